@@ -1,23 +1,63 @@
+import calendar
 import datetime
-import json
 import os
-import time
 
 import click
 import pandas as pd
 from bs4 import BeautifulSoup
 from loguru import logger
 from lxml import etree
-from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
 
+from browser_pool import BrowserPool, create_browser
+from config import AIR_PAGE_TIMEOUT, BROWSER_MAX_PAGES, HTTP_CACHE_DIR, PARQUET_DIR, RATE_LIMIT
+from http_cache import configure_cache
+from normalize import normalize_aqi
+from parquet_sink import configure_parquet, get_parquet_sink
+from rate_limit import configure_limiter, get_limiter
+from sinks import close_sink, get_csv_sink
 from tools import requests_get
+from xpath_registry import register
+
+AIR_XPATHS = register("air", {
+    "dates": "/html/body/div[3]/div[1]/div[2]/div[2]/div[2]/ul/li[position()<=last()]/a",
+    "tables": "//table[.//tr[td]]",
+    "rows": ".//tr",
+    "cells": "./th|./td",
+})
+AIR_COLUMNS = ("日期", "AQI", "范围", "质量等级", "PM2.5", "PM10", "SO2", "CO", "NO2", "O3_8h")
+COLUMN_ALIASES = {"O3": "O3_8h", "O3_8H": "O3_8h", "PM25": "PM2.5"}
+# 数据表格由 js 填充, 出现数据行时页面加载完成
+AIR_TABLE_ROW = (By.XPATH, "//table//tr[td]")
 
 
 def date_range(start, end, step=1, format="%Y%m"):
-    strptime, strftime = datetime.datetime.strptime, datetime.datetime.strftime
-    days = (strptime(end, format) - strptime(start, format)).days
-    return set([strftime(strptime(start, format) + datetime.timedelta(i), format) for i in
-                range(0, days, step)])
+    """ start 到 end 之间的月份, 不包括 end, step 为间隔的月数"""
+    start, end = datetime.datetime.strptime(start, format), datetime.datetime.strptime(end, format)
+    first, last = start.year * 12 + start.month - 1, end.year * 12 + end.month - 1
+    return [datetime.date(month // 12, month % 12 + 1, 1).strftime(format) for month in range(first, last, step)]
+
+
+def days_in_month(month, format="%Y%m"):
+    """ 一个月的天数"""
+    month = datetime.datetime.strptime(month, format)
+    return calendar.monthrange(month.year, month.month)[1]
+
+
+def parse_table(html) -> pd.DataFrame:
+    """ 页面里第一个有数据的表格 -> 全部为字符串的 DataFrame, 第一行为表头, 没有表格时为空"""
+    selector = etree.HTML(html)
+    tables = AIR_XPATHS["tables"](selector) if selector is not None else []
+    if not tables:
+        return pd.DataFrame(columns=list(AIR_COLUMNS))
+    rows = [["".join(cell.itertext()).strip() for cell in AIR_XPATHS["cells"](tr)]
+            for tr in AIR_XPATHS["rows"](tables[0])]
+    rows = [row for row in rows if row]
+    header = [COLUMN_ALIASES.get(name, name) for name in rows[0]]
+    return pd.DataFrame([row[:len(header)] for row in rows[1:]], columns=header)
 
 
 def get_all_city_names():
@@ -33,20 +73,36 @@ def get_all_city_names():
 
 
 class AirSpyder:
-    def __init__(self, city_name, start_time=None, stop_time=None, dirname="."):
+    def __init__(self, city_name, start_time=None, stop_time=None, dirname=".", browser=None, incremental=False,
+                 timeout=AIR_PAGE_TIMEOUT):
+        """
+        browser: 浏览器池中的浏览器, 为空时第一次使用时新建一个, close 时退出
+        incremental: 只抓保存文件里还没有整月数据的月份和当前月份
+        timeout: 等待数据表格出现的最长秒数
+        """
         self.city_name = city_name
+        self.incremental = incremental
+        self.timeout = timeout
         self.dirname = dirname
         self.start_time = start_time
         self.stop_time = stop_time
         self.domain = "https://www.aqistudy.cn/historydata/daydata.php?city={}&month={}"
-        option = webdriver.ChromeOptions()
-        option.add_argument('--headless')
-        option.add_argument("start-maximized")
-        option.add_argument("--disable-blink-features=AutomationControlled")
-        option.add_experimental_option("excludeSwitches", ["enable-automation"])
-        option.add_experimental_option("useAutomationExtension", False)
-        self.browser = webdriver.Chrome(options=option)
-        time.sleep(2)
+        self._browser = browser
+        self.own_browser = False
+
+    @property
+    def browser(self):
+        if self._browser is None:
+            self._browser = create_browser()
+            self.own_browser = True
+        return self._browser
+
+    def close(self):
+        close_sink(self.get_save_path())
+        if self.own_browser:
+            self._browser.quit()
+            self._browser = None
+            self.own_browser = False
 
     @staticmethod
     def get_selector(url):
@@ -73,57 +129,158 @@ class AirSpyder:
                 self.stop_time = datetime.date.today().strftime("%Y%m")
             if int(self.stop_time) < int(self.start_time):
                 self.start_time, self.stop_time = self.stop_time, self.start_time
-            dates = date_range(self.start_time, self.stop_time, step=1, format="%Y%m")
-            dates = list(dates)
-            return sorted(dates)
+            return date_range(self.start_time, self.stop_time, step=1, format="%Y%m")
 
         url = "https://www.aqistudy.cn/historydata/daydata.php?city={}".format(self.city_name)
         try:
             selector = self.get_selector(url)
-            pattern = "/html/body/div[3]/div[1]/div[2]/div[2]/div[2]/ul/li[position()<=last()]/a"
-            return sorted([self._get_date(elem.text) for elem in selector.xpath(pattern)])
+            dates = [self._get_date(elem.text) for elem in AIR_XPATHS["dates"](selector)]
+            return sorted(str(d) for d in dates if d is not None)
         except Exception as err:
             logger.error(err)
             raise Exception(err)
 
     @staticmethod
-    def save_json(mapping, save_path):
-        """ 保存成json"""
-        if not isinstance(mapping, str):
-            mapping = json.dumps(mapping)
-        with open(save_path, "a+") as fd:
-            fd.write(mapping + "\n")
+    def to_days(dates: pd.Series) -> pd.Series:
+        """ 日期列 -> "20200101" 这样的字符串, 取不到时为空"""
+        if pd.api.types.is_datetime64_any_dtype(dates):
+            return dates.dt.strftime("%Y%m%d")
+        days = dates.astype("string").str.extract(r"(\d{4})\D?(\d{2})\D?(\d{2})")
+        return days[0] + days[1] + days[2]
 
-    @staticmethod
-    def bulk_save_json(records, save_path):
-        with open(save_path, "a+") as fd:
-            for record in records:
-                record = json.dumps(record)
-                fd.write(record + "\n")
-
-    def get_one(self, date):
-        self.browser.get(self.domain.format(self.city_name, date))
-        time.sleep(3)
-        df: pd.DataFrame = pd.read_html(self.browser.page_source, header=0)[0]
+    def read_stored_dates(self):
+        """ 保存文件里的日期列, 设置了 parquet 目录时读 parquet 里这个城市的分区, 否则读 {city}.csv"""
+        parquet = get_parquet_sink("aqi")
+        if parquet is not None:
+            return parquet.read_partition({"city": self.city_name}, ["日期"])["日期"]
+        path = self.get_save_path()
+        if not os.path.exists(path):
+            return pd.Series([], dtype=str)
+        try:
+            return pd.read_csv(path, usecols=["日期"], dtype=str)["日期"]
+        except ValueError:
+            return pd.Series([], dtype=str)
+
+    def get_stored_days(self):
+        """ 保存文件里每个月已有的天数, {"202001": 31, "202002": 12, ...}"""
+        days = self.to_days(self.read_stored_dates()).dropna().drop_duplicates()
+        return days.str[:6].value_counts().to_dict()
+
+    def drop_months(self, months):
+        """ 删除保存文件里这些月份的记录, 重新抓取只保存了一部分的月份前调用, 避免重复的行"""
+        def drop(df):
+            return self.to_days(df["日期"]).str[:6].isin(months)
+
+        parquet = get_parquet_sink("aqi")
+        if parquet is not None:
+            rows = parquet.drop_rows({"city": self.city_name}, drop)
+        else:
+            path = self.get_save_path()
+            close_sink(path)
+            df = pd.read_csv(path, dtype=str, keep_default_na=False)
+            mask = drop(df)
+            rows = int(mask.sum())
+            if rows:
+                df[~mask].to_csv(f"{path}.tmp", index=False)
+                os.replace(f"{path}.tmp", path)
+        logger.info(f"[City]: {self.city_name}   dropped {rows} rows of {len(months)} incomplete months")
+
+    def get_todo_dates(self):
+        """ 需要抓取的月份
+
+        增量模式下跳过已经保存了整月数据的月份, 当前月份总是重新抓取,
+        只保存了一部分天数的月份先删除已有的记录再重新抓取.
+        """
+        dates = self.get_dates()
+        if not self.incremental:
+            return dates
+        stored = self.get_stored_days()
+        current = datetime.date.today().strftime("%Y%m")
+        todo = [d for d in dates if d == current or stored.get(d, 0) < days_in_month(d)]
+        incomplete = [d for d in todo if stored.get(d)]
+        if incomplete:
+            self.drop_months(incomplete)
+        logger.info(f"[City]: {self.city_name}   {len(dates) - len(todo)} months stored, {len(todo)} to crawl, "
+                    f"{len(incomplete)} of them incomplete")
+        return todo
+
+    def get_save_path(self):
+        return os.path.join(self.dirname, self.city_name + ".csv")
+
+    def get_one(self, date, browser=None):
+        """ 抓取一个月的数据, browser 为空时使用自己的浏览器"""
+        browser = browser or self.browser
+        url = self.domain.format(self.city_name, date)
+        get_limiter().acquire(url)
+        browser.get(url)
+        try:
+            WebDriverWait(browser, self.timeout).until(expected_conditions.presence_of_element_located(AIR_TABLE_ROW))
+        except TimeoutException:
+            # 没有数据的月份不会出现数据行, 等到超时后按空表格处理
+            logger.warning(f"[City]: {self.city_name}   [Date]:{date}    no data rows after {self.timeout}s")
+        df = parse_table(browser.page_source)
         if not df.empty:
             logger.info(df)
             df["city"] = self.city_name
-            save_path = os.path.join(self.dirname, self.city_name + ".csv")
-            if os.path.exists(save_path):
-                df.to_csv(save_path, mode="a", index=None, header=False)
-            else:
-                df.to_csv(save_path, mode="a", index=None, header=True)
+            get_csv_sink(self.get_save_path(), columns=df.columns).write_many(df.to_dict("records"))
+            parquet = get_parquet_sink("aqi")
+            if parquet:
+                # 整个表格一次转换成数值和日期
+                parquet.write_frame(normalize_aqi(df))
             logger.success(f"[City]: {self.city_name}   [Date]:{date}    [DONE]")
         else:
             logger.success(f"[City]: {self.city_name}   [Date]:{date}    [None]")
 
     def start_crawler(self):
-        dates = self.get_dates()
+        dates = self.get_todo_dates()
         for d in dates:
             try:
                 self.get_one(d)
             except Exception as err:
                 logger.error(f"[City]: {self.city_name}   [Date]:{d}    [FAILED]: {err}")
+        close_sink(self.get_save_path())
+
+
+def crawl_cities(city_names, start_time=None, stop_time=None, dirname=".", browsers=4,
+                 max_pages=BROWSER_MAX_PAGES, incremental=False, timeout=AIR_PAGE_TIMEOUT):
+    """ 多个浏览器从共享队列中取 (城市, 月份) 任务
+
+    Parameters
+    ----------
+    city_names : list, 城市列表
+    start_time : str, 开始月份, 为空时抓城市有数据的所有月份
+    stop_time : str, 结束月份
+    dirname : str, 保存目录, 每个城市一个 {city}.csv
+    browsers : int, 浏览器数量, 任务数少于浏览器数时只启动任务数个浏览器
+    max_pages : int, 一个浏览器最多加载多少页后重启
+    incremental : bool, 只抓保存文件里还没有整月数据的月份和当前月份
+    timeout : float, 等待数据表格出现的最长秒数
+    """
+    spyders = {}
+    tasks = []
+    for city_name in city_names:
+        spyder = AirSpyder(city_name, start_time, stop_time, dirname, incremental=incremental, timeout=timeout)
+        try:
+            dates = spyder.get_todo_dates()
+        except Exception as err:
+            logger.error(f"[City]: {city_name}    [FAILED]: {err}")
+            continue
+        spyders[city_name] = spyder
+        tasks.extend((city_name, d) for d in dates)
+    logger.info(f"{len(tasks)} city months for {len(spyders)} cities, {browsers} browsers")
+
+    def handler(browser, task):
+        city_name, d = task
+        try:
+            spyders[city_name].get_one(d, browser)
+        except Exception as err:
+            logger.error(f"[City]: {city_name}   [Date]:{d}    [FAILED]: {err}")
+
+    try:
+        BrowserPool(browsers, max_pages).run(tasks, handler)
+    finally:
+        for spyder in spyders.values():
+            spyder.close()
 
 
 @click.command()
@@ -132,7 +289,16 @@ class AirSpyder:
 @click.option("--stop_time", help="结束日期", default=None)
 @click.option("--dirname", help="Save dirname", default=".")
 @click.option("--alone", help="", default="one")
-def main(city_name, start_time, stop_time, dirname, alone):
+@click.option("--browsers", help="Number of browsers pulling city-month tasks from a shared queue", default=1)
+@click.option("--max_pages", help="Restart a browser after loading this many pages", default=BROWSER_MAX_PAGES)
+@click.option("--incremental", help="Only crawl the current month and months missing days in {city}.csv, or in the "
+                                   "parquet dataset when --parquet_dir is set", is_flag=True)
+@click.option("--timeout", help="Seconds to wait for the data table of a month", default=AIR_PAGE_TIMEOUT)
+@click.option("--rate", help="Target requests per second for each domain", default=RATE_LIMIT)
+@click.option("--cache_dir", help="HTTP response cache dirname, empty to disable", default=HTTP_CACHE_DIR)
+@click.option("--parquet_dir", help="Also write typed, partitioned parquet files to this dirname", default=PARQUET_DIR)
+def main(city_name, start_time, stop_time, dirname, alone, browsers, max_pages, incremental, timeout, rate, cache_dir,
+         parquet_dir):
     """
     1. 需要安装selenium，pip install selenium
 
@@ -155,18 +321,30 @@ def main(city_name, start_time, stop_time, dirname, alone):
     python air_spyder.py --start_time 201409 --stop_time 201607 --alone all
 
     python air_spyder.py --alone all
+
+    - 8 个浏览器同时爬, 每个浏览器加载 200 页后重启
+
+    python air_spyder.py --alone all --browsers 8 --max_pages 200
+
+    - 增量, 只抓已保存文件里缺少天数的月份和当前月份
+
+    python air_spyder.py --alone all --incremental
+
+    - 同时写入按城市分区的 parquet, 增量时按 parquet 里的数据判断已有的月份
+
+    python air_spyder.py --alone all --incremental --parquet_dir parquet
+
+    - 限速, 每秒请求数
+
+    python air_spyder.py --alone all --rate 0.5
     """
-    if alone == "one":
-        spyder = AirSpyder(city_name, start_time, stop_time, dirname)
-        spyder.start_crawler()
-        spyder.browser.close()
-    else:
-        city_names = get_all_city_names()
-        logger.info(city_names)
-        for city_name in city_names:
-            spyder = AirSpyder(city_name, start_time, stop_time, dirname)
-            spyder.start_crawler()
-            spyder.browser.close()
+    configure_limiter(rate)
+    configure_cache(cache_dir)
+    configure_parquet(parquet_dir)
+    city_names = [city_name] if alone == "one" else get_all_city_names()
+    logger.info(city_names)
+    # 一个浏览器时也由浏览器池执行, 所有城市共用一个浏览器, 按 max_pages 重启
+    crawl_cities(city_names, start_time, stop_time, dirname, browsers, max_pages, incremental, timeout)
 
 
 if __name__ == '__main__':
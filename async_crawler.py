@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: asyncio 并发抓取链家页面, 解析仍然使用 HomeLinkSpider 的方法
+
+@ModifyRecord:
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+import aiohttp
+from loguru import logger
+from lxml import etree
+
+from http_cache import get_cache
+from rate_limit import get_limiter
+from tools import get_useragent
+
+_parser = None
+
+
+def init_parser(city_abbreviation):
+    """ 解析进程的初始化函数, 每个进程一个 HomeLinkSpider 负责解析"""
+    global _parser
+    # home_link 导入了本模块, 放在函数里避免循环导入
+    from home_link import HomeLinkSpider
+    _parser = HomeLinkSpider(city_abbreviation)
+
+
+def parse_house(house, content, encoding):
+    """ 在解析进程中把详情页的 bytes 解析成 dict"""
+    selector = etree.HTML(content.decode(encoding or "utf-8", errors="replace"))
+    return _parser.get_house_all_info(house, selector)
+
+
+class AsyncFetcher:
+    """ 按 host 限制并发数的异步下载器"""
+
+    def __init__(self, concurrency=16, per_host=4, timeout=30, tries=5, delay=1):
+        """
+        Parameters
+        ----------
+        concurrency : int, 全局最大连接数
+        per_host : int, 同一个 host 的最大并发请求数
+        timeout : int, 单个请求超时时间(秒)
+        tries : int, 失败重试次数
+        delay : int, 重试间隔(秒)
+        """
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.tries = tries
+        self.delay = delay
+        self.session = None
+        self._semaphores = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    def get_semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self._semaphores[host]
+
+    async def fetch(self, url):
+        """ 下载页面, 返回 html 文本"""
+        content, encoding = await self.fetch_raw(url)
+        return content.decode(encoding or "utf-8", errors="replace")
+
+    async def fetch_raw(self, url):
+        """ 下载页面, 返回 (bytes, encoding)
+
+        缓存读写 sqlite 和解压/压缩文件, 放到线程池里执行, 不阻塞事件循环
+        """
+        loop = asyncio.get_event_loop()
+        cache = get_cache()
+        cached = await loop.run_in_executor(None, cache.get, url) if cache else None
+        if cached:
+            return cached
+        for attempt in range(1, self.tries + 1):
+            limiter = get_limiter()
+            try:
+                async with self.get_semaphore(url):
+                    await asyncio.sleep(limiter.reserve(url))
+                    headers = {'User-Agent': get_useragent(), }
+                    start = time.monotonic()
+                    async with self.session.get(url, headers=headers) as response:
+                        if response.status != 200:
+                            raise Exception(f"status code {response.status}")
+                        content = await response.read()
+                        encoding = response.get_encoding()
+                        redirected = bool(response.history)
+                    limiter.feedback(url, True, time.monotonic() - start)
+                    if cache:
+                        await loop.run_in_executor(None, cache.put, url, content, encoding, redirected)
+                    return content, encoding
+            except Exception as err:
+                limiter.feedback(url, ok=False)
+                if attempt == self.tries:
+                    raise
+                logger.warning(f"fetch {url} failed ({attempt}/{self.tries}): {err}")
+                await asyncio.sleep(self.delay)
+
+    async def fetch_selector(self, url):
+        return etree.HTML(await self.fetch(url))
+
+
+class AsyncHomeLinkCrawler:
+    """ 并发抓取 区 -> 县 -> 列表页 -> 详情页
+
+    列表页由 discover 协程并发抓取, 发现的房子放入有界队列, 由 concurrency 个 worker 抓详情页.
+    parse_workers > 0 时详情页的 bytes 放入另一个有界队列, 由进程池解析, 解析不再占用下载所在的 CPU.
+    """
+
+    def __init__(self, spider, concurrency=16, per_host=4, accept_house=None, save_item=None, parse_workers=0):
+        """
+        Parameters
+        ----------
+        spider : HomeLinkSpider, 负责解析页面
+        concurrency : int, 详情页 worker 数
+        per_host : int, 同一个 host 的最大并发请求数
+        accept_house : callable, accept_house(house) -> bool, 返回 False 时跳过这个房子
+        save_item : callable, save_item(house_info), 默认保存到 {city_abbreviation}.txt
+        parse_workers : int, 解析进程数, 0 时在下载的事件循环里解析
+        """
+        self.spider = spider
+        self.concurrency = concurrency
+        self.fetcher = AsyncFetcher(concurrency=concurrency, per_host=per_host)
+        self.accept_house = accept_house or (lambda house: True)
+        self.save_item = save_item or self.default_save_item
+        self.parse_workers = parse_workers
+        self.queue = None
+        self.parse_queue = None
+        self.pool = None
+
+    def default_save_item(self, house_info):
+        self.spider.save_house_info(house_info)
+        logger.info(house_info)
+
+    async def get_counties(self, district, counties_list=None):
+        try:
+            counties = self.spider.get_counties(district, await self.fetcher.fetch_selector(district.url))
+        except Exception as err:
+            logger.error(f"{district}: {err}")
+            return []
+        if not counties:
+            logger.error(f"{district} 没有县级区域")
+            return []
+        if counties_list:
+            counties = [county for county in counties if county.name in counties_list]
+        return counties
+
+    async def crawl_page(self, page_url, district, county, selector=None):
+        try:
+            if selector is None:
+                selector = await self.fetcher.fetch_selector(page_url)
+        except Exception as err:
+            logger.error(f"{page_url}: {err}")
+            return
+        house_list = self.spider.get_house_from_current_page(selector)
+        if not house_list:
+            logger.error(f"{page_url}：该页面没有房子")
+            return
+        for house in house_list:
+            house.district = district.name
+            house.county = county.name
+            if self.accept_house(house):
+                await self.queue.put(house)
+
+    async def crawl_county(self, district, county):
+        try:
+            first_page = await self.fetcher.fetch_selector(county.url)
+        except Exception as err:
+            logger.error(f"{county}: {err}")
+            return
+        total_page = self.spider.get_total_page(first_page)
+        if not total_page:
+            return
+        total_page = total_page[0]
+        # 与同步版本保持一致, 只抓 pg1 ~ pg{total_page - 1}, pg1 就是已经下载的第一页
+        await asyncio.gather(*[self.crawl_page(f"{county.url}pg{i}", district, county,
+                                               first_page if i == 1 else None)
+                               for i in range(1, total_page)])
+
+    async def discover(self, districts_list=None, counties_list=None):
+        districts = self.spider.get_districts(await self.fetcher.fetch_selector(self.spider.sub_domain))
+        if not districts:
+            logger.error("没有区级区域")
+            return
+        if districts_list:
+            districts = [district for district in districts if district.name in districts_list]
+        counties = await asyncio.gather(*[self.get_counties(district, counties_list) for district in districts])
+        await asyncio.gather(*[self.crawl_county(district, county)
+                               for district, district_counties in zip(districts, counties)
+                               for county in district_counties])
+
+    async def crawl_house(self, house):
+        try:
+            content, encoding = await self.fetcher.fetch_raw(house.url)
+        except Exception as err:
+            logger.error(f"{house.url}: {err}")
+            return
+        if self.pool:
+            await self.parse_queue.put((house, content, encoding))
+            return
+        selector = etree.HTML(content.decode(encoding or "utf-8", errors="replace"))
+        house_info = self.spider.get_house_all_info(house, selector)
+        if house_info:
+            self.save_item(house_info)
+
+    async def parse_worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await self.parse_queue.get()
+            try:
+                if item is None:
+                    return
+                house_info = await loop.run_in_executor(self.pool, parse_house, *item)
+                if house_info:
+                    self.save_item(house_info)
+            except Exception as err:
+                logger.error(f"parse {item[0].url} failed: {err}")
+            finally:
+                self.parse_queue.task_done()
+
+    async def worker(self):
+        while True:
+            house = await self.queue.get()
+            try:
+                if house is None:
+                    return
+                await self.crawl_house(house)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, producer):
+        self.queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        parsers = []
+        if self.parse_workers > 0:
+            self.parse_queue = asyncio.Queue(maxsize=self.parse_workers * 4)
+            self.pool = ProcessPoolExecutor(self.parse_workers, initializer=init_parser,
+                                            initargs=(self.spider.city_abbreviation,))
+            parsers = [asyncio.ensure_future(self.parse_worker()) for _ in range(self.parse_workers)]
+        try:
+            async with self.fetcher:
+                workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+                try:
+                    await producer
+                finally:
+                    for _ in workers:
+                        await self.queue.put(None)
+                    await asyncio.gather(*workers)
+        finally:
+            if self.pool:
+                for _ in parsers:
+                    await self.parse_queue.put(None)
+                await asyncio.gather(*parsers)
+                self.pool.shutdown()
+                self.pool = None
+
+    async def run(self, districts_list=None, counties_list=None):
+        """ 抓取整个城市, 可以用 districts_list / counties_list 过滤区和县"""
+        logger.info("Start async crawler")
+        await self._run(self.discover(districts_list, counties_list))
+        logger.info("Finished all")
+
+    async def run_houses(self, house_list):
+        """ 只抓取给定房子的详情页"""
+
+        async def produce():
+            for house in house_list:
+                await self.queue.put(house)
+
+        await self._run(produce())
+
+
+def run_crawler(spider, concurrency=16, per_host=4, districts_list=None, counties_list=None, **kwargs):
+    """ 同步入口, 抓取整个城市"""
+    crawler = AsyncHomeLinkCrawler(spider, concurrency, per_host, **kwargs)
+    asyncio.run(crawler.run(districts_list, counties_list))
+
+
+def run_houses(spider, house_list, concurrency=16, per_host=4, **kwargs):
+    """ 同步入口, 抓取给定房子的详情页"""
+    crawler = AsyncHomeLinkCrawler(spider, concurrency, per_host, **kwargs)
+    asyncio.run(crawler.run_houses(house_list))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 无头 Chrome 池, 多个浏览器从共享队列中取任务, 加载一定页数后重启浏览器
+
+@ModifyRecord:
+"""
+import queue
+import threading
+
+from loguru import logger
+from selenium import webdriver
+
+from config import BROWSER_MAX_PAGES, BROWSER_POOL_SIZE
+
+
+def create_browser():
+    """ 创建无头 Chrome"""
+    option = webdriver.ChromeOptions()
+    option.add_argument('--headless')
+    option.add_argument("start-maximized")
+    option.add_argument("--disable-blink-features=AutomationControlled")
+    option.add_experimental_option("excludeSwitches", ["enable-automation"])
+    option.add_experimental_option("useAutomationExtension", False)
+    return webdriver.Chrome(options=option)
+
+
+class BrowserPool:
+    """ size 个线程, 每个线程拥有一个浏览器, 从共享的任务队列中取任务执行
+
+    浏览器在第一次取到任务时启动, 加载的页面数达到 max_pages 后退出, 下一个任务再启动新的浏览器, 避免内存一直增长.
+    """
+
+    def __init__(self, size=BROWSER_POOL_SIZE, max_pages=BROWSER_MAX_PAGES, factory=create_browser):
+        """
+        Parameters
+        ----------
+        size : int, 浏览器数量
+        max_pages : int, 一个浏览器最多加载多少页后重启, 0 时不重启
+        factory : callable, 创建浏览器
+        """
+        self.size = size
+        self.max_pages = max_pages
+        self.factory = factory
+        self.tasks = queue.Queue()
+
+    def worker(self, handler):
+        browser, pages = None, 0
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    return
+                if browser is None:
+                    browser, pages = self.factory(), 0
+                try:
+                    pages += handler(browser, task) or 1
+                except Exception as err:
+                    logger.exception(f"browser task {task} failed: {err}")
+                    # 浏览器可能已经不可用, 换一个新的
+                    pages = self.max_pages or pages
+                if self.max_pages and pages >= self.max_pages:
+                    logger.info(f"recycle browser after {pages} pages")
+                    self.quit(browser)
+                    browser = None
+        finally:
+            if browser is not None:
+                self.quit(browser)
+
+    @staticmethod
+    def quit(browser):
+        try:
+            browser.quit()
+        except Exception as err:
+            logger.warning(f"failed to quit browser: {err}")
+
+    def run(self, tasks, handler):
+        """ 执行所有任务, 全部完成后返回, 任务比浏览器少时只启动任务数个浏览器
+
+        Parameters
+        ----------
+        tasks : iterable, 任务列表
+        handler : callable, handler(browser, task) -> 本次加载的页面数, 返回 None 时按 1 页计算
+        """
+        tasks = list(tasks)
+        for task in tasks:
+            self.tasks.put(task)
+        size = min(self.size, len(tasks))
+        logger.info(f"{len(tasks)} browser tasks, {size} browsers")
+        threads = [threading.Thread(target=self.worker, args=(handler,), daemon=True) for _ in range(size)]
+        for _ in threads:
+            self.tasks.put(None)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
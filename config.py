@@ -10,6 +10,53 @@ Created on 2020/6/20 23:10
 """
 DOMAIN_URL = "https://sh.lianjia.com/"
 
+# 共享 HTTP 连接池: 每个 host 保持的 keep-alive 连接数, 请求超时时间(秒)
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = 30
+
+# 每个域名的目标速率(每秒请求数), 命令行 --rate 可以覆盖; 响应超过 RATE_SLOW_SECONDS 秒视为过载
+RATE_LIMIT = 1.0
+RATE_SLOW_SECONDS = 5
+
+# HTTP 响应缓存目录, 为空时不缓存; 缓存总大小上限(字节)
+HTTP_CACHE_DIR = ".http_cache"
+HTTP_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# 输出文件: 缓存多少条记录/最长多少秒写入一次, fsync 策略(never/close/flush), 单个文件大小上限(字节, 0 不切分)
+SINK_BATCH_SIZE = 100
+SINK_FLUSH_INTERVAL = 1.0
+SINK_FSYNC = "never"
+SINK_MAX_BYTES = 0
+
+# parquet 输出目录, 为空时不输出; 每个 row group 的行数, 同时打开的文件数
+PARQUET_DIR = ""
+PARQUET_ROW_GROUP_SIZE = 5000
+PARQUET_MAX_OPEN_FILES = 64
+
+# json 转 csv/excel 时每次读取的行数, 0 时整个文件读入内存
+CONVERT_CHUNK_SIZE = 50000
+
+# 合并 csv 去重时的内存预算(字节), 超过时按 key 的哈希分区写入临时文件
+MERGE_MEMORY_BUDGET = 512 * 1024 ** 2
+
+# 无头浏览器池: 默认浏览器数量, 一个浏览器加载多少页后重启(0 不重启)
+BROWSER_POOL_SIZE = 4
+BROWSER_MAX_PAGES = 200
+
+# 空气质量页面等待数据表格出现的最长秒数
+AIR_PAGE_TIMEOUT = 15
+
+# 任务队列: 每个消费者每次预取的任务数, 租约秒数(超时未确认的任务重新入队), 最多重试次数(超过后进入死信队列)
+WORK_QUEUE_BATCH_SIZE = 10
+WORK_QUEUE_VISIBILITY_TIMEOUT = 600
+WORK_QUEUE_MAX_RETRIES = 3
+# 生产者缓存多少个任务/最长多少秒一次批量推送
+WORK_QUEUE_PUSH_BATCH_SIZE = 500
+WORK_QUEUE_PUSH_INTERVAL = 1.0
+
+# 发现阶段(区, 县, 页数, 列表页)并发请求的线程数, 请求仍然受每个域名的速率限制, 不要超过 HTTP_POOL_SIZE
+DISCOVERY_WORKERS = 8
+
 PATTERN = {
     "房间代号": "//property[@name = 'houseCode']/string/text()",
     "城市": "//property[@name = 'city_name']/string/text()",
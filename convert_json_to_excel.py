@@ -1,12 +1,23 @@
 # In[]
+import csv
 import json
+import math
 import os
+import tempfile
 from pathlib import Path
 
 import click
 import pandas as pd
 from loguru import logger
 
+from config import CONVERT_CHUNK_SIZE, MERGE_MEMORY_BUDGET
+from normalize import normalize_houses
+from seen_index import SeenIndex
+from sinks import flush_sinks, get_csv_sink
+
+# 按顺序选择第一个存在的列作为去重的 key
+DEDUP_KEYS = ("房间代号", "网址")
+
 
 def load_data(path):
     data = []
@@ -26,98 +37,296 @@ def load_data(path):
     return df, dirname, name
 
 
-def convert_json_to_excel(path, typ):
+def iter_records(path):
+    """ 逐行读取 json, 跳过解析失败和不是 dict 的行"""
+    with open(path, "r") as f:
+        for index, line in enumerate(f):
+            try:
+                _dict = json.loads(line)
+            except Exception as err:
+                logger.error(f"{index}: {line}", err)
+                continue
+            if isinstance(_dict, dict):
+                yield _dict
+
+
+def iter_chunks(records, chunksize):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_dedup_key(columns, key=None):
+    if key:
+        return key
+    for name in DEDUP_KEYS:
+        if name in columns:
+            return name
+    return None
+
+
+def iter_unique_frames(path, chunksize=CONVERT_CHUNK_SIZE, key=None):
+    """ 每次读取 chunksize 行, 去重后产生 DataFrame, 内存占用和文件大小无关
+
+    先读一遍文件得到所有记录的列, 每块数据都对齐到这些列. 已经出现过的 key 记录在临时的 SeenIndex 文件里.
+
+    Parameters
+    ----------
+    path : str, json 文件
+    chunksize : int, 每块的行数
+    key : str, 去重的列, 默认 DEDUP_KEYS 中第一个存在的列, 都不存在或者 key 为空时按整行去重
+    """
+    columns = get_unified_columns([path])
+    key = get_dedup_key(columns, key)
+    logger.info(f"dedup {path} by {key or 'all columns'}")
+    with tempfile.TemporaryDirectory() as dirname:
+        seen = SeenIndex(os.path.join(dirname, "seen.db"))
+        try:
+            for chunk in iter_chunks(iter_records(path), chunksize):
+                df = pd.DataFrame(chunk).reindex(columns=columns)
+                row_keys = "#" + pd.util.hash_pandas_object(df.astype(str), index=False).astype(str)
+                if key:
+                    row_keys = df[key].astype(str).where(df[key].notna(), row_keys)
+                df = df[seen.add_many(row_keys)]
+                if not df.empty:
+                    yield df
+        finally:
+            seen.close()
+
+
+def convert_json_to_excel(path, typ, chunksize=0, key=None, normalize=False):
+    """ 转换json成excel, normalize 时先转换房子记录的类型
+
+    chunksize 为 0 时整个文件读入内存, 按整行去重, 保存为 xls; 大于 0 时分块写入 xlsx, 按 key 去重.
+    """
+    if chunksize:
+        return convert_json_to_excel_streaming(path, typ, chunksize, key, normalize)
     df, dirname, name = load_data(path)
+    if normalize:
+        df = normalize_houses(df)
     save_name = os.path.join(dirname, f"{name}_{typ}.xls")
     df.to_excel(save_name)
     logger.success(f"转换成功，保存到{save_name}")
 
 
-def convert_json_to_csv(path, typ):
-    """ 转换json成csv"""
-    df, dirname, name = load_data(path)
+def convert_json_to_excel_streaming(path, typ, chunksize=CONVERT_CHUNK_SIZE, key=None, normalize=False):
+    """ 用 openpyxl 的 write_only 模式逐块写入, xls 最多 65536 行, 所以保存为 xlsx"""
+    from openpyxl import Workbook
+
+    dirname, name = Path(path).parent.__str__(), Path(path).name
+    save_name = os.path.join(dirname, f"{name}_{typ}.xlsx")
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    offset = 0
+    for df in iter_unique_frames(path, chunksize, key):
+        if normalize:
+            df = normalize_houses(df)
+        if offset == 0:
+            sheet.append([None] + list(df.columns))
+        df = df.astype(object).where(df.notna(), None)
+        for index, row in enumerate(df.itertuples(index=False), offset):
+            sheet.append([index] + list(row))
+        offset += len(df)
+    workbook.save(save_name)
+    logger.success(f"转换成功，{offset} 行，保存到{save_name}")
+
+
+def convert_json_to_csv(path, typ, chunksize=0, key=None, normalize=False):
+    """ 转换json成csv
+
+    Parameters
+    ----------
+    path : str, json 文件
+    typ : str, 保存为 {path}_{typ}.csv
+    chunksize : int, 0 时整个文件读入内存按整行去重; 大于 0 时分块读写, 按 key 去重
+    key : str, 分块时去重的列, 默认 DEDUP_KEYS 中第一个存在的列
+    normalize : bool, 把房子记录的价格, 面积, 日期等转换成数值和日期后再保存
+    """
+    if not chunksize:
+        df, dirname, name = load_data(path)
+        if normalize:
+            df = normalize_houses(df)
+        save_name = os.path.join(dirname, f"{name}_{typ}.csv")
+        df.to_csv(save_name)
+        logger.success(f"转换成功，保存到{save_name}")
+        return
+    dirname, name = Path(path).parent.__str__(), Path(path).name
     save_name = os.path.join(dirname, f"{name}_{typ}.csv")
-    df.to_csv(save_name)
-    logger.success(f"转换成功，保存到{save_name}")
+    offset = 0
+    with open(save_name, "w", encoding="utf-8", newline="") as fd:
+        for df in iter_unique_frames(path, chunksize, key):
+            if normalize:
+                df = normalize_houses(df)
+            df.index = pd.RangeIndex(offset, offset + len(df))
+            df.to_csv(fd, header=offset == 0)
+            offset += len(df)
+    logger.success(f"转换成功，{offset} 行，保存到{save_name}")
 
 
 def save_dict_to_csv(mapping, save_path, columns):
-    df = pd.DataFrame([mapping])
-    if os.path.exists(save_path):
-        df.to_csv(save_path, mode="a", index=False, header=False, columns=columns)
-    else:
-        df.to_csv(save_path, mode="a", index=False, header=True, columns=columns)
+    get_csv_sink(save_path, columns=columns).write(mapping)
 
 
 def get_column_name(path):
-    with open(path, "r") as f:
-        for line in f:
-            _dict = json.loads(line)
-            if not isinstance(_dict, dict):
-                continue
-            return list(_dict.keys())
+    for _dict in iter_records(path):
+        return list(_dict.keys())
 
 
-def merge_multiple_csv(path_list, save_path):
-    df_total = None
-    column_name = None
-    df_list = []
+def get_unified_columns(path_list):
+    """ 按出现顺序合并所有文件所有记录的列, 逐行读取, 只在内存里保存列名"""
+    columns = {}
     for path in path_list:
-        df = pd.read_csv(path)
-        if not column_name:
-            column_name = list(df.columns)
-        df = df[column_name]
-        df_list.append(df)
+        for record in iter_records(path):
+            for name in record:
+                columns.setdefault(name, None)
+    return list(columns)
+
 
-    df_total = pd.concat(df_list)
-    df_total = df_total.drop_duplicates(subset=["房间代号"], keep="first")
-    df_total.to_csv(save_path)
+def merge_multiple_csv(path_list, save_path, key="房间代号", keep="first", memory_budget=MERGE_MEMORY_BUDGET,
+                       chunksize=CONVERT_CHUNK_SIZE):
+    """ 合并多个csv文件, 按 key 去重, 内存占用不超过 memory_budget
 
+    第一遍分块读取所有文件, 按 key 的哈希把行写入 n 个临时分区文件, 同一个 key 的行都在同一个分区;
+    第二遍逐个分区读入内存去重后写入 save_path. n 由输入文件大小和 memory_budget 决定, 为 1 时不写临时文件.
+    输出按分区排列, 分区内保持输入的顺序.
 
-def merge_multiple_file(path_list, save_path):
-    """ 合并多个txt文件 并保存为csv文件"""
-    columns = None
+    Parameters
+    ----------
+    path_list : list, csv 文件列表, 列以第一个文件为准
+    save_path : str, 保存的 csv 文件
+    key : str, 去重的列
+    keep : str, "first" 保留最早出现的行, "last" 保留最后出现的行(最新的爬取放在 path_list 后面)
+    memory_budget : int, 一个分区最多占用的内存(字节)
+    chunksize : int, 分块读取的行数
+    """
     if not isinstance(path_list, list):
         path_list = [path_list]
+    # 读入 DataFrame 后大约是 csv 文件大小的 4 倍
+    total_bytes = sum(os.path.getsize(path) for path in path_list)
+    partitions = max(1, math.ceil(total_bytes * 4 / memory_budget))
+    logger.info(f"merge {len(path_list)} csv files, {total_bytes} bytes, {partitions} partitions")
 
-    columns = get_column_name(path_list[0])
+    def read_chunks():
+        columns = None
+        for path in path_list:
+            for df in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunksize):
+                if columns is None:
+                    columns = list(df.columns)
+                yield df.reindex(columns=columns, fill_value="")
+
+    def write_unique(df, fd, offset):
+        df = df.drop_duplicates(subset=[key], keep=keep)
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        df.to_csv(fd, header=offset == 0)
+        return offset + len(df)
+
+    with open(save_path, "w", encoding="utf-8", newline="") as fd:
+        if partitions == 1:
+            frames = list(read_chunks())
+            if frames:
+                write_unique(pd.concat(frames, ignore_index=True), fd, 0)
+            logger.success(f"合并成功，保存到{save_path}")
+            return
+        with tempfile.TemporaryDirectory() as dirname:
+            part_paths = [os.path.join(dirname, f"part-{index}.csv") for index in range(partitions)]
+            part_fds = [open(path, "w", encoding="utf-8", newline="") for path in part_paths]
+            try:
+                for df in read_chunks():
+                    parts = pd.util.hash_pandas_object(df[key], index=False) % partitions
+                    for part, group in df.groupby(parts.values):
+                        group.to_csv(part_fds[part], header=part_fds[part].tell() == 0, index=False)
+            finally:
+                for part_fd in part_fds:
+                    part_fd.close()
+            offset = 0
+            for path in part_paths:
+                if os.path.getsize(path):
+                    offset = write_unique(pd.read_csv(path, dtype=str, keep_default_na=False), fd, offset)
+    logger.success(f"合并成功，保存到{save_path}")
+
+
+def merge_multiple_file(path_list, save_path, columns=None, batch_size=CONVERT_CHUNK_SIZE):
+    """ 合并多个txt文件 并保存为csv文件
+
+    每个文件按 batch_size 行读取, 对齐到统一的列后整批写入. 和原来一样追加到 save_path,
+    save_path 不存在时先写表头, 已经存在时沿用它的表头, 追加的行和已有的行列对齐.
+
+    Parameters
+    ----------
+    path_list : list, json 文件列表
+    save_path : str, 保存的 csv 文件
+    columns : list, 输出的列, 默认为 save_path 的表头, 没有表头时合并所有文件所有记录的列;
+              记录中多余的列忽略, 缺少的列为空
+    batch_size : int, 每批的行数
+    """
+    if not isinstance(path_list, list):
+        path_list = [path_list]
+
+    exists = os.path.exists(save_path) and os.path.getsize(save_path) > 0
+    if exists and not columns:
+        columns = list(pd.read_csv(save_path, nrows=0).columns)
+    columns = columns or get_unified_columns(path_list)
     if not columns:
         return
 
-    for path in path_list:
-        with open(path, "r") as f:
-            for idx, line in enumerate(f):
-                try:
-                    _dict = json.loads(line)
-                    if isinstance(_dict, dict):
-                        save_dict_to_csv(_dict, save_path, columns)
-                except Exception as err:
-                    logger.error(f"{path}, {idx}, {err}, {line}")
-
-
-def custom_format(path, typ, save_file_type="csv"):
-    """ 转换文件成csv"""
+    total = 0
+    with open(save_path, "a", encoding="utf-8", newline="") as fd:
+        # 不经过 DataFrame, 有缺失值的整数列不会变成 1.0 这样的浮点数
+        writer = csv.DictWriter(fd, columns, extrasaction="ignore", lineterminator="\n")
+        if not exists:
+            writer.writeheader()
+        for path in path_list:
+            for chunk in iter_chunks(iter_records(path), batch_size):
+                writer.writerows(chunk)
+                total += len(chunk)
+            logger.info(f"merged {path}, total {total}")
+    logger.success(f"合并 {len(path_list)} 个文件，{total} 行，保存到{save_path}")
+
+
+def custom_format(path, typ, save_file_type="csv", chunksize=0, key=None, normalize=False):
+    """ 转换文件成csv
+
+    chunksize 为 0 时整个文件读入内存, 按整行去重(原来的行为); 大于 0 时分块转换, 内存占用和文件大小无关,
+    但是改为按 key 去重, excel 保存为 xlsx. normalize 时转换房子记录的类型.
+    """
+    # 爬虫的输出还缓存在 sink 里, 先写入文件
+    flush_sinks()
     if save_file_type == "txt":
         return
     if save_file_type == "csv":
         try:
-            convert_json_to_csv(path, typ)
+            convert_json_to_csv(path, typ, chunksize, key, normalize)
         except Exception as err:
             logger.error("convert failed: {}".format(err))
     else:
         try:
-            convert_json_to_excel(path, typ)
+            convert_json_to_excel(path, typ, chunksize, key, normalize)
         except Exception as err:
             logger.error("convert failed: {}".format(err))
-            convert_json_to_csv(path, typ)
+            convert_json_to_csv(path, typ, chunksize, key, normalize)
 
 
 @click.command()
 @click.option("--save_file_type", help="Save File Type", default="csv")
 @click.option("--typ", help="Types of housing", default="chengjiao")
 @click.option("--path", help="Filename")
-def main(path, typ, save_file_type):
-    custom_format(path, typ, save_file_type)
+@click.option("--chunksize", help="Stream the file in chunks of this many rows and dedup by --key (excel as xlsx); "
+                                 "0 loads the whole file and drops duplicate rows", default=0)
+@click.option("--key", help="Dedup column in chunked mode, default 房间代号 or 网址", default=None)
+@click.option("--normalize", help="Convert house prices, areas, counts and dates to typed columns", is_flag=True)
+def main(path, typ, save_file_type, chunksize, key, normalize):
+    """
+    python convert_json_to_excel.py --path bj.txt --typ chengjiao
+    - 文件太大读不进内存时分块转换
+    python convert_json_to_excel.py --path bj_xiaoqu.txt --typ xiaoqu --chunksize 100000 --key 网址
+    python convert_json_to_excel.py --path bj.txt --typ chengjiao --normalize
+    """
+    custom_format(path, typ, save_file_type, chunksize, key, normalize)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 记录爬取进度的 frontier, 保存在 sqlite 文件里, 程序中断后可以从断点继续
+
+@ModifyRecord:
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+PENDING = 0
+IN_FLIGHT = 1
+DONE = 2
+
+
+class Frontier:
+    """ 每个任务(列表页, 详情页)一行, 状态为 PENDING / IN_FLIGHT / DONE
+
+    状态更新先缓存在内存里, 满 batch_size 条或者距离上次写入超过 flush_interval 秒时一次性提交,
+    程序崩溃最多丢失最后一批更新, 这些任务在恢复时会重新抓取. 每次提交前先调用 before_commit
+    (一般是 sinks.flush_sinks), 标记为完成的任务的输出一定已经写入文件.
+    """
+
+    def __init__(self, path, reset=False, batch_size=1000, flush_interval=1.0, before_commit=None):
+        """
+        Parameters
+        ----------
+        path : str, sqlite 文件路径
+        reset : bool, 清空之前的进度重新开始
+        batch_size : int, 缓存多少条更新后提交
+        flush_interval : float, 最长多少秒提交一次
+        before_commit : callable, 提交前调用, 把任务的输出写入磁盘
+        """
+        self.path = path
+        self.before_commit = before_commit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.ops = []
+        self.flushed = time.monotonic()
+        if reset:
+            for name in (path, f"{path}-wal", f"{path}-shm"):
+                if os.path.exists(name):
+                    os.remove(name)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            state INTEGER NOT NULL,
+            updated REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_kind_state ON tasks (kind, state)")
+        # 上次中断时正在抓取的任务重新抓取
+        recovered = self.conn.execute("UPDATE tasks SET state = ? WHERE state = ?", (PENDING, IN_FLIGHT)).rowcount
+        self.conn.commit()
+        if recovered:
+            logger.info(f"frontier {path}: {recovered} in-flight tasks back to pending")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _append(self, sql, params):
+        with self.lock:
+            self.ops.append((sql, params))
+            if len(self.ops) >= self.batch_size or time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """ 提交缓存的更新"""
+        with self.lock:
+            if self.ops:
+                if self.before_commit is not None:
+                    self.before_commit()
+                with self.conn:
+                    sql, batch = None, []
+                    for op_sql, params in self.ops:
+                        if op_sql != sql and batch:
+                            self.conn.executemany(sql, batch)
+                            batch = []
+                        sql = op_sql
+                        batch.append(params)
+                    self.conn.executemany(sql, batch)
+                self.ops = []
+            self.flushed = time.monotonic()
+
+    def add(self, kind, key, payload=None):
+        """ 添加任务, 已经存在的任务保持原来的状态"""
+        self._append("INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?)",
+                     (key, kind, json.dumps(payload, ensure_ascii=False), PENDING, time.time()))
+
+    def add_many(self, kind, items):
+        """ items: [(key, payload), ...]"""
+        for key, payload in items:
+            self.add(kind, key, payload)
+
+    def _set_state(self, key, state):
+        self._append("UPDATE tasks SET state = ?, updated = ? WHERE key = ?", (state, time.time(), key))
+
+    def start(self, key):
+        self._set_state(key, IN_FLIGHT)
+
+    def done(self, key):
+        self._set_state(key, DONE)
+
+    def fail(self, key):
+        """ 抓取失败, 下次恢复时重新抓取"""
+        self._set_state(key, PENDING)
+
+    def keys(self, kind, state=DONE):
+        """ 某种任务在某个状态下的所有 key"""
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute("SELECT key FROM tasks WHERE kind = ? AND state = ?", (kind, state))
+            return {row[0] for row in rows}
+
+    def pending(self, kind):
+        """ 没有完成的任务, [(key, payload), ...], 按添加顺序"""
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute("SELECT key, payload FROM tasks WHERE kind = ? AND state != ? ORDER BY rowid",
+                                     (kind, DONE)).fetchall()
+        return [(key, json.loads(payload)) for key, payload in rows]
+
+    def counts(self):
+        """ {(kind, state): 数量}"""
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute("SELECT kind, state, COUNT(*) FROM tasks GROUP BY kind, state")
+            return {(kind, state): count for kind, state, count in rows}
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
@@ -10,17 +10,36 @@ Created on 2020/7/7 13:31:q
 @ModifyRecord:
 """
 import json
-import time
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from typing import List, Optional
 
 import click
-import js2xml
-import requests
 from loguru import logger
 from lxml import etree
 
-from config import PATTERN
+from async_crawler import run_crawler
+from config import HTTP_CACHE_DIR, HTTP_POOL_SIZE, PARQUET_DIR, PATTERN, RATE_LIMIT
+from frontier import Frontier
+from http_cache import configure_cache
+from parquet_sink import configure_parquet, save_record
+from rate_limit import configure_limiter
+from script_vars import get_page_vars
+from seen_index import SeenIndex
+from sinks import flush_sinks
+from tools import configure_client, get_client, save_json
+from xpath_registry import register
+
+# script 中的变量由 script_vars 提取, 其它字段用预编译的 xpath
+SCRIPT_FIELDS = ("房间代号", "城市", "小区", "lng", "lat")
+HOUSE_XPATHS = register("house", dict(
+    {name: pattern for name, pattern in PATTERN.items() if name not in SCRIPT_FIELDS},
+    script="/html/body/script[11]/text()"))
+LIST_XPATHS = register("house_list", {
+    "district": "/html/body/div[3]/div[1]/dl[2]/dd/div/div/a[position()<=last()]",
+    "county": "/html/body/div[3]/div[1]/dl[2]/dd/div/div[2]/a[position()<=last()]",
+    "total_page": "/html/body/div[5]/div[1]/div[5]/div[2]/div",
+    "house": "/html/body/div[5]/div[1]/ul/li[position()<=last()]/div/div[1]/a",
+})
 
 
 # //*[@id="introduction"]/div[1]/div[1]/div[2]/ul/li[position()<=last()
@@ -61,7 +80,7 @@ class HomeLinkSpider:
         if isinstance(url, etree._Element):
             return url
         if isinstance(url, str):
-            html = requests.get(url).text
+            html = get_client().get(url).text
             return etree.HTML(html)
         raise TypeError(url)
 
@@ -69,31 +88,38 @@ class HomeLinkSpider:
         name, url = elem.text, f"{self.domain}{elem.attrib['href']}"
         return Region(name, url)
 
-    def get_districts(self) -> List[Region]:
+    def get_districts(self, selector=None) -> List[Region]:
         """ 得到区级别
 
+        Parameters
+        ----------
+        selector : etree._Element, 已经下载好的页面, 为空时请求 self.sub_domain
+
         Returns
         -------
         List[SubRegion], [SubRegion(name='浦东', url_suffix='/chengjiao/pudong/'), ...]
         """
         try:
-            selector = self.get_selector(self.sub_domain)
-            pattern = "/html/body/div[3]/div[1]/dl[2]/dd/div/div/a[position()<=last()]"
-            return [self.get_region(elem) for elem in selector.xpath(pattern)]
+            selector = self.get_selector(self.sub_domain if selector is None else selector)
+            return [self.get_region(elem) for elem in LIST_XPATHS["district"](selector)]
         except Exception as err:
             logger.error(err)
 
-    def get_counties(self, region: Optional[Region]) -> List[Region]:
+    def get_counties(self, region: Optional[Region], selector=None) -> List[Region]:
         """ 得到县级别
 
+        Parameters
+        ----------
+        region : Region
+        selector : etree._Element, 已经下载好的页面, 为空时请求 region.url
+
         Returns
         -------
 
         """
         try:
-            selector = self.get_selector(region.url)
-            pattern = "/html/body/div[3]/div[1]/dl[2]/dd/div/div[2]/a[position()<=last()]"
-            return [self.get_region(elem) for elem in selector.xpath(pattern)]
+            selector = self.get_selector(region.url if selector is None else selector)
+            return [self.get_region(elem) for elem in LIST_XPATHS["county"](selector)]
         except Exception as err:
             logger.error(err)
 
@@ -109,9 +135,8 @@ class HomeLinkSpider:
         tuple
         """
         try:
-            pattern = "/html/body/div[5]/div[1]/div[5]/div[2]/div"
             selector = self.get_selector(selector)
-            attrib = json.loads(selector.xpath(pattern)[0].attrib["page-data"])
+            attrib = json.loads(LIST_XPATHS["total_page"](selector)[0].attrib["page-data"])
             return attrib["totalPage"], attrib["curPage"]
         except Exception as err:
             logger.error(err)
@@ -119,9 +144,8 @@ class HomeLinkSpider:
     def get_house_from_current_page(self, selector):
         try:
             selector = self.get_selector(selector)
-            pattern = "/html/body/div[5]/div[1]/ul/li[position()<=last()]/div/div[1]/a"
             house_list = []
-            for house_info in selector.xpath(pattern):
+            for house_info in LIST_XPATHS["house"](selector):
                 # 房间网页地址， 标题，小区名字
                 house_url = house_info.attrib["href"]
                 house_title = house_info.text
@@ -133,59 +157,60 @@ class HomeLinkSpider:
 
     @staticmethod
     def get_lng_lat(script):
-        """ 获得经纬度
+        """ 获得经纬度和页面变量
 
         Parameters
         ----------
-        script
+        script : str, 详情页内嵌的 script
 
         Returns
         -------
-        tuple
+        tuple, (lng, lat, {"houseCode": ..., "city_name": ..., "resblockName": ..., "resblockPosition": ...})
         """
-        script = js2xml.parse(script, encoding='utf-8', debug=False)
-        script = js2xml.pretty_print(script)
-        script_selector = etree.HTML(script)
-        lng, lat = script_selector.xpath(PATTERN["lng"])[0].split(",")
-        return lng, lat, script_selector
+        page_vars = get_page_vars(script)
+        lng, lat = page_vars["resblockPosition"].split(",")
+        return lng, lat, page_vars
 
-    def get_house_all_info(self, house: House):
+    def get_house_all_info(self, house: House, selector=None):
         """ 一个房间的所有信息
 
         Parameters
         ----------
         house : House
+        selector : etree._Element, 已经下载好的详情页, 为空时请求 house.url
 
         Returns
         -------
         dict
         """
         try:
-            selector = self.get_selector(house.url)
-            script = selector.xpath("/html/body/script[11]/text()")[0]
-            lng, lat, script_selector = self.get_lng_lat(script)
-            query = selector.xpath
+            selector = self.get_selector(house.url if selector is None else selector)
+            values = HOUSE_XPATHS.evaluate(selector)
+            lng, lat, page_vars = self.get_lng_lat(values["script"][0])
+
+            def query(item_name):
+                return values[item_name]
 
             def query_modify(item_name):
                 try:
-                    return query(PATTERN[item_name])[0].strip()
+                    return values[item_name][0].strip()
                 except Exception as e:
                     logger.info("没有此项{}, 错误原因{}, 继续爬取".format(item_name, e))
                     return None
 
             item = {
-                "房间代号": script_selector.xpath(PATTERN["房间代号"])[0],
-                "城市": script_selector.xpath(PATTERN["城市"])[0],
+                "房间代号": page_vars["houseCode"],
+                "城市": page_vars["city_name"],
                 "区": house.district,
                 "县": house.county,
-                "小区": script_selector.xpath(PATTERN["小区"])[0],
+                "小区": page_vars["resblockName"],
                 "lng": lng,
                 "lat": lat,
-                "单价": query(PATTERN["单价"])[0],
-                "成交价格": query(PATTERN["成交价格"])[0],
-                "挂牌价格": query(PATTERN["挂牌价格"])[0],
+                "单价": query("单价")[0],
+                "成交价格": query("成交价格")[0],
+                "挂牌价格": query("挂牌价格")[0],
                 "挂牌时间": query_modify("挂牌时间"),
-                "成交时间": query(PATTERN["成交时间"])[0].split(" ")[0],
+                "成交时间": query("成交时间")[0].split(" ")[0],
                 "房屋户型": query_modify("房屋户型"),
                 "房屋朝向": query_modify("房屋朝向"),
                 "所在楼层": query_modify("所在楼层"),
@@ -213,54 +238,79 @@ class HomeLinkSpider:
             # logger.info(err)
             logger.exception(err)
 
-    @staticmethod
-    def save_json(mapping, save_path):
-        """ 保存成json"""
-        if not isinstance(mapping, str):
-            mapping = json.dumps(mapping)
-        with open(save_path, "a+") as fd:
-            fd.write(mapping + "\n")
+    def get_frontier_path(self):
+        return f"{self.city_abbreviation}_frontier.db"
 
-    @staticmethod
-    def bulk_save_json(records, save_path):
-        with open(save_path, "a+") as fd:
-            for record in records:
-                record = json.dumps(record)
-                fd.write(record + "\n")
+    def get_seen_path(self):
+        return f"{self.city_abbreviation}_crawl_seen.db"
 
-    def start_crawler(self):
-        logger.info("Start crawler")
-        districts = self.get_districts()
-        if not districts:
-            logger.error("没有区级区域", districts)
+    def save_house_info(self, house_info):
+        """ 保存到 {city_abbreviation}.txt, 设置了 parquet 目录时同时写入 parquet"""
+        save_json(house_info, f"{self.city_abbreviation}.txt")
+        save_record("house", house_info)
+
+    def crawl_house(self, house: House, frontier: Frontier):
+        """ 抓取并保存一个房子, 用 frontier 记录状态"""
+        frontier.start(house.url)
+        house_info = self.get_house_all_info(house)
+        if not house_info:
+            frontier.fail(house.url)
             return
-        for district in districts:
-            counties = self.get_counties(district)
-            print(counties)
-            if not counties:
-                logger.error(f"{district} 没有县级区域")
-                continue
-            for county in counties:
-                total_page = self.get_total_page(county.url)
-                if not total_page:
+        self.save_house_info(house_info)
+        logger.info(house_info)
+        frontier.done(house.url)
+
+    def start_crawler(self, resume=False):
+        """
+        Parameters
+        ----------
+        resume : bool, 从上次中断的地方继续, 否则清空之前的进度重新爬
+        """
+        logger.info("Start crawler")
+        # 同一个房子会出现在多个县下面, 用 seen 去重, seen 和 frontier 一起保留或者一起清空
+        with SeenIndex(self.get_seen_path(), reset=not resume) as seen, \
+                Frontier(self.get_frontier_path(), reset=not resume, before_commit=flush_sinks) as frontier:
+            # 上次中断时还没有抓完的房子
+            for _, house in frontier.pending("house"):
+                self.crawl_house(House(**house), frontier)
+            done_pages = frontier.keys("page")
+            done_houses = frontier.keys("house")
+
+            districts = self.get_districts()
+            if not districts:
+                logger.error("没有区级区域", districts)
+                return
+            for district in districts:
+                counties = self.get_counties(district)
+                print(counties)
+                if not counties:
+                    logger.error(f"{district} 没有县级区域")
                     continue
-                total_page = total_page[0]
-                for i in range(1, total_page):
-                    page_url = f"{county.url}pg{i}"
-                    house_list = self.get_house_from_current_page(page_url)
-                    if not house_list:
-                        logger.error(f"{page_url}：该页面没有房子")
+                for county in counties:
+                    total_page = self.get_total_page(county.url)
+                    if not total_page:
                         continue
-                    for house in house_list:
-                        house.district = district.name
-                        house.county = county.name
-                        house_info = self.get_house_all_info(house)
-                        if not house_info:
+                    total_page = total_page[0]
+                    page_urls = [f"{county.url}pg{i}" for i in range(1, total_page)]
+                    frontier.add_many("page", [(page_url, {"district": district.name, "county": county.name})
+                                               for page_url in page_urls])
+                    for page_url in page_urls:
+                        if page_url in done_pages:
                             continue
-                        self.save_json(
-                            house_info, f"{self.city_abbreviation}.txt")
-                        logger.info(house_info)
-                        time.sleep(4)
+                        house_list = self.get_house_from_current_page(page_url)
+                        if not house_list:
+                            logger.error(f"{page_url}：该页面没有房子")
+                            continue
+                        for house in house_list:
+                            house.district = district.name
+                            house.county = county.name
+                            frontier.add("house", house.url, asdict(house))
+                        # 先提交 frontier 再写 seen, seen 里的房子一定在 frontier 里, 中断后从 pending 继续抓
+                        frontier.flush()
+                        for house in house_list:
+                            if house.url not in done_houses and seen.add(house.url):
+                                self.crawl_house(house, frontier)
+                        frontier.done(page_url)
         logger.info("Finished all")
 
     def start_crawler_counties(self, districts_list, counties_list):
@@ -300,17 +350,57 @@ class HomeLinkSpider:
                         house_info = self.get_house_all_info(house)
                         if not house_info:
                             continue
-                        self.save_json(house_info, f"{self.city_abbreviation}.txt")
+                        self.save_house_info(house_info)
                         print(house_info)
-                        time.sleep(2)
 
         logger.info("Finished all")
 
+    def start_crawler_async(self, concurrency=16, per_host=4, districts_list=None, counties_list=None, parse_workers=0):
+        """ asyncio 并发抓取, 用并发数限制代替 time.sleep
+
+        Parameters
+        ----------
+        concurrency : int, 同时抓取详情页的 worker 数
+        per_host : int, 同一个 host 的最大并发请求数
+        districts_list : list, 需要爬的区列表, 为空时爬全部
+        counties_list : list, 需要爬的县列表, 为空时爬全部
+        parse_workers : int, 解析详情页的进程数, 0 时在下载线程里解析
+        """
+        # 没有保存进度, 每次都是新的一轮, 索引只在本次运行内使用, 放在内存里, 不影响同一个城市的其它进程
+        with SeenIndex(":memory:") as seen:
+            run_crawler(self, concurrency, per_host, districts_list, counties_list,
+                        accept_house=lambda house: seen.add(house.url), parse_workers=parse_workers)
+
 
 @click.command()
 @click.option("--city_abbreviation", help="A brief spelling of Chinese city names", default="bd")
-def main(city_abbreviation):
-    HomeLinkSpider(city_abbreviation).start_crawler()
+@click.option("--mode", help="sync or async", default="sync", type=click.Choice(["sync", "async"]))
+@click.option("--concurrency", help="Number of concurrent detail workers in async mode", default=16)
+@click.option("--per_host", help="Max concurrent requests per host in async mode", default=4)
+@click.option("--parse_workers", help="Number of parser processes in async mode, 0 to parse in the event loop",
+              default=0)
+@click.option("--rate", help="Target requests per second for each domain", default=RATE_LIMIT)
+@click.option("--pool_size", help="HTTP connections kept per host by the shared client", default=HTTP_POOL_SIZE)
+@click.option("--cache_dir", help="HTTP response cache dirname, empty to disable", default=HTTP_CACHE_DIR)
+@click.option("--parquet_dir", help="Also write typed, partitioned parquet files to this dirname", default=PARQUET_DIR)
+@click.option("--resume", help="Resume from the last interrupted crawl (sync mode)", is_flag=True)
+def main(city_abbreviation, mode, concurrency, per_host, parse_workers, rate, pool_size, cache_dir, parquet_dir,
+         resume):
+    """
+    python home_link.py --city_abbreviation bj
+    python home_link.py --city_abbreviation bj --resume
+    python home_link.py --city_abbreviation bj --mode async --concurrency 16 --per_host 4 --rate 2
+    python home_link.py --city_abbreviation bj --mode async --concurrency 64 --parse_workers 4
+    """
+    configure_limiter(rate)
+    configure_client(pool_size)
+    configure_cache(cache_dir)
+    configure_parquet(parquet_dir)
+    spider = HomeLinkSpider(city_abbreviation)
+    if mode == "async":
+        spider.start_crawler_async(concurrency, per_host, parse_workers=parse_workers)
+    else:
+        spider.start_crawler(resume)
 
 
 if __name__ == '__main__':
@@ -1,13 +1,22 @@
 import json
-import time
+import os
 from dataclasses import asdict
 
 import click
 import redis
 from loguru import logger
 
+from async_crawler import run_crawler, run_houses
+from config import (DISCOVERY_WORKERS, HTTP_CACHE_DIR, HTTP_POOL_SIZE, PARQUET_DIR, RATE_LIMIT, WORK_QUEUE_BATCH_SIZE,
+                    WORK_QUEUE_MAX_RETRIES, WORK_QUEUE_VISIBILITY_TIMEOUT)
 from convert_json_to_excel import custom_format
 from home_link import HomeLinkSpider, House
+from http_cache import configure_cache
+from parquet_sink import configure_parquet
+from rate_limit import configure_limiter
+from seen_index import SeenIndex
+from tools import configure_client, save_json, thread_map
+from work_queue import RedisProducer, RedisWorkQueue, SqliteWorkQueue
 
 RedisHost = "139.198.190.139"
 RedisPort = 6379
@@ -16,55 +25,87 @@ RedisDB = 0
 
 
 class HomeLinkSpiderV1(HomeLinkSpider):
-    def __init__(self, city_abbreviation="km", use_redis=False):
+    def __init__(self, city_abbreviation="km", use_redis=False, seen_path=None, discovery_workers=DISCOVERY_WORKERS,
+                 resume=False):
+        """
+        seen_path: 已发现房子的索引文件, 默认 {city_abbreviation}_url_list_seen.db
+        discovery_workers: 并发请求县, 页数和列表页的线程数
+        resume: 跳过之前运行或者同时运行的其它进程已经发现的房子, 只处理新发现的房子,
+                否则清空索引重新发现全部房子, 同一个城市的其它发现进程要设置 resume
+        """
         self.url_list = []
-        self.url_set = set()
         super(HomeLinkSpiderV1, self).__init__(city_abbreviation)
+        self.seen_path = seen_path or f"{city_abbreviation}_url_list_seen.db"
+        self.resume = resume
+        self._url_set = None
         # self.city_abbreviation = city_abbreviation
         self.use_redis = use_redis
         self.redis_client = None
+        self.redis_producer = None
+        self.discovery_workers = discovery_workers
+
+    @property
+    def url_set(self):
+        """ 第一次发现房子时才打开索引, 只从文件或者队列抓详情的进程不会打开索引
+
+        resume 时打开已有的索引, 和同一个城市正在发现房子的其它进程共享, 否则清空索引开始新的一轮发现.
+        索引是空的(之前的运行没有索引文件)时用已经写入 url 文件的房子初始化.
+        """
+        if self._url_set is None:
+            self._url_set = SeenIndex(self.seen_path, reset=not self.resume)
+            if self.resume and not len(self._url_set) and os.path.exists(self.get_url_list_path()):
+                self._url_set.add_many(house["url"] for house in self.read_house_file(self.get_url_list_path()))
+        return self._url_set
 
     def get_url_list(self, district_name_list=None):
+        """ 发现所有房子: 先并发获取所有区的县, 再并发获取每个县的页数, 最后并发抓取所有列表页"""
         logger.info("start getting url")
         districts = self.get_districts()
 
         if not districts:
             logger.error("没有区级区域", districts)
             return
-        for district in districts:
-            if district.name not in district_name_list:
+        districts = [district for district in districts
+                     if not district_name_list or district.name in district_name_list]
+        workers = self.discovery_workers
+        counties = []
+        for district, district_counties in zip(districts, thread_map(self.get_counties, districts, workers)):
+            if not district_counties:
+                logger.error(f"{district} 没有县级区域")
+                continue
+            counties += [(district, county) for county in district_counties]
+        logger.info(f"{len(districts)} districts, {len(counties)} counties")
+
+        pages = []
+        total_pages = thread_map(lambda item: self.get_total_page(item[1].url), counties, workers)
+        for (district, county), total_page in zip(counties, total_pages):
+            if not total_page:
                 continue
-            try:
-                counties = self.get_counties(district)
-                if not counties:
-                    logger.error(f"{district} 没有县级区域")
-                    continue
-                for county in counties:
-                    total_page = self.get_total_page(county.url)
-                    if not total_page:
-                        continue
-                    total_page = total_page[0]
-                    for i in range(1, total_page):
-                        page_url = f"{county.url}pg{i}"
-                        house_list = self.get_house_from_current_page(page_url)
-                        if not house_list:
-                            logger.error(f"{page_url}：该页面没有房子")
-                            continue
-                        for house in house_list:
-                            if house.url in self.url_set:
-                                continue
-                            house.district = district.name
-                            house.county = county.name
-                            logger.info(house)
-                            self.url_set.add(house.url)
-                            self.url_list.append(house)
-                            self.save_house_json(house)
-                            if self.use_redis:
-                                self.save_house_redis(house)
-                        time.sleep(4)
-            except Exception as err:
-                logger.exception(f"district: {err}")
+            pages += [(district, county, f"{county.url}pg{i}") for i in range(1, total_page[0])]
+        logger.info(f"{len(pages)} listing pages")
+
+        # 结果按页面顺序在当前线程里去重和保存
+        house_lists = thread_map(lambda item: self.get_house_from_current_page(item[2]), pages, workers)
+        for (district, county, page_url), house_list in zip(pages, house_lists):
+            if not house_list:
+                logger.error(f"{page_url}：该页面没有房子")
                 continue
+            for house in house_list:
+                house.district = district.name
+                house.county = county.name
+                self.record_house(house)
+        self.flush_redis()
+
+    def record_house(self, house: House):
+        """ 去重并保存新发现的房子, 返回是否为新房子"""
+        if not self.url_set.add(house.url):
+            return False
+        logger.info(house)
+        self.url_list.append(house)
+        self.save_house_json(house)
+        if self.use_redis:
+            self.save_house_redis(house)
+        return True
 
     def get_url_list_path(self):
         try:
@@ -77,32 +118,55 @@ class HomeLinkSpiderV1(HomeLinkSpider):
         if isinstance(house, House):
             house = asdict(house)
         if isinstance(house, dict):
-            self.save_json(house, self.get_url_list_path())
+            save_json(house, self.get_url_list_path())
             logger.success(f"store house to file: {house}")
 
-    def save_house_redis(self, house):
-
+    def get_redis_client(self):
         if self.redis_client is None:
             self.redis_client = redis.Redis(host=RedisHost,
                                             password=RedisPassword,
                                             port=RedisPort,
                                             db=RedisDB)
+        return self.redis_client
 
-        if not hasattr(self.redis_client, "ping"):
-            return
-
-        if not self.redis_client.ping():
-            return
+    def get_redis_producer(self):
+        if self.redis_producer is None:
+            self.redis_producer = RedisProducer(self.get_redis_client(), self.city_abbreviation)
+        return self.redis_producer
 
+    def save_house_redis(self, house):
+        """ 放入批量推送的缓存, 按 url 在 redis 中去重"""
         if isinstance(house, House):
             house = asdict(house)
         try:
-            self.redis_client.lpush(self.city_abbreviation, json.dumps(house))
-            logger.success(f"store house to redis: {house}")
+            self.get_redis_producer().add(json.dumps(house), key=house["url"])
         except Exception as err:
-            logger.error(f"failed to push redis: {house}, err: {err}")
+            logger.error(f"failed to push redis, {self.redis_producer.buffered} houses kept for retry, err: {err}")
+
+    def flush_redis(self):
+        """ 推送缓存中剩下的房子"""
+        if self.redis_producer is None:
+            return
+        try:
+            self.redis_producer.flush()
+        except Exception as err:
+            logger.error(f"failed to push redis, {self.redis_producer.buffered} houses not pushed, err: {err}")
+        logger.info(f"redis {self.city_abbreviation}: {self.redis_producer.pushed} houses pushed, "
+                    f"{self.redis_producer.duplicated} duplicated")
 
     def _start_crawler_house(self, house):
+        house = self.to_house(house)
+        if not isinstance(house, House):
+            return
+
+        house_info = self.get_house_all_info(house)
+        if not house_info:
+            return
+        self.save_house_info(house_info)
+        logger.success(house_info)
+
+    @staticmethod
+    def to_house(house):
         if isinstance(house, dict):
             house = House(url=house.get("url", None),
                           title=house.get("title", None),
@@ -110,21 +174,13 @@ class HomeLinkSpiderV1(HomeLinkSpider):
                           district=house.get("district", ""),
                           county=house.get("county", "")
                           )
-
-        if not isinstance(house, House):
-            return
-
-        house_info = self.get_house_all_info(house)
-        self.save_json(house_info, f"{self.city_abbreviation}.txt")
-        logger.success(house_info)
+        return house
 
     def start_crawler_house(self, house):
         try:
             self._start_crawler_house(house)
         except Exception as err:
             logger.error(f"start_crawler err: {err}")
-        finally:
-            time.sleep(4)
 
     def start_crawler(self):
         self.get_url_list()
@@ -148,18 +204,64 @@ class HomeLinkSpiderV1(HomeLinkSpider):
         logger.info("save to csv file...")
         custom_format(path=f"{self.city_abbreviation}.txt", typ="ershoufang", save_file_type="csv")
 
-    def start_crawler_from_redis(self):
-        pool = redis.Redis(host=RedisHost, password=RedisPassword, port=RedisPort, db=RedisDB)
-        if not pool.ping():
-            logger.error("redis disconnect")
-            return
+    def start_crawler_async(self, district_name_list=None, concurrency=16, per_host=4, parse_workers=0):
+        """ asyncio 并发抓取列表页和详情页, 发现的房子边去重边抓详情"""
+        if isinstance(district_name_list, str):
+            district_name_list = [district_name_list]
+        run_crawler(self, concurrency, per_host, district_name_list, accept_house=self.record_house,
+                    parse_workers=parse_workers)
+        self.flush_redis()
+        logger.info(f"self.url_list: {len(self.url_list)}")
+        logger.info("save to csv file...")
+        custom_format(path=f"{self.city_abbreviation}.txt", typ="ershoufang", save_file_type="csv")
 
-        while True:
-            body = pool.brpop(self.city_abbreviation)
-            house = json.loads(body)
-            self._start_crawler_house(house)
+    def crawl_queue_item(self, item):
+        """ 抓取队列中的一个房子, 失败时抛出异常, 由队列重试"""
+        house = self.to_house(json.loads(item))
+        house_info = self.get_house_all_info(house)
+        if not house_info:
+            raise ValueError(f"failed to crawl {house.url}")
+        self.save_house_info(house_info)
+        logger.success(house_info)
 
-    def start_crawler_from_file(self, filename, start=0, end=0):
+    def start_crawler_from_redis(self, batch_size=WORK_QUEUE_BATCH_SIZE,
+                                 visibility_timeout=WORK_QUEUE_VISIBILITY_TIMEOUT, max_retries=WORK_QUEUE_MAX_RETRIES,
+                                 exit_when_empty=False):
+        """ 从 redis 队列 {city_abbreviation} 取房子抓取, 多台机器的多个进程可以同时运行
+
+        batch_size: 每次预取的房子数
+        visibility_timeout: 取出后多少秒没有完成(进程挂了)重新入队
+        max_retries: 失败多少次后放入 {city_abbreviation}:dead
+        exit_when_empty: 队列处理完后退出并转换成 csv, 否则一直等待新的房子
+        """
+        queue = RedisWorkQueue(self.get_redis_client(), self.city_abbreviation, visibility_timeout=visibility_timeout,
+                               max_retries=max_retries)
+        self.start_crawler_from_queue(queue, batch_size, exit_when_empty)
+
+    def start_crawler_from_sqlite(self, queue_path="", filename="", batch_size=WORK_QUEUE_BATCH_SIZE,
+                                  visibility_timeout=WORK_QUEUE_VISIBILITY_TIMEOUT, max_retries=WORK_QUEUE_MAX_RETRIES,
+                                  exit_when_empty=False):
+        """ 同一台机器上的多个进程共享一个 sqlite 队列, 参数同 start_crawler_from_redis, 默认也一直等待新的房子
+
+        queue_path: 队列文件, 默认 {city_abbreviation}_queue.db
+        filename: 先把 json 行文件里的房子放入队列, 已经在队列里(包括已经完成)的房子忽略, 每个进程都可以传同一个文件
+        """
+        queue = SqliteWorkQueue(queue_path or f"{self.city_abbreviation}_queue.db", self.city_abbreviation,
+                                visibility_timeout=visibility_timeout, max_retries=max_retries)
+        if filename:
+            queue.put(json.dumps(house) for house in self.read_house_file(filename))
+        self.start_crawler_from_queue(queue, batch_size, exit_when_empty)
+        queue.close()
+
+    def start_crawler_from_queue(self, queue, batch_size=WORK_QUEUE_BATCH_SIZE, exit_when_empty=False):
+        """ 从任务队列(work_queue.WorkQueue)取房子抓取"""
+        logger.info(f"queue {self.city_abbreviation}: {queue.stats()}")
+        queue.consume(self.crawl_queue_item, batch_size, exit_when_empty=exit_when_empty)
+        logger.info("save to csv file...")
+        custom_format(path=f"{self.city_abbreviation}.txt", typ="ershoufang", save_file_type="csv")
+
+    @staticmethod
+    def read_house_file(filename, start=0, end=0):
         """
         start: 开始行数
         end: 结束行数
@@ -169,23 +271,57 @@ class HomeLinkSpiderV1(HomeLinkSpider):
         with open(filename, "r") as f:
             for idx, line in enumerate(f):
                 if start <= idx <= end:
-                    house = json.loads(line)
-                    self.start_crawler_house(house)
+                    yield json.loads(line)
+
+    def start_crawler_from_file(self, filename, start=0, end=0, mode="sync", concurrency=16, per_host=4,
+                                parse_workers=0):
+        """
+        start: 开始行数
+        end: 结束行数
+        mode: sync 逐个抓取, async 并发抓取
+        """
+        houses = self.read_house_file(filename, start, end)
+        if mode == "async":
+            run_houses(self, [self.to_house(house) for house in houses], concurrency, per_host,
+                       parse_workers=parse_workers)
+        else:
+            for house in houses:
+                self.start_crawler_house(house)
         logger.info("save to csv file...")
         custom_format(path=f"{self.city_abbreviation}.txt", typ="ershoufang", save_file_type="csv")
 
 
-def crawler_home_link(city_abbreviation, source, file, start, end):
+def crawler_home_link(city_abbreviation, source, file, start, end, mode="sync", concurrency=16, per_host=4,
+                      parse_workers=0, batch_size=WORK_QUEUE_BATCH_SIZE,
+                      visibility_timeout=WORK_QUEUE_VISIBILITY_TIMEOUT, max_retries=WORK_QUEUE_MAX_RETRIES,
+                      exit_when_empty=False, push_redis=False, discover_only=False, queue_path="",
+                      discovery_workers=DISCOVERY_WORKERS, resume=False):
     if source == "":
-        HomeLinkSpiderV1(city_abbreviation, use_redis=False).start_crawler()
+        spider = HomeLinkSpiderV1(city_abbreviation, use_redis=push_redis, discovery_workers=discovery_workers,
+                                  resume=resume)
+        if discover_only:
+            spider.get_url_list()
+            logger.info(f"discovered {len(spider.url_list)} houses")
+            return
+        if mode == "async":
+            spider.start_crawler_async(concurrency=concurrency, per_host=per_host, parse_workers=parse_workers)
+        else:
+            spider.start_crawler()
         return
 
     if source == "file":
-        HomeLinkSpiderV1(city_abbreviation).start_crawler_from_file(file, start, end)
+        HomeLinkSpiderV1(city_abbreviation).start_crawler_from_file(file, start, end, mode, concurrency, per_host,
+                                                                   parse_workers)
         return
 
     if source == "redis":
-        HomeLinkSpiderV1(city_abbreviation).start_crawler_from_redis()
+        HomeLinkSpiderV1(city_abbreviation).start_crawler_from_redis(batch_size, visibility_timeout, max_retries,
+                                                                     exit_when_empty)
+        return
+
+    if source == "sqlite":
+        HomeLinkSpiderV1(city_abbreviation).start_crawler_from_sqlite(queue_path, file, batch_size, visibility_timeout,
+                                                                      max_retries, exit_when_empty)
 
 
 @click.command()
@@ -194,12 +330,53 @@ def crawler_home_link(city_abbreviation, source, file, start, end):
 @click.option("--file", help="A brief spelling of Chinese city names", default="cd.json")
 @click.option("--start", help="A brief spelling of Chinese city names", default=0)
 @click.option("--end", help="A brief spelling of Chinese city names", default=0)
-def main(city_abbreviation, source, file, start, end):
+@click.option("--mode", help="sync or async", default="sync", type=click.Choice(["sync", "async"]))
+@click.option("--concurrency", help="Number of concurrent detail workers in async mode", default=16)
+@click.option("--per_host", help="Max concurrent requests per host in async mode", default=4)
+@click.option("--parse_workers", help="Number of parser processes in async mode, 0 to parse in the event loop",
+              default=0)
+@click.option("--batch_size", help="Houses prefetched per claim from the redis queue", default=WORK_QUEUE_BATCH_SIZE)
+@click.option("--visibility_timeout", help="Seconds before an unacknowledged redis task is requeued",
+              default=WORK_QUEUE_VISIBILITY_TIMEOUT)
+@click.option("--max_retries", help="Failures before a redis task moves to the dead-letter list",
+              default=WORK_QUEUE_MAX_RETRIES)
+@click.option("--exit_when_empty", help="Stop the redis or sqlite worker once the queue is drained, otherwise keep "
+                                      "waiting for new houses", is_flag=True)
+@click.option("--queue_path", help="SQLite queue file for --source sqlite, default {city_abbreviation}_queue.db",
+              default="")
+@click.option("--push_redis", help="Push discovered houses to the redis queue for detail workers", is_flag=True)
+@click.option("--discover_only", help="Only walk the listing pages, do not crawl details", is_flag=True)
+@click.option("--discovery_workers", help="Threads fetching counties, page counts and listing pages",
+              default=DISCOVERY_WORKERS)
+@click.option("--resume", help="Keep the shared seen-house index of earlier or concurrent runs and only handle newly "
+                                "listed houses; set it on every worker joining a running discovery",
+              is_flag=True)
+@click.option("--rate", help="Target requests per second for each domain", default=RATE_LIMIT)
+@click.option("--pool_size", help="HTTP connections kept per host by the shared client", default=HTTP_POOL_SIZE)
+@click.option("--cache_dir", help="HTTP response cache dirname, empty to disable", default=HTTP_CACHE_DIR)
+@click.option("--parquet_dir", help="Also write typed, partitioned parquet files to this dirname", default=PARQUET_DIR)
+def main(city_abbreviation, source, file, start, end, mode, concurrency, per_host, parse_workers, batch_size,
+         visibility_timeout, max_retries, exit_when_empty, queue_path, push_redis, discover_only, discovery_workers,
+         resume, rate, pool_size, cache_dir, parquet_dir):
     """
     python home_link_v1.py --city_abbreviation gz
-    python home_link_v1.py --city_abbreviation gz --source file --file gz_url_list.json --start 60000
+    python home_link_v1.py --city_abbreviation gz --mode async --concurrency 16
+    python home_link_v1.py --city_abbreviation gz --mode async --concurrency 64 --parse_workers 4
+    python home_link_v1.py --city_abbreviation gz --source file --file gz_url_list.json --start 60000 --rate 2
+    python home_link_v1.py --city_abbreviation gz --source redis --batch_size 20 --exit_when_empty
+    python home_link_v1.py --city_abbreviation gz --push_redis --discover_only
+    - 再次发现时只推送新上架的房子
+    python home_link_v1.py --city_abbreviation gz --push_redis --discover_only --resume
+    - 没有 redis 时, 同一台机器上的多个进程共享 sqlite 队列, 每个进程运行同样的命令
+    python home_link_v1.py --city_abbreviation gz --source sqlite --file gz_url_list.json --exit_when_empty
     """
-    crawler_home_link(city_abbreviation, source, file, start, end)
+    configure_limiter(rate)
+    configure_client(pool_size)
+    configure_cache(cache_dir)
+    configure_parquet(parquet_dir)
+    crawler_home_link(city_abbreviation, source, file, start, end, mode, concurrency, per_host, parse_workers,
+                      batch_size, visibility_timeout, max_retries, exit_when_empty, push_redis, discover_only,
+                      queue_path, discovery_workers, resume)
 
 
 if __name__ == '__main__':
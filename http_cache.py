@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 本地 HTTP 响应缓存, 按 url 类别设置过期时间, 重跑时跳过区域/页数等发现阶段的请求
+
+@ModifyRecord:
+"""
+import atexit
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from loguru import logger
+
+from config import HTTP_CACHE_DIR, HTTP_CACHE_MAX_BYTES
+
+DAY = 24 * 3600
+HOUR = 3600
+
+# (正则, 过期秒数), 按顺序匹配第一个; None 表示永不过期, 0 表示不缓存
+TTL_RULES = [
+    (r"lianjia\.com/(chengjiao|ershoufang)/\d+\.html", None),  # 房子详情页
+    (r"lianjia\.com/xiaoqu/\d+/?$", None),  # 小区详情页
+    (r"lianjia\.com/.*/pg\d+/?$", 6 * HOUR),  # 列表页
+    (r"lianjia\.com/(chengjiao|ershoufang|xiaoqu)/[a-z0-9]+/?$", 6 * HOUR),  # 区和县的第一页也是列表页, 还提供总页数
+    (r"lianjia\.com/", 3 * DAY),  # 城市首页等其它页面
+    (r"aqistudy\.cn/historydata/daydata\.php(\?city=[^&]*)?$", 3 * DAY),  # 城市列表, 城市有数据的月份
+]
+# 验证码, 人机认证等反爬页面, 状态码也是 200, 不能当作正常页面缓存
+BLOCKED_PAGE_PATTERN = re.compile("hip\\.lianjia\\.com/captcha|人机认证|人机验证".encode("utf-8"))
+
+
+class ResponseCache:
+    """ 压缩后按内容 sha1 保存在磁盘上, sqlite 记录 url -> 内容的索引, 超过 max_bytes 时按 LRU 淘汰"""
+
+    def __init__(self, dirname=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES, ttl_rules=None):
+        """
+        Parameters
+        ----------
+        dirname : str, 缓存目录
+        max_bytes : int, 缓存文件总大小上限(压缩后)
+        ttl_rules : list, [(正则, 过期秒数), ...], 默认 TTL_RULES
+        """
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.ttl_rules = [(re.compile(pattern), ttl) for pattern, ttl in (ttl_rules or TTL_RULES)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(dirname, "index.db"), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            encoding TEXT,
+            expires REAL,
+            accessed REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_digest ON responses (digest)")
+        self.conn.commit()
+        self.bytes = self.total_bytes()
+
+    def get_ttl(self, url):
+        for pattern, ttl in self.ttl_rules:
+            if pattern.search(url):
+                return ttl
+        return 0
+
+    def blob_path(self, digest):
+        return os.path.join(self.dirname, digest[:2], digest)
+
+    def get(self, url):
+        """ 返回 (content, encoding), 没有缓存或者已经过期时返回 None"""
+        if self.get_ttl(url) == 0:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT digest, encoding, expires FROM responses WHERE url = ?",
+                                    (url,)).fetchone()
+            if row is None or (row[2] is not None and row[2] < now):
+                self.misses += 1
+                return None
+            digest, encoding, _ = row
+            try:
+                with open(self.blob_path(digest), "rb") as fd:
+                    content = zlib.decompress(fd.read())
+            except (OSError, zlib.error) as err:
+                logger.warning(f"broken cache entry {url}: {err}")
+                self.conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self.conn.commit()
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE url = ?", (now, url))
+            self.conn.commit()
+            self.hits += 1
+        return content, encoding
+
+    def put(self, url, content, encoding=None, redirected=False):
+        """ 保存响应内容, 不需要缓存的 url, 被重定向的响应和反爬页面直接忽略
+
+        Parameters
+        ----------
+        redirected : bool, 响应是否经过重定向, 重定向后的内容(登录页, 验证码页)不是 url 本身的内容
+        """
+        ttl = self.get_ttl(url)
+        if ttl == 0:
+            return
+        if redirected or BLOCKED_PAGE_PATTERN.search(content):
+            logger.warning(f"not caching {url}: {'redirected' if redirected else 'blocked page'}")
+            return
+        now = time.time()
+        digest = hashlib.sha1(content).hexdigest()
+        path = self.blob_path(digest)
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as fd:
+                    fd.write(zlib.compress(content))
+                os.replace(tmp_path, path)
+                self.bytes += os.path.getsize(path)
+            old = self.conn.execute("SELECT digest FROM responses WHERE url = ?", (url,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                              (url, digest, os.path.getsize(path), encoding,
+                               None if ttl is None else now + ttl, now))
+            if old and old[0] != digest:
+                self.remove_orphan(old[0])
+            self.conn.commit()
+            if self.bytes > self.max_bytes:
+                self.evict()
+
+    def total_bytes(self):
+        row = self.conn.execute("SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM responses)").fetchone()
+        return row[0] or 0
+
+    def remove_orphan(self, digest):
+        """ 没有 url 引用这个内容时删除文件"""
+        if self.conn.execute("SELECT 1 FROM responses WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+            return
+        path = self.blob_path(digest)
+        try:
+            self.bytes -= os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """ 超过 max_bytes 时删除最久没有访问的记录, 直到降到 max_bytes 的 90%"""
+        # 其它进程也可能写入缓存, 淘汰前重新统计
+        self.bytes = self.total_bytes()
+        target = self.max_bytes * 0.9
+        cursor = self.conn.execute("SELECT url, digest FROM responses ORDER BY accessed")
+        for url, digest in cursor.fetchall():
+            if self.bytes <= target:
+                break
+            self.conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self.evictions += 1
+            self.remove_orphan(digest)
+        self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self.bytes,
+        }
+
+    def close(self):
+        logger.info(f"http cache stats: {self.stats()}")
+        self.conn.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_cache(dirname=HTTP_CACHE_DIR, max_bytes=HTTP_CACHE_MAX_BYTES, ttl_rules=None):
+    """ 重新创建共享的缓存, dirname 为空时关闭缓存"""
+    global _cache
+    with _cache_lock:
+        if _cache:
+            atexit.unregister(_cache.close)
+            _cache.close()
+        _cache = ResponseCache(dirname, max_bytes, ttl_rules) if dirname else False
+        if _cache:
+            atexit.register(_cache.close)
+    return _cache
+
+
+def get_cache():
+    """ 获取共享的缓存, 关闭缓存时返回 False"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache() if HTTP_CACHE_DIR else False
+                if _cache:
+                    atexit.register(_cache.close)
+    return _cache
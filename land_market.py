@@ -1,21 +1,45 @@
-import copy
-import json
+import math
 import os
+import queue
+import re
+import threading
 import time
+from functools import lru_cache
+from io import StringIO
 
 import click
 import pandas as pd
-import requests
 from bs4 import BeautifulSoup
 from lxml import etree
-from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+
+from browser_pool import BrowserPool, create_browser
+from config import BROWSER_MAX_PAGES, HTTP_POOL_SIZE, PARQUET_DIR, RATE_LIMIT
+from parquet_sink import configure_parquet, save_record
+from rate_limit import configure_limiter, get_limiter
+from sinks import close_sink, get_csv_sink, get_sink
+from tools import configure_client, get_client
+from xpath_registry import register
 
 DomainUrl = "https://www.landchina.com"
 
+LAND_XPATHS = register("land", {
+    "href": "//@href",
+    "tables": "//table",
+    "rows": "./tr|./tbody/tr",
+    "cells": "./td|./th",
+})
+
+# 和 pandas.read_html 一样合并空白
+WHITESPACE_PATTERN = re.compile(r"[\r\n]+|\s{2,}")
+
 
 def extract_all_url(tree: etree.HTML, prefix="/DesktopModule/BizframeExtendMdl/workList"):
     url_list = []
-    for link in tree.xpath("//@href"):
+    for link in LAND_XPATHS["href"](tree):
         link_str = str(link)
         if link_str.startswith(prefix):
             link_str = DomainUrl + link_str
@@ -23,37 +47,59 @@ def extract_all_url(tree: etree.HTML, prefix="/DesktopModule/BizframeExtendMdl/w
     return url_list
 
 
+LAND_COLUMNS = ['宗地编号', '宗地总面积', '宗地坐落', '出让年限', '容积率', '建筑密度', '绿化率',
+                '建筑限高', '主要用途', '面积', '投资强度', '保证金', '估价报告备案号',
+                '起始价', '加价幅度', '挂牌开始时间', '挂牌截止时间']
+
+# 字段在表格中的位置 (行, 列), 合并单元格展开之后
+LAND_CELLS = {
+    '宗地编号': (0, 1), '宗地总面积': (0, 3), '宗地坐落': (0, 5),
+    '出让年限': (1, 1), '容积率': (1, 3), '建筑密度': (1, 5),
+    '绿化率': (2, 1), '建筑限高': (2, 3),
+    '主要用途': (4, 0),
+    '面积': (7, 3),
+    '投资强度': (8, 1), '保证金': (8, 3), '估价报告备案号': (8, 5),
+    '起始价': (9, 1), '加价幅度': (9, 3),
+    '挂牌开始时间': (10, 1), '挂牌截止时间': (10, 3),
+}
+# 页面上混淆后的 "宗地编号", "出让年限"
+TABLE_FLAGS = ["宗箹编号", "出让鹽限"]
+
+
 def save_json(mapping, save_path):
     """ 保存成json"""
-    if not isinstance(mapping, str):
-        mapping = json.dumps(mapping)
-    with open(save_path, "a+") as fd:
-        fd.write(mapping + "\n")
+    get_sink(save_path).write(mapping)
 
 
 def save_csv(mapping, save_path):
-    columns = ['宗地编号', '宗地总面积', '宗地坐落', '出让年限', '容积率', '建筑密度', '绿化率',
-               '建筑限高', '主要用途', '面积', '投资强度', '保证金', '估价报告备案号',
-               '起始价', '加价幅度', '挂牌开始时间', '挂牌截止时间']
-    df = pd.DataFrame([mapping])
-    if os.path.exists(save_path):
-        df.to_csv(save_path, mode="a", index=None,
-                  header=False, columns=columns)
-    else:
-        df.to_csv(save_path, mode="a", index=None,
-                  header=True, columns=columns)
+    get_csv_sink(save_path, columns=LAND_COLUMNS).write(mapping)
+
+
+FONT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "font_table.txt")
+
+
+@lru_cache(maxsize=None)
+def load_font_table(path=FONT_TABLE_PATH):
+    """ 读取字体映射表, 每个进程只读一次
+
+    Returns
+    -------
+    dict, str.translate 使用的映射表 {混淆字符的码位: 正确的字符}
+    """
+    table = {}
+    with open(path, encoding="utf-8") as fp:
+        for line in fp:
+            infos = line.split(':')
+            if len(infos) == 2:
+                table[int(infos[0].strip()[2:], 16)] = infos[1].strip()
+    return table
 
 
 class DecodeText:
-    def __init__(self):
-        self.font_map = {}
-        self.load_font_table()
+    """ 还原 landchina 页面上用自定义字体混淆的文字"""
 
-    def load_font_table(self):
-        with open("font_table.txt", encoding="utf-8") as fp:
-            for line in fp:
-                infos = line.split(':')
-                self.font_map[infos[0].strip()[2:]] = infos[1].strip()
+    def __init__(self, path=FONT_TABLE_PATH):
+        self.table = load_font_table(path)
 
     @staticmethod
     def cn_to_unicode(string, need_str=True):
@@ -91,43 +137,118 @@ class DecodeText:
             return string.encode('utf-8').decode('unicode_escape')
 
     def html_trans(self, content):
-        content_new = copy.deepcopy(content)
-        for i in content:
-            str_ = self.cn_to_unicode(i)
-            new_str = self.font_map.get(str_[2:].upper(), '')
-            if new_str:
-                content_new = content_new.replace(i, new_str)
-        return content_new
+        return content.translate(self.table)
 
     def convert(self, string):
-        return self.html_trans(string)
+        """ 还原一个值, 不是字符串时原样返回"""
+        return string.translate(self.table) if isinstance(string, str) else string
+
+    def convert_series(self, series: pd.Series) -> pd.Series:
+        """ 还原一整列"""
+        return series.map(self.convert)
+
+    def convert_frame(self, df: pd.DataFrame, columns=None) -> pd.DataFrame:
+        """ 还原 DataFrame 中的 columns 列, 默认所有列, 返回新的 DataFrame"""
+        df = df.copy()
+        for name in columns or df.columns:
+            df[name] = self.convert_series(df[name])
+        return df
+
+    def convert_records(self, records):
+        """ 还原一批 dict 的所有值"""
+        return [{k: self.convert(v) for k, v in record.items()} for record in records]
+
+
+def cell_text(cell):
+    text = WHITESPACE_PATTERN.sub(" ", "".join(cell.itertext()).strip())
+    return text or None
+
+
+def span(cell, name):
+    try:
+        return max(1, int(cell.get(name, 1)))
+    except ValueError:
+        return 1
+
+
+def table_to_grid(table):
+    """ 把 <table> 展开成二维列表, colspan/rowspan 的单元格复制到覆盖的每个位置, 和 pandas.read_html 相同
+
+    开头全是 <th> 的行是表头, 不在结果里. 空单元格为 None.
+    """
+    rows = LAND_XPATHS["rows"](table)
+    while rows and all(cell.tag == "th" for cell in LAND_XPATHS["cells"](rows[0])):
+        rows = rows[1:]
+    grid = []
+    pending = {}  # 列 -> [文字, 还要向下复制的行数]
+    for tr in rows:
+        row = []
+        cells = iter(LAND_XPATHS["cells"](tr))
+        cell = next(cells, None)
+        while cell is not None or any(col >= len(row) for col in pending):
+            col = len(row)
+            if col in pending:
+                text, left = pending[col]
+                row.append(text)
+                if left == 1:
+                    del pending[col]
+                else:
+                    pending[col][1] = left - 1
+                continue
+            if cell is None:
+                row.append(None)
+                continue
+            text, rowspan = cell_text(cell), span(cell, "rowspan")
+            for _ in range(span(cell, "colspan")):
+                if rowspan > 1:
+                    pending[len(row)] = [text, rowspan - 1]
+                row.append(text)
+            cell = next(cells, None)
+        grid.append(row)
+    return grid
 
 
 class TableParser:
-    def __init__(self, url):
+    def __init__(self, url, html=None):
+        """
+        Parameters
+        ----------
+        url : str, 土地详情页
+        html : str, 已经下载好的页面, 为空时用共享的连接池下载
+        """
         self.url = url
+        self.html = html
         self.decode_text = DecodeText()
 
+    def get_html(self):
+        if self.html is None:
+            self.html = get_client().get(self.url).content.decode("gbk", errors="ignore")
+        return self.html
+
     def by_pandas(self):
-        return pd.read_html(self.url, encoding="gbk")
+        return pd.read_html(StringIO(self.get_html()))
 
     @staticmethod
     def is_valid_table(table: pd.DataFrame):
-        flag = ["宗箹编号", "出让鹽限"]
-        for f in flag:
+        for f in TABLE_FLAGS:
             if f not in table.__str__():
                 return False
         return True
 
     def get_valid_table(self):
-        tables = []
-        for table in self.by_pandas():
-            if self.is_valid_table(table):
-                tables.append(table)
-        return tables
+        """ 用 lxml 解析一次页面, 返回含有 TABLE_FLAGS 的最内层表格展开后的二维列表"""
+        tree = etree.HTML(self.get_html())
+        if tree is None:
+            return []
+        tables = [table for table in LAND_XPATHS["tables"](tree)
+                  if all(f in "".join(table.itertext()) for f in TABLE_FLAGS)]
+        # 外层表格包含了内层表格的文字, 只保留最内层的
+        inner = [table for table in tables
+                 if not any(other is not table and table in other.iterancestors() for other in tables)]
+        return [table_to_grid(table) for table in inner]
 
     def by_bs4(self):
-        req = requests.get(self.url)
+        req = get_client().get(self.url)
         soup = BeautifulSoup(req.content.decode(encoding="gbk"))
         tables = soup.find_all(
             'table', attrs={'width': "100%", 'border': '1', 'cellpadding': '1'})
@@ -135,46 +256,33 @@ class TableParser:
             td_list = table.find_all("td")
 
     def convert_text(self, dict_):
-        new_dict = {}
-        for k, v in dict_.items():
-            new_dict[k] = self.decode_text.convert(v)
-        return new_dict
+        return self.decode_text.convert_records([dict_])[0]
 
     @staticmethod
     def extract_table2dict(table: pd.DataFrame):
-        # item_key_list = ['宗地编号', '宗地总面积', '宗地坐落', '出让年限', '容积率', '建筑密度', '绿化率',
-        #                  '建筑限高', '主要用途', '用途名称', '面积', '投资强度', '保证金', '估价报告备案号',
-        #                  '起始价', '加价幅度', '挂牌开始时间', '挂牌截止时间']
+        """ pandas.read_html 得到的表格 -> dict"""
         try:
-            dict_ = {
-                '宗地编号': table.loc[0, 1],
-                '宗地总面积': table.loc[0, 3],
-                '宗地坐落': table.loc[0, 5],
-                '出让年限': table.loc[1, 1],
-                '容积率': table.loc[1, 3],
-                '建筑密度': table.loc[1, 5],
-                '绿化率': table.loc[2, 1],
-                '建筑限高': table.loc[2, 3],
-                '主要用途': table.loc[4, 0],
-                '面积': table.loc[7, 3],
-                '投资强度': table.loc[8, 1],
-                '保证金': table.loc[8, 3],
-                '估价报告备案号': table.loc[8, 5],
-                '起始价': table.loc[9, 1],
-                '加价幅度': table.loc[9, 3],
-                '挂牌开始时间': table.loc[10, 1],
-                '挂牌截止时间': table.loc[10, 3],
-            }
+            dict_ = {name: table.loc[row, col] for name, (row, col) in LAND_CELLS.items()}
         except Exception:
             dict_ = {}
         return dict_
 
+    @staticmethod
+    def extract_grid2dict(grid):
+        """ table_to_grid 得到的二维列表 -> dict, 和 extract_table2dict 一样, 表格外的位置返回 {}, 空单元格为 "无" """
+        width = max((len(row) for row in grid), default=0)
+        dict_ = {}
+        for name, (row, col) in LAND_CELLS.items():
+            if row >= len(grid) or col >= width:
+                return {}
+            value = grid[row][col] if col < len(grid[row]) else None
+            dict_[name] = "无" if value is None else value
+        return dict_
+
     def extract(self):
         items = []
-        tables = self.get_valid_table()
-        for table in tables:
-            table = table.fillna("无")
-            dict_ = self.extract_table2dict(table)
+        for grid in self.get_valid_table():
+            dict_ = self.extract_grid2dict(grid)
             if not dict_:
                 continue
             dict_ = self.convert_text(dict_)
@@ -183,7 +291,15 @@ class TableParser:
 
 
 class LandMarketCrawler:
-    def __init__(self, start_page, end_page, suffix="/default.aspx?tabid=261"):
+    def __init__(self, start_page, end_page, suffix="/default.aspx?tabid=261", browser=None):
+        """
+        Parameters
+        ----------
+        start_page : int, 开始页数
+        end_page : int, 结束页数, 不包括
+        suffix : str, 列表页地址
+        browser : WebDriver, 浏览器池中的浏览器, 为空时新建一个, close 时退出
+        """
         self.domain = DomainUrl + suffix
 
         self.start_page = int(start_page)
@@ -191,15 +307,8 @@ class LandMarketCrawler:
 
         self.page = 0
         # self.domain = "https://www.landchina.com/default.aspx?tabid=261"
-        option = webdriver.ChromeOptions()
-        option.add_argument('--headless')
-        option.add_argument("start-maximized")
-        option.add_argument("--disable-blink-features=AutomationControlled")
-        option.add_experimental_option(
-            "excludeSwitches", ["enable-automation"])
-        option.add_experimental_option("useAutomationExtension", False)
-        self.browser = webdriver.Chrome(options=option)
-        time.sleep(2)
+        self.own_browser = browser is None
+        self.browser = create_browser() if browser is None else browser
 
     def __enter__(self):
         return self
@@ -208,23 +317,35 @@ class LandMarketCrawler:
         self.close()
 
     def close(self):
-        self.browser.close()
+        if self.own_browser:
+            self.browser.quit()
 
     def first_page(self):
         self.browser.get(self.domain)
 
+    def wait_page_loaded(self, old_page, timeout=10):
+        """ 等待翻页后旧页面失效, 把加载耗时反馈给限速器"""
+        start = time.monotonic()
+        try:
+            WebDriverWait(self.browser, timeout).until(expected_conditions.staleness_of(old_page))
+            get_limiter().feedback(self.domain, True, time.monotonic() - start)
+        except TimeoutException:
+            get_limiter().feedback(self.domain, ok=False)
+            print("page {} not reloaded in {}s".format(self.page, timeout))
+
     def click_page(self, page):
         try:
             self.page = page
+            get_limiter().acquire(self.domain)
+            old_page = self.browser.find_element(By.TAG_NAME, "html")
             self.browser.execute_script(
                 "QueryAction.GoPage('TAB',{})".format(page))
+            self.wait_page_loaded(old_page)
         except Exception as err:
             print("failed to QueryAction.GoPage('TAB',{})".format(page), err)
 
     def click_next_page(self):
-        self.page += 1
-        self.browser.execute_script(
-            "QueryAction.GoPage('TAB',{})".format(self.page))
+        self.click_page(self.page + 1)
 
     def get_tree(self):
         return etree.HTML(self.browser.page_source)
@@ -235,36 +356,117 @@ class LandMarketCrawler:
     def get_total_page(self):
         pass
 
+    def iter_urls(self, pages):
+        """ 打开第一页后依次跳到 pages 中的每一页, 产生每页上的详情页链接"""
+        self.first_page()
+        for page in pages:
+            self.click_page(page)
+            yield from self.get_url()
+
     def get_all_by_page(self):
         save_path = f"{self.start_page}_{self.end_page}.csv"
-        self.first_page()
         dicts = []
-        urls = []
-        for page in range(self.start_page, self.end_page):
-            self.click_page(page)
-            time.sleep(1)
-            urls.extend(self.get_url())
+        urls = list(self.iter_urls(range(self.start_page, self.end_page)))
         for url in urls:
-            d = TableParser(url).extract()
-            for v in d:
-                save_csv(v, save_path)
-                print(v)
+            save_land(url, save_path)
             # dicts.extend(d)
+        close_sink(save_path)
         # return dicts
 
 
+def save_land(url, save_path):
+    """ 抓取一个详情页, 保存其中的所有土地"""
+    for v in TableParser(url).extract():
+        save_csv(v, save_path)
+        save_record("land", v)
+        print(v)
+
+
+def split_pages(start_page, end_page, parts, max_pages=0):
+    """ [start_page, end_page) 分成连续不重叠的区间, 至少 parts 个(页数足够时), 每个区间最多 max_pages 页
+
+    区间比浏览器多时, 先翻完的浏览器接着取下一个区间, 浏览器翻完一个区间后按 max_pages 重启.
+    """
+    size = max(1, math.ceil((end_page - start_page) / parts))
+    if max_pages:
+        size = min(size, max_pages)
+    return [(page, min(page + size, end_page)) for page in range(start_page, end_page, size)]
+
+
+def crawl_land_market(start_page, end_page, browsers=2, detail_workers=8, max_pages=BROWSER_MAX_PAGES):
+    """ 多个浏览器同时翻不同区间的列表页, 发现的详情页链接马上交给 detail_workers 个线程抓取解析
+
+    Parameters
+    ----------
+    start_page : int, 开始页数
+    end_page : int, 结束页数, 不包括
+    browsers : int, 浏览器数量, 区间数少于浏览器数时只启动区间数个浏览器
+    detail_workers : int, 抓取详情页的线程数, 详情页通过共享的连接池和限速器下载
+    max_pages : int, 一个区间最多多少页, 一个浏览器最多翻多少页后重启
+    """
+    start_page, end_page = int(start_page), int(end_page)
+    save_path = f"{start_page}_{end_page}.csv"
+    urls = queue.Queue(maxsize=detail_workers * 100)
+
+    def paginate(browser, page_range):
+        crawler = LandMarketCrawler(page_range[0], page_range[1], browser=browser)
+        for url in crawler.iter_urls(range(*page_range)):
+            urls.put(url)
+        return page_range[1] - page_range[0]
+
+    def detail_worker():
+        while True:
+            url = urls.get()
+            if url is None:
+                return
+            try:
+                save_land(url, save_path)
+            except Exception as err:
+                print("failed to extract {}".format(url), err)
+
+    workers = [threading.Thread(target=detail_worker, daemon=True) for _ in range(detail_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        BrowserPool(browsers, max_pages).run(split_pages(start_page, end_page, browsers, max_pages), paginate)
+    finally:
+        for _ in workers:
+            urls.put(None)
+        for worker in workers:
+            worker.join()
+        close_sink(save_path)
+
+
 @click.command()
 @click.option("--start_page", help="开始页数", default="安庆")
 @click.option("--end_page", help="结束页数", default=None)
-def main(start_page, end_page):
+@click.option("--browsers", help="Number of browsers paginating disjoint page ranges", default=1)
+@click.option("--detail_workers", help="Number of detail page threads", default=8)
+@click.option("--max_pages", help="Pages per range and per browser before it restarts, 0 for no limit",
+              default=BROWSER_MAX_PAGES)
+@click.option("--rate", help="Target requests per second for each domain", default=RATE_LIMIT)
+@click.option("--pool_size", help="HTTP connections kept per host by the shared client", default=HTTP_POOL_SIZE)
+@click.option("--parquet_dir", help="Also write typed, partitioned parquet files to this dirname", default=PARQUET_DIR)
+def main(start_page, end_page, browsers, detail_workers, max_pages, rate, pool_size, parquet_dir):
     """
      Command:
     - 指定日期
 
-    python land_market.py --start_page 1 --end_page 4
+    python land_market.py --start_page 1 --end_page 4 --rate 1
+
+    - 4 个浏览器同时翻页, 8 个线程抓详情页
+
+    python land_market.py --start_page 1 --end_page 200 --browsers 4 --detail_workers 8 --rate 4
+
+    - 每 100 页一个区间, 4 个浏览器轮流取区间, 翻完 100 页后重启浏览器
+
+    python land_market.py --start_page 1 --end_page 2000 --browsers 4 --max_pages 100
     """
-    with LandMarketCrawler(start_page, end_page) as crawler:
-        crawler.get_all_by_page()
+    configure_limiter(rate)
+    configure_client(pool_size)
+    configure_parquet(parquet_dir)
+    # 一个浏览器时同样按 max_pages 分区间翻页和重启
+    crawl_land_market(start_page, end_page, browsers, detail_workers, max_pages)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 合并多个爬虫输出的 json 文件或者 csv 文件, 保存为一个 csv 文件
+
+@ModifyRecord:
+"""
+import click
+
+from config import CONVERT_CHUNK_SIZE, MERGE_MEMORY_BUDGET
+from convert_json_to_excel import merge_multiple_csv, merge_multiple_file
+
+
+@click.command()
+@click.option("--path", help="Input file, repeat for multiple files", multiple=True, required=True)
+@click.option("--input_type", help="json lines files or csv files", default="json", type=click.Choice(["json", "csv"]))
+@click.option("--save_path", help="Merged csv filename, json inputs are appended if it exists", required=True)
+@click.option("--columns", help="Comma separated output columns, default the header of an existing --save_path, "
+                               "else the union of every record's columns", default="")
+@click.option("--batch_size", help="Rows per batch", default=CONVERT_CHUNK_SIZE)
+@click.option("--key", help="Dedup column for csv inputs", default="房间代号")
+@click.option("--keep", help="Keep the first or the last row of each key for csv inputs", default="first",
+              type=click.Choice(["first", "last"]))
+@click.option("--memory_budget", help="Memory budget in bytes for csv dedup", default=MERGE_MEMORY_BUDGET)
+def main(path, input_type, save_path, columns, batch_size, key, keep, memory_budget):
+    """
+    python merge_files.py --path bj_1.txt --path bj_2.txt --save_path bj.csv
+    python merge_files.py --input_type csv --path bj_202009.csv --path bj_202010.csv --save_path bj.csv --keep last
+    """
+    if input_type == "csv":
+        merge_multiple_csv(list(path), save_path, key, keep, memory_budget, batch_size)
+        return
+    columns = [name for name in columns.split(",") if name] or None
+    merge_multiple_file(list(path), save_path, columns, batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,19 +10,24 @@ Created on 2020/7/26 10:32
 """
 import json
 import random
-import time
 from collections import OrderedDict
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, fields
 from typing import Optional
 
 import click
-import js2xml
-import requests
 from loguru import logger
 from lxml import etree
 from retry import retry
 
-from tools import ua_list
+from config import DISCOVERY_WORKERS, HTTP_CACHE_DIR, HTTP_POOL_SIZE, PARQUET_DIR, RATE_LIMIT
+from frontier import Frontier
+from http_cache import configure_cache
+from parquet_sink import configure_parquet, save_record
+from rate_limit import configure_limiter
+from script_vars import get_page_vars
+from sinks import flush_sinks
+from tools import configure_client, get_client, save_json, thread_map, ua_list
+from xpath_registry import register
 
 
 def get_useragent():
@@ -129,6 +134,11 @@ class Xpath:
     address: Optional[str] = "/html/body/div[4]/div/div[1]/div"
 
 
+NEIGHBORHOOD_XPATHS = register("neighborhood", {field.name: field.default for field in fields(Xpath)})
+DETAIL_FIELDS = ("building_age", "building_types", "property_cost", "property_company", "property_developers",
+                 "num_building", "num_house", "unit_price", "address")
+
+
 class NeighborhoodSpider:
     """
     get neighborhood data
@@ -147,27 +157,28 @@ class NeighborhoodSpider:
         self.typ = typ
 
     def get_districts(self):
-        selector = etree.HTML(requests.get(self.sub_domain).text)
-        return [Region(item.text, item.attrib["href"]) for item in selector.xpath(Xpath.district)]
+        selector = etree.HTML(get_client().get(self.sub_domain).text)
+        return [Region(item.text, item.attrib["href"]) for item in NEIGHBORHOOD_XPATHS["district"](selector)]
 
     def get_counties(self, region: Region):
         url = self.domain + region.url
-        selector = etree.HTML(requests.get(url).text)
-        return [Region(item.text, item.attrib["href"]) for item in selector.xpath(Xpath.county)]
+        selector = etree.HTML(get_client().get(url).text)
+        return [Region(item.text, item.attrib["href"]) for item in NEIGHBORHOOD_XPATHS["county"](selector)]
 
     def get_total_page(self, region: Region):
         try:
             url = self.domain + region.url
-            selector = etree.HTML(requests.get(url).text)
-            attrib = json.loads(selector.xpath(Xpath.total_page)[0].attrib["page-data"])
+            selector = etree.HTML(get_client().get(url).text)
+            attrib = json.loads(NEIGHBORHOOD_XPATHS["total_page"](selector)[0].attrib["page-data"])
             return attrib["totalPage"]
         except Exception as err:
             logger.error(err)
 
     @staticmethod
     def get_neighborhood_from_current_page(url):
-        selector = etree.HTML(requests.get(url).text)
-        return [Neighborhood(name=item.text, url=item.attrib["href"]) for item in selector.xpath(Xpath.neighborhood)]
+        selector = etree.HTML(get_client().get(url).text)
+        return [Neighborhood(name=item.text, url=item.attrib["href"])
+                for item in NEIGHBORHOOD_XPATHS["neighborhood"](selector)]
 
     @staticmethod
     def selector_xpath(selector, pattern):
@@ -177,25 +188,26 @@ class NeighborhoodSpider:
             logger.error("have no this pattern data: {}".format(err))
             return None
 
+    @staticmethod
+    def first_text(values, name):
+        try:
+            return values[name][0].text
+        except Exception as err:
+            logger.error("have no this pattern data: {}".format(err))
+            return None
+
     def get_neighborhood_detail_info(self, neighborhood: Neighborhood):
-        selector = etree.HTML(requests.get(neighborhood.url).text)
-        neighborhood.building_age = self.selector_xpath(selector, Xpath.building_age)
-        neighborhood.building_types = self.selector_xpath(selector, Xpath.building_types)
-        neighborhood.property_cost = self.selector_xpath(selector, Xpath.property_cost)
-        neighborhood.property_company = self.selector_xpath(selector, Xpath.property_company)
-        neighborhood.property_developers = self.selector_xpath(selector, Xpath.property_developers)
-        neighborhood.num_building = self.selector_xpath(selector, Xpath.num_building)
-        neighborhood.num_house = self.selector_xpath(selector, Xpath.num_house)
-        neighborhood.unit_price = self.selector_xpath(selector, Xpath.unit_price)
+        selector = etree.HTML(get_client().get(neighborhood.url).text)
+        values = NEIGHBORHOOD_XPATHS.evaluate(selector, DETAIL_FIELDS + ("lng_lat_script",))
+        for name in DETAIL_FIELDS:
+            setattr(neighborhood, name, self.first_text(values, name))
         try:
-            lng_lat_script = selector.xpath(Xpath.lng_lat_script)[0]
-            lng, lat, _ = self.get_lng_lat(lng_lat_script)
+            lng, lat, _ = self.get_lng_lat(values["lng_lat_script"][0])
         except Exception as err:
             logger.error("unable to extract lng and lat: {}".format(err))
             lng, lat = None, None
         neighborhood.lng = lng
         neighborhood.lat = lat
-        neighborhood.address = self.selector_xpath(selector, Xpath.address)
         return neighborhood
 
     @staticmethod
@@ -204,68 +216,103 @@ class NeighborhoodSpider:
 
         Parameters
         ----------
-        script
+        script : str, 小区详情页内嵌的 script
 
         Returns
         -------
-        tuple
+        tuple, (lng, lat, {"resblockPosition": ...})
         """
-        script = js2xml.parse(script, encoding='utf-8', debug=False)
-        script = js2xml.pretty_print(script)
-        script_selector = etree.HTML(script)
-        lng, lat = script_selector.xpath(Xpath.lng_lat)[0].split(",")
-        return lng, lat, script_selector
+        page_vars = get_page_vars(script, ("resblockPosition",))
+        lng, lat = page_vars["resblockPosition"].split(",")
+        return lng, lat, page_vars
+
+    def get_frontier_path(self):
+        return f"{self.city_abbreviation}_{self.typ}_frontier.db"
+
+    def save_neighborhood(self, neighborhood: Neighborhood):
+        """ 保存到 {city_abbreviation}_{typ}.txt, 设置了 parquet 目录时同时写入 parquet"""
+        record = neighborhood.as_dict()
+        save_json(record, f"{self.city_abbreviation}_{self.typ}.txt")
+        save_record("neighborhood", record)
+
+    def crawl_neighborhood(self, neighborhood: Neighborhood, frontier: Frontier):
+        """ 抓取并保存一个小区的详情, 用 frontier 记录状态"""
+        frontier.start(neighborhood.url)
+        try:
+            neighborhood = self.get_neighborhood_detail_info(neighborhood)
+            logger.info(neighborhood)
+            self.save_neighborhood(neighborhood)
+            frontier.done(neighborhood.url)
+        except Exception as err:
+            logger.error(err)
+            frontier.fail(neighborhood.url)
 
-    @staticmethod
-    def save_json(mapping, save_path):
-        """ 保存成json"""
-        if not isinstance(mapping, str):
-            mapping = json.dumps(mapping)
-        with open(save_path, "a+") as fd:
-            fd.write(mapping + "\n")
-
-    def start_crawler(self):
-        save_path = f"{self.city_abbreviation}_{self.typ}.txt"
-        districts = self.get_districts()
-        counties_list = [(self.get_counties(district), district)
-                         for district in districts]
-        logger.info(f"districts: {districts}")
-        logger.info(f"counties_list: {counties_list}")
-        for counties, district in counties_list:
-            for county in counties:
-                total_page = self.get_total_page(county)
+    def start_crawler(self, resume=False, workers=DISCOVERY_WORKERS):
+        """
+        Parameters
+        ----------
+        resume : bool, 从上次中断的地方继续, 否则清空之前的进度重新爬
+        workers : int, 并发请求县, 页数和列表页的线程数, 详情页仍然在当前线程里逐个抓取
+        """
+        with Frontier(self.get_frontier_path(), reset=not resume, before_commit=flush_sinks) as frontier:
+            # 上次中断时还没有抓完的小区
+            for _, neighborhood in frontier.pending("neighborhood"):
+                self.crawl_neighborhood(Neighborhood(**neighborhood), frontier)
+            done_pages = frontier.keys("page")
+            done_neighborhoods = frontier.keys("neighborhood")
+
+            districts = self.get_districts()
+            counties_list = list(zip(thread_map(self.get_counties, districts, workers), districts))
+            logger.info(f"districts: {districts}")
+            logger.info(f"counties_list: {counties_list}")
+            counties = [(county, district) for county_list, district in counties_list for county in county_list or []]
+            pages = []
+            for (county, district), total_page in zip(counties, thread_map(lambda item: self.get_total_page(item[0]),
+                                                                            counties, workers)):
                 if not total_page:
                     continue
-                for page in range(1, total_page + 1):
-                    page_url = f"{self.domain}{county.url}pg{page}"
-                    try:
-                        neighborhood_list = self.get_neighborhood_from_current_page(page_url)
-                    except Exception as err:
-                        logger.error("获取页面小区列表错误", err)
-                        time.sleep(8)  # 5
-                        continue
-                    for neighborhood in neighborhood_list:
-                        try:
-                            neighborhood.county = county.name
-                            neighborhood.district = district.name
-                            neighborhood.city_name = self.city_zh_name
-                            neighborhood = self.get_neighborhood_detail_info(neighborhood)
-                            logger.info(neighborhood)
-                            self.save_json(neighborhood.as_dict(), save_path)
-                            time.sleep(5)  # 3
-                        except Exception as err:
-                            logger.error(err)
-                            time.sleep(12)  # 10
-                            continue
+                page_urls = [f"{self.domain}{county.url}pg{page}" for page in range(1, total_page + 1)]
+                frontier.add_many("page", [(page_url, {"district": district.name, "county": county.name})
+                                           for page_url in page_urls])
+                pages += [(page_url, county, district) for page_url in page_urls if page_url not in done_pages]
+            logger.info(f"{len(pages)} listing pages to crawl")
+
+            # 列表页在线程池里提前下载, 详情页按列表页的顺序在当前线程里抓取
+            neighborhood_lists = thread_map(lambda item: self.get_neighborhood_from_current_page(item[0]), pages,
+                                            workers)
+            for (page_url, county, district), neighborhood_list in zip(pages, neighborhood_lists):
+                if neighborhood_list is None:
+                    logger.error(f"获取页面小区列表错误: {page_url}")
+                    continue
+                for neighborhood in neighborhood_list:
+                    neighborhood.county = county.name
+                    neighborhood.district = district.name
+                    neighborhood.city_name = self.city_zh_name
+                    frontier.add("neighborhood", neighborhood.url, asdict(neighborhood))
+                for neighborhood in neighborhood_list:
+                    if neighborhood.url not in done_neighborhoods:
+                        self.crawl_neighborhood(neighborhood, frontier)
+                frontier.done(page_url)
 
 
 @click.command()
 @click.option("--city_zh_name", help="The chinese city name", default="北京")
 @click.option("--city_abbreviation",
               help="A brief spelling of Chinese city names", default="bj")
-def main(city_abbreviation, city_zh_name):
+@click.option("--rate", help="Target requests per second for each domain", default=RATE_LIMIT)
+@click.option("--pool_size", help="HTTP connections kept per host by the shared client", default=HTTP_POOL_SIZE)
+@click.option("--cache_dir", help="HTTP response cache dirname, empty to disable", default=HTTP_CACHE_DIR)
+@click.option("--resume", help="Resume from the last interrupted crawl", is_flag=True)
+@click.option("--parquet_dir", help="Also write typed, partitioned parquet files to this dirname", default=PARQUET_DIR)
+@click.option("--discovery_workers", help="Threads fetching counties, page counts and listing pages",
+              default=DISCOVERY_WORKERS)
+def main(city_abbreviation, city_zh_name, rate, pool_size, cache_dir, parquet_dir, resume, discovery_workers):
+    configure_limiter(rate)
+    configure_client(pool_size)
+    configure_cache(cache_dir)
+    configure_parquet(parquet_dir)
     NeighborhoodSpider(city_abbreviation=city_abbreviation,
-                       city_zh_name=city_zh_name).start_crawler()
+                       city_zh_name=city_zh_name).start_crawler(resume, discovery_workers)
 
 
 if __name__ == '__main__':
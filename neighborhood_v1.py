@@ -1,12 +1,19 @@
 import json
-import time
+import os
 import click
-import requests
 from lxml import etree
-from neighborhood import NeighborhoodSpider, Region, Xpath, Neighborhood
+from config import (HTTP_CACHE_DIR, HTTP_POOL_SIZE, PARQUET_DIR, RATE_LIMIT, WORK_QUEUE_BATCH_SIZE,
+                    WORK_QUEUE_MAX_RETRIES, WORK_QUEUE_VISIBILITY_TIMEOUT)
+from http_cache import configure_cache
+from parquet_sink import configure_parquet
+from neighborhood import NEIGHBORHOOD_XPATHS, NeighborhoodSpider, Region, Neighborhood
+from rate_limit import configure_limiter
+from seen_index import SeenIndex
 from loguru import logger
+from tools import configure_client, get_client, save_json
 from dataclasses import asdict
 from convert_json_to_excel import convert_json_to_csv, custom_format
+from work_queue import SqliteWorkQueue
 
 logger.add("neighborhood.log")
 
@@ -18,8 +25,8 @@ class NeighborhoodSpiderV1(NeighborhoodSpider):
         self.save_path_name = f"{self.city_abbreviation}_{self.typ}"
 
     def get_districts(self):
-        selector = etree.HTML(requests.get(self.sub_domain).text)
-        for item in selector.xpath(Xpath.district):
+        selector = etree.HTML(get_client().get(self.sub_domain).text)
+        for item in NEIGHBORHOOD_XPATHS["district"](selector):
             try:
                 yield Region(item.text, item.attrib["href"])
             except Exception as err:
@@ -34,38 +41,43 @@ class NeighborhoodSpiderV1(NeighborhoodSpider):
 
     @staticmethod
     def get_neighborhood_from_current_page(url):
-        selector = etree.HTML(requests.get(url).text)
-        for item in selector.xpath(Xpath.neighborhood):
+        selector = etree.HTML(get_client().get(url).text)
+        for item in NEIGHBORHOOD_XPATHS["neighborhood"](selector):
             yield Neighborhood(name=item.text, url=item.attrib["href"])
 
-    def start_crawler_neighborhood_list(self):
-        _url_list = []
+    def start_crawler_neighborhood_list(self, resume=False):
+        """
+        resume: 接着上次中断的发现继续, 之前发现的小区从 {save_path_name}.json 读取, 不重复保存,
+                否则重新发现所有小区
+        """
         save_path_url = f"{self.save_path_name}.json"  # 保存爬取的链接
-        for counties, district in self.get_counties_list():
-            # if district.name in ["通州", "东城", "西城", "朝阳", "海淀", "丰台", "石景山"]:
-            #     continue
-            for county in counties:
-                total_page = self.get_total_page(county)
-                if not total_page:
-                    continue
-                for page in range(1, total_page + 1):
-                    page_url = f"{self.domain}{county.url}pg{page}"
-                    time.sleep(4)
-                    for neighborhood in self.get_neighborhood_from_current_page(page_url):
-                        try:
-                            if neighborhood.url in _url_list:
-                                continue
-                            _url_list.append(neighborhood.url)
-                            neighborhood.county = county.name
-                            neighborhood.district = district.name
-                            neighborhood.city_name = self.city_zh_name
-                            self.neighborhood_list.append(neighborhood)
-                            logger.info(asdict(neighborhood))
-                            self.save_json(asdict(neighborhood), save_path_url)
-                        except Exception as err:
-                            logger.error(err)
-                        finally:
-                            time.sleep(0)
+        if resume and os.path.exists(save_path_url):
+            self.get_neighborhood_list_from_file(save_path_url)
+        # resume 时打开已有的索引, 和其它进程共享, 索引是空的(之前的运行没有索引文件)时用文件里的小区初始化
+        with SeenIndex(f"{self.save_path_name}_seen.db", reset=not resume) as seen:
+            if resume and not len(seen):
+                seen.add_many(neighborhood.url for neighborhood in self.neighborhood_list)
+            for counties, district in self.get_counties_list():
+                # if district.name in ["通州", "东城", "西城", "朝阳", "海淀", "丰台", "石景山"]:
+                #     continue
+                for county in counties:
+                    total_page = self.get_total_page(county)
+                    if not total_page:
+                        continue
+                    for page in range(1, total_page + 1):
+                        page_url = f"{self.domain}{county.url}pg{page}"
+                        for neighborhood in self.get_neighborhood_from_current_page(page_url):
+                            try:
+                                if not seen.add(neighborhood.url):
+                                    continue
+                                neighborhood.county = county.name
+                                neighborhood.district = district.name
+                                neighborhood.city_name = self.city_zh_name
+                                self.neighborhood_list.append(neighborhood)
+                                logger.info(asdict(neighborhood))
+                                save_json(asdict(neighborhood), save_path_url)
+                            except Exception as err:
+                                logger.error(err)
         self.get_all_neighborhood()
 
     def get_neighborhood_list_from_file(self, filename):
@@ -82,15 +94,12 @@ class NeighborhoodSpiderV1(NeighborhoodSpider):
                 self.neighborhood_list.append(neighborhood)
 
     def get_neighborhood(self, neighborhood: Neighborhood, idx=0, total_length=0):
-        save_path = f"{self.save_path_name}.txt"
         try:
             neighborhood = self.get_neighborhood_detail_info(neighborhood)
             logger.info(f"idx: {idx}:{total_length}, {neighborhood}")
-            self.save_json(neighborhood.as_dict(), save_path)
+            self.save_neighborhood(neighborhood)
         except Exception as err:
             logger.error(err)
-        finally:
-            time.sleep(4)
 
     def get_all_neighborhood(self, start=0, end=0):
         if end == 0:
@@ -98,15 +107,15 @@ class NeighborhoodSpiderV1(NeighborhoodSpider):
         if start > end:
             start, end = end, start
 
-        _url_list = []
+        _url_set = set()
         neighborhood_list = []
         # 去重
         for neighborhood in self.neighborhood_list:
-            if neighborhood.url in _url_list:
+            if neighborhood.url in _url_set:
                 continue
-            _url_list.append(neighborhood.url)
+            _url_set.add(neighborhood.url)
             neighborhood_list.append(neighborhood)
-        del _url_list
+        del _url_set
 
         neighborhood_list = neighborhood_list[start: end]
 
@@ -120,13 +129,46 @@ class NeighborhoodSpiderV1(NeighborhoodSpider):
         self.get_neighborhood_list_from_file(filename)
         self.get_all_neighborhood(start=start, end=end)
 
+    def crawl_queue_item(self, item):
+        """ 抓取队列中的一个小区, 失败时抛出异常, 由队列重试"""
+        neighborhood = self.get_neighborhood_detail_info(Neighborhood(**json.loads(item)))
+        logger.info(neighborhood)
+        self.save_neighborhood(neighborhood)
+
+    def start_crawler_from_queue(self, queue, batch_size=WORK_QUEUE_BATCH_SIZE, exit_when_empty=False):
+        """ 从任务队列(work_queue.WorkQueue)取小区抓取, exit_when_empty 为 False 时一直等待新的小区"""
+        logger.info(f"queue {self.save_path_name}: {queue.stats()}")
+        queue.consume(self.crawl_queue_item, batch_size, exit_when_empty=exit_when_empty)
+        custom_format(f"{self.save_path_name}.txt", self.typ)
 
-def crawler_neighborhood(city_abbreviation, city_zh_name, file, start, end):
+    def start_crawler_from_sqlite(self, queue_path="", filename="", batch_size=WORK_QUEUE_BATCH_SIZE,
+                                  visibility_timeout=WORK_QUEUE_VISIBILITY_TIMEOUT, max_retries=WORK_QUEUE_MAX_RETRIES,
+                                  exit_when_empty=False):
+        """ 同一台机器上的多个进程共享一个 sqlite 队列
+
+        queue_path: 队列文件, 默认 {city_abbreviation}_{typ}_queue.db
+        filename: 先把 json 行文件里的小区放入队列, 已经在队列里(包括已经完成)的小区忽略
+        exit_when_empty: 队列处理完后退出并转换成 csv, 否则一直等待新的小区, 和命令行 --exit_when_empty 的默认值一致
+        """
+        queue = SqliteWorkQueue(queue_path or f"{self.save_path_name}_queue.db", self.save_path_name,
+                                visibility_timeout=visibility_timeout, max_retries=max_retries)
+        if filename:
+            self.get_neighborhood_list_from_file(filename)
+            queue.put(json.dumps(asdict(neighborhood)) for neighborhood in self.neighborhood_list)
+        self.start_crawler_from_queue(queue, batch_size, exit_when_empty)
+        queue.close()
+
+
+def crawler_neighborhood(city_abbreviation, city_zh_name, file, start, end, queue_path="",
+                         batch_size=WORK_QUEUE_BATCH_SIZE, visibility_timeout=WORK_QUEUE_VISIBILITY_TIMEOUT,
+                         max_retries=WORK_QUEUE_MAX_RETRIES, exit_when_empty=False, resume=False):
     n_v1 = NeighborhoodSpiderV1(city_abbreviation=city_abbreviation, city_zh_name=city_zh_name)
-    if file != "":
+    if queue_path != "":
+        n_v1.start_crawler_from_sqlite(queue_path, file, batch_size, visibility_timeout, max_retries, exit_when_empty)
+    elif file != "":
         n_v1.start_crawler_from_file(file, start, end)
     else:
-        n_v1.start_crawler_neighborhood_list()
+        n_v1.start_crawler_neighborhood_list(resume)
 
 
 @click.command()
@@ -135,12 +177,34 @@ def crawler_neighborhood(city_abbreviation, city_zh_name, file, start, end):
 @click.option("--file", help="from file", default="")
 @click.option("--start", help="start index", default=0)
 @click.option("--end", help="end index", default=0)
-def main(city_abbreviation, city_zh_name, file, start, end):
+@click.option("--queue_path", help="Share the neighborhoods of --file through this SQLite queue file", default="")
+@click.option("--batch_size", help="Neighborhoods prefetched per claim from the queue", default=WORK_QUEUE_BATCH_SIZE)
+@click.option("--visibility_timeout", help="Seconds before an unacknowledged queue task is requeued",
+              default=WORK_QUEUE_VISIBILITY_TIMEOUT)
+@click.option("--max_retries", help="Failures before a queue task is marked dead", default=WORK_QUEUE_MAX_RETRIES)
+@click.option("--exit_when_empty", help="Stop the queue worker once the queue is drained, otherwise keep waiting for "
+                                      "new neighborhoods", is_flag=True)
+@click.option("--resume", help="Continue an interrupted or running neighborhood discovery instead of starting over; "
+                                "set it on every worker joining a running discovery",
+              is_flag=True)
+@click.option("--rate", help="Target requests per second for each domain", default=RATE_LIMIT)
+@click.option("--pool_size", help="HTTP connections kept per host by the shared client", default=HTTP_POOL_SIZE)
+@click.option("--cache_dir", help="HTTP response cache dirname, empty to disable", default=HTTP_CACHE_DIR)
+@click.option("--parquet_dir", help="Also write typed, partitioned parquet files to this dirname", default=PARQUET_DIR)
+def main(city_abbreviation, city_zh_name, file, start, end, queue_path, batch_size, visibility_timeout, max_retries,
+         exit_when_empty, resume, rate, pool_size, cache_dir, parquet_dir):
     """
     python neighborhood_v1.py --city_zh_name 北京 --city_abbreviation bj
-    python neighborhood_v1.py --city_zh_name 北京 --city_abbreviation bj --file bj_xiaoqu.json --start 0 --end 5000
+    python neighborhood_v1.py --city_zh_name 北京 --city_abbreviation bj --file bj_xiaoqu.json --start 0 --end 5000 --rate 2
+    - 多个进程共享 sqlite 队列, 每个进程运行同样的命令
+    python neighborhood_v1.py --city_zh_name 北京 --city_abbreviation bj --file bj_xiaoqu.json --queue_path bj.db --exit_when_empty
     """
-    crawler_neighborhood(city_abbreviation, city_zh_name, file, start, end)
+    configure_limiter(rate)
+    configure_client(pool_size)
+    configure_cache(cache_dir)
+    configure_parquet(parquet_dir)
+    crawler_neighborhood(city_abbreviation, city_zh_name, file, start, end, queue_path, batch_size, visibility_timeout,
+                         max_retries, exit_when_empty, resume)
 
 
 if __name__ == '__main__':
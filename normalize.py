@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 把房子和空气质量记录的文本字段整列转换成数值, 日期和分类类型
+
+@ModifyRecord:
+"""
+import os
+
+import click
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from config import CONVERT_CHUNK_SIZE
+
+NUMBER_PATTERN = r"(-?\d+(?:\.\d+)?)"
+DATE_PATTERN = r"(?P<year>\d{4})\D(?P<month>\d{1,2})\D(?P<day>\d{1,2})"
+
+# "350" 万, "52345元/平米", "89.5平米", "116.35"
+FLOAT_COLUMNS = ("lng", "lat", "单价", "成交价格", "挂牌价格", "建筑面积", "成交小区均价")
+# "2005年建", "85", "3"
+INT_COLUMNS = ("建筑年代", "成交周期", "调价次数", "带看次数", "浏览次数", "关注人数")
+# "2020-06-01", "2020.06.20"
+DATE_COLUMNS = ("挂牌时间", "成交时间")
+CATEGORY_COLUMNS = ("城市", "区", "县", "小区", "房屋朝向", "配备电梯", "装修情况", "建筑类型", "建筑结构", "供暖方式",
+                    "交易权属", "房屋用途", "房权所属")
+# 空气质量表格的列, 其它列为字符串
+AQI_FLOAT_COLUMNS = ("AQI", "PM2.5", "PM10", "SO2", "CO", "NO2", "O3_8h")
+AQI_TEXT_COLUMNS = ("city", "范围", "质量等级")
+
+
+def to_str(series: pd.Series) -> pd.Series:
+    """ 去掉首尾空白的 string, 空字符串为 NA"""
+    values = series.astype("string").str.strip()
+    return values.mask(values == "")
+
+
+def to_float(series: pd.Series) -> pd.Series:
+    """ 取每个值里的第一个数字, 取不到时为 NaN"""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("float64")
+    values = series.astype("string").str.replace(",", "", regex=False).str.extract(NUMBER_PATTERN, expand=False)
+    return pd.to_numeric(values, errors="coerce").astype("float64")
+
+
+def to_int(series: pd.Series) -> pd.Series:
+    """ 同 to_float, 小数部分截断, 结果为可以为空的 Int64"""
+    return np.trunc(to_float(series)).astype("Int64")
+
+
+def to_date(series: pd.Series) -> pd.Series:
+    """ 年月日用任意一个字符分隔的日期, 取不到或者不合法时为 NaT"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    parts = series.astype("string").str.extract(DATE_PATTERN).astype("float64")
+    return pd.to_datetime(parts, errors="coerce")
+
+
+def normalize_houses(data) -> pd.DataFrame:
+    """ 转换一批房子记录
+
+    Parameters
+    ----------
+    data : DataFrame 或者 get_house_all_info 返回的 dict 列表
+
+    Returns
+    -------
+    DataFrame, 新的 DataFrame, 不存在的列忽略, 其它列保持原样
+    """
+    df = pd.DataFrame(data).copy()
+    for name in FLOAT_COLUMNS:
+        if name in df:
+            df[name] = to_float(df[name])
+    for name in INT_COLUMNS:
+        if name in df:
+            df[name] = to_int(df[name])
+    for name in DATE_COLUMNS:
+        if name in df:
+            df[name] = to_date(df[name])
+    for name in CATEGORY_COLUMNS:
+        if name in df:
+            df[name] = df[name].astype("category")
+    return df
+
+
+def normalize_aqi(data) -> pd.DataFrame:
+    """ 转换一批空气质量记录: 日期 -> datetime64, AQI 和污染物 -> float64, 其它为 string
+
+    缺少的列补为空, 日期不合法的行(表头, 汇总行)丢弃.
+
+    Parameters
+    ----------
+    data : DataFrame 或者 dict 列表, 全部为字符串的空气质量表格
+    """
+    raw = pd.DataFrame(data)
+    # 每次只转换一个月几十行, 先收集各列再一次构造 DataFrame, 不逐列插入
+    columns = {"日期": to_date(raw["日期"]) if "日期" in raw else pd.Series(pd.NaT, index=raw.index)}
+    for name in AQI_FLOAT_COLUMNS:
+        columns[name] = to_float(raw[name]) if name in raw else pd.Series(np.nan, index=raw.index)
+    for name in AQI_TEXT_COLUMNS:
+        columns[name] = raw[name].astype("string") if name in raw else pd.Series(pd.NA, index=raw.index,
+                                                                                  dtype="string")
+    df = pd.DataFrame(columns)
+    return df[df["日期"].notna()].reset_index(drop=True)
+
+
+def read_chunks(path, chunksize=CONVERT_CHUNK_SIZE):
+    """ 分块读取 json 行文件或者 csv 文件"""
+    if path.endswith(".csv"):
+        for df in pd.read_csv(path, dtype=str, chunksize=chunksize, index_col=False):
+            yield df.drop(columns=[name for name in df.columns if name.startswith("Unnamed:")])
+        return
+    # convert_json_to_excel 导入了本模块, 放在函数里避免循环导入
+    from convert_json_to_excel import iter_chunks, iter_records
+    for chunk in iter_chunks(iter_records(path), chunksize):
+        yield pd.DataFrame(chunk)
+
+
+def normalize_file(path, save_path, chunksize=CONVERT_CHUNK_SIZE):
+    """ 分块转换已有的文件, save_path 为 .parquet 时保存为 parquet, 否则保存为 csv"""
+    writer = None
+    total = 0
+    try:
+        for df in read_chunks(path, chunksize):
+            df = normalize_houses(df)
+            if save_path.endswith(".parquet"):
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                # 每块的分类不同, parquet 里统一保存为字符串, 由 parquet 自己做字典编码
+                for name in df.columns:
+                    if isinstance(df[name].dtype, pd.CategoricalDtype) or df[name].dtype == object:
+                        df[name] = df[name].astype("string")
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(save_path, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                df.to_csv(save_path, mode="a" if total else "w", header=not total, index=False)
+            total += len(df)
+            logger.info(f"normalized {total} rows")
+    finally:
+        if writer is not None:
+            writer.close()
+    logger.success(f"转换成功，{total} 行，保存到{save_path}")
+
+
+@click.command()
+@click.option("--path", help="House records, json lines or csv")
+@click.option("--save_path", help="Output filename, .csv or .parquet", default="")
+@click.option("--chunksize", help="Rows per chunk", default=CONVERT_CHUNK_SIZE)
+def main(path, save_path, chunksize):
+    """
+    python normalize.py --path bj.txt --save_path bj_normalized.parquet
+    python normalize.py --path bj.txt_ershoufang.csv
+    """
+    if not save_path:
+        save_path = f"{os.path.splitext(path)[0]}_normalized.csv"
+    normalize_file(path, save_path, chunksize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 把房子, 小区, 土地, 空气质量记录按类型写成分区的 parquet 文件, 边爬边按 row group 写入, 按分区或者整个数据集读取
+
+@ModifyRecord:
+"""
+import atexit
+import glob
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+from loguru import logger
+
+from config import PARQUET_DIR, PARQUET_MAX_OPEN_FILES, PARQUET_ROW_GROUP_SIZE
+from normalize import normalize_aqi, normalize_houses, to_date, to_float, to_int, to_str
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+MONTH_PATTERN = re.compile(r"(\d{4})\D(\d{1,2})")
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def to_month(value):
+    """ 日期文本 -> "2020-06", 分区用"""
+    match = MONTH_PATTERN.search(str(value)) if value is not None else None
+    return f"{match.group(1)}-{int(match.group(2)):02d}" if match else None
+
+
+# 类型名 -> (normalize 里整列转换的函数, arrow 类型名)
+CONVERTERS = {
+    "str": (to_str, "string"),
+    "float": (to_float, "float64"),
+    "int": (to_int, "int64"),
+    "date": (to_date, "date32"),
+}
+
+# 记录类型 -> {"fields": {列名: 类型名}, "partition": record -> [(分区列, 值), ...], "normalize": DataFrame -> DataFrame}
+# 分区列保存在目录名里(hive 风格 列=值), 不重复写入文件; normalize 为 normalize.py 里这种记录的转换, 没有时只按列的类型转换
+SCHEMAS = {
+    "house": {
+        "fields": OrderedDict([
+            ("房间代号", "str"), ("县", "str"), ("小区", "str"), ("lng", "float"), ("lat", "float"),
+            ("单价", "float"), ("成交价格", "float"), ("挂牌价格", "float"), ("挂牌时间", "date"), ("成交时间", "date"),
+            ("房屋户型", "str"), ("房屋朝向", "str"), ("所在楼层", "str"), ("配备电梯", "str"), ("装修情况", "str"),
+            ("建筑面积", "float"), ("建筑类型", "str"), ("建筑年代", "int"), ("建筑结构", "str"), ("梯户比例", "str"),
+            ("供暖方式", "str"), ("交易权属", "str"), ("房屋用途", "str"), ("房权所属", "str"), ("成交周期", "int"),
+            ("调价次数", "int"), ("带看次数", "int"), ("浏览次数", "int"), ("关注人数", "int"),
+            ("成交小区均价", "float"), ("网址", "str"),
+        ]),
+        "partition": lambda record: [("城市", record.get("城市")), ("区", record.get("区"))],
+        "normalize": normalize_houses,
+    },
+    "neighborhood": {
+        "fields": OrderedDict([
+            ("经度", "float"), ("纬度", "float"), ("板块", "str"), ("小区名称", "str"), ("地址", "str"),
+            ("挂牌均价(元/m2)", "float"), ("建筑年代", "int"), ("建筑类型", "str"), ("物业费用", "str"),
+            ("物业公司", "str"), ("开发商", "str"), ("楼栋总数(栋)", "int"), ("房屋总数(户)", "int"), ("网址", "str"),
+        ]),
+        "partition": lambda record: [("城市", record.get("城市")), ("行政区", record.get("行政区"))],
+    },
+    "land": {
+        "fields": OrderedDict([
+            ("宗地编号", "str"), ("宗地总面积", "float"), ("宗地坐落", "str"), ("出让年限", "str"), ("容积率", "str"),
+            ("建筑密度", "str"), ("绿化率", "str"), ("建筑限高", "str"), ("主要用途", "str"), ("面积", "float"),
+            ("投资强度", "str"), ("保证金", "float"), ("估价报告备案号", "str"), ("起始价", "float"),
+            ("加价幅度", "float"), ("挂牌开始时间", "str"), ("挂牌截止时间", "str"),
+        ]),
+        # 土地记录没有城市/行政区, 按挂牌开始的月份分区
+        "partition": lambda record: [("month", to_month(record.get("挂牌开始时间")))],
+    },
+    "aqi": {
+        "fields": OrderedDict([
+            ("日期", "date"), ("AQI", "float"), ("范围", "str"), ("质量等级", "str"), ("PM2.5", "float"),
+            ("PM10", "float"), ("SO2", "float"), ("CO", "float"), ("NO2", "float"), ("O3_8h", "float"),
+        ]),
+        # 每个城市每月只有几十行, 按月分区会产生几万个小文件, 读取全部数据要几十秒, 所以只按城市分区
+        "partition": lambda record: [("city", record.get("city"))],
+        "normalize": normalize_aqi,
+    },
+}
+
+
+def partition_value(value):
+    if value is None or value == "":
+        return DEFAULT_PARTITION
+    return re.sub(r"[\\/=:]", "_", str(value))
+
+
+class ParquetSink:
+    """ 一种记录的分区 parquet 数据集
+
+    每个分区的记录攒够 row_group_size 条时作为一个 row group 写入该分区当前的文件,
+    同时打开的文件超过 max_open_files 时关闭最久没有写入的文件, 之后再写这个分区时新建文件.
+    write 缓存文本记录, 写 row group 时整批用 normalize.py 转换, write_frame 写入已经转换好类型的 DataFrame.
+    """
+
+    def __init__(self, root, kind, row_group_size=PARQUET_ROW_GROUP_SIZE, max_open_files=PARQUET_MAX_OPEN_FILES):
+        """
+        Parameters
+        ----------
+        root : str, 数据集根目录, 记录写到 {root}/{kind}/列=值/.../part-*.parquet
+        kind : str, SCHEMAS 中的记录类型: house / neighborhood / land / aqi
+        row_group_size : int, 每个 row group 的行数
+        max_open_files : int, 同时打开的 parquet 文件数
+        """
+        if pa is None:
+            raise ImportError("parquet output needs pyarrow, pip install pyarrow")
+        self.root = os.path.join(root, kind)
+        self.kind = kind
+        self.fields = SCHEMAS[kind]["fields"]
+        self.partition = SCHEMAS[kind]["partition"]
+        self.normalize = SCHEMAS[kind].get("normalize")
+        self.schema = pa.schema([(name, getattr(pa, CONVERTERS[typ][1])()) for name, typ in self.fields.items()])
+        self.row_group_size = row_group_size
+        self.max_open_files = max_open_files
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.frames = {}
+        self.writers = OrderedDict()
+        self.sequence = 0
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_partition_dir(self, record):
+        return os.path.join(self.root, *[f"{name}={partition_value(value)}" for name, value in self.partition(record)])
+
+    def buffered_rows(self, dirname):
+        return len(self.buffers.get(dirname, ())) + sum(table.num_rows for table in self.frames.get(dirname, ()))
+
+    def write(self, record):
+        """ 写入一条记录, 记录中不在 schema 里的 key 忽略"""
+        dirname = self.get_partition_dir(record)
+        with self.lock:
+            self.buffers.setdefault(dirname, []).append(record)
+            if self.buffered_rows(dirname) >= self.row_group_size:
+                self.write_row_group(dirname)
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def write_frame(self, df: pd.DataFrame):
+        """ 写入已经转换好类型的记录(normalize 的结果), 整列转换成 arrow"""
+        if df.empty:
+            return
+        # 用 Series 分组, 只有一行时列表会被当作一个分组键的元组
+        dirnames = pd.Series([self.get_partition_dir(record) for record in df.to_dict("records")], index=df.index)
+        for dirname, group in df.groupby(dirnames, sort=False):
+            table = self.frame_to_table(group)
+            with self.lock:
+                self.frames.setdefault(dirname, []).append(table)
+                if self.buffered_rows(dirname) >= self.row_group_size:
+                    self.write_row_group(dirname)
+
+    def frame_to_table(self, df):
+        """ DataFrame -> schema 的 arrow 表, 不在 schema 里的列忽略, 缺少的列为空, 已经转换好的列不再重复转换"""
+        columns = {}
+        for name, typ in self.fields.items():
+            column = df[name] if name in df else pd.Series(pd.NA, index=df.index, dtype="object")
+            columns[name] = CONVERTERS[typ][0](column)
+        return pa.Table.from_pandas(pd.DataFrame(columns, index=df.index), schema=self.schema, preserve_index=False)
+
+    def to_table(self, records):
+        """ 一个 row group 的文本记录整批转换, 先用这种记录的 normalize 转换, 再按列的类型转换"""
+        # object 列保留原来的值, 整数列有缺失时不会先变成 101.0 这样的浮点数
+        df = pd.DataFrame(records, dtype=object)
+        if self.normalize is not None:
+            df = self.normalize(df)
+        return self.frame_to_table(df)
+
+    def get_writer(self, dirname):
+        writer = self.writers.pop(dirname, None)
+        if writer is None:
+            if len(self.writers) >= self.max_open_files:
+                _, oldest = self.writers.popitem(last=False)
+                oldest.close()
+            os.makedirs(dirname, exist_ok=True)
+            writer = pq.ParquetWriter(self.new_part_path(dirname), self.schema, compression="snappy")
+        self.writers[dirname] = writer
+        return writer
+
+    def new_part_path(self, dirname):
+        """ 分区里一个新的文件名, 同一秒内重新打开的数据集序号从头开始, 跳过已经存在的文件"""
+        while True:
+            self.sequence += 1
+            path = os.path.join(dirname, f"part-{os.getpid()}-{int(time.time())}-{self.sequence}.parquet")
+            if not os.path.exists(path):
+                return path
+
+    def write_row_group(self, dirname):
+        tables = self.frames.pop(dirname, [])
+        rows = self.buffers.pop(dirname, None)
+        if rows:
+            tables.append(self.to_table(rows))
+        if tables:
+            table = pa.concat_tables(tables)
+            self.get_writer(dirname).write_table(table, row_group_size=table.num_rows)
+            self.rows += table.num_rows
+
+    def flush(self):
+        """ 把所有分区缓存的记录写成 row group"""
+        with self.lock:
+            for dirname in set(self.buffers) | set(self.frames):
+                self.write_row_group(dirname)
+
+    def get_partition_files(self, dirname):
+        """ 写入分区缓存的记录, 关闭分区正在写入的文件(没有关闭的 parquet 文件不能读取), 返回分区的所有文件
+
+        调用时需要持有 self.lock, 之后再写这个分区时新建文件.
+        """
+        self.write_row_group(dirname)
+        writer = self.writers.pop(dirname, None)
+        if writer is not None:
+            writer.close()
+        return sorted(glob.glob(os.path.join(dirname, "*.parquet")))
+
+    def read_partition(self, record, columns=None) -> pd.DataFrame:
+        """ 读取 record 所在分区已经写入的所有记录
+
+        Parameters
+        ----------
+        record : dict, 只需要包含分区列, 如 {"city": "北京"}
+        columns : list, 读取的列, 为空时读取全部
+        """
+        with self.lock:
+            paths = self.get_partition_files(self.get_partition_dir(record))
+            tables = [pq.ParquetFile(path).read(columns=columns) for path in paths]
+        schema = self.schema if columns is None else pa.schema([self.schema.field(name) for name in columns])
+        return pa.concat_tables(tables or [schema.empty_table()]).to_pandas(date_as_object=False)
+
+    def drop_rows(self, record, drop):
+        """ 删除 record 所在分区中的一部分记录, 用于重新抓取已经保存了一部分的数据之前
+
+        剩下的记录先写到一个新文件, 再删除原来的文件, 中途退出时最多留下重复的记录, 不会丢失记录.
+
+        Parameters
+        ----------
+        record : dict, 只需要包含分区列, 如 {"city": "北京"}
+        drop : callable, DataFrame -> bool Series, 为 True 的行删除
+
+        Returns
+        -------
+        int, 删除的行数
+        """
+        dirname = self.get_partition_dir(record)
+        with self.lock:
+            paths = self.get_partition_files(dirname)
+            if not paths:
+                return 0
+            df = pa.concat_tables([pq.ParquetFile(path).read() for path in paths]).to_pandas(date_as_object=False)
+            mask = drop(df)
+            if not mask.any():
+                return 0
+            table = pa.Table.from_pandas(df[~mask], schema=self.schema, preserve_index=False)
+            path = self.new_part_path(dirname)
+            pq.write_table(table, f"{path}.tmp", compression="snappy")
+            os.replace(f"{path}.tmp", path)
+            for old in paths:
+                os.remove(old)
+        return int(mask.sum())
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers.clear()
+        logger.info(f"parquet {self.root}: {self.rows} rows")
+
+
+_root = PARQUET_DIR
+_options = {}
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def configure_parquet(root=PARQUET_DIR, **kwargs):
+    """ 设置 parquet 输出目录, root 为空时不输出 parquet, kwargs 传给 ParquetSink"""
+    global _root, _options
+    if root and pa is None:
+        raise ImportError("parquet output needs pyarrow, pip install pyarrow")
+    close_parquet()
+    with _sinks_lock:
+        _root, _options = root, kwargs
+
+
+def get_parquet_sink(kind):
+    """ 获取共享的 ParquetSink, 没有设置输出目录时返回 None"""
+    if not _root:
+        return None
+    with _sinks_lock:
+        if kind not in _sinks:
+            _sinks[kind] = ParquetSink(_root, kind, **_options)
+        return _sinks[kind]
+
+
+def save_record(kind, record):
+    """ 设置了 parquet 输出目录时写入一条记录"""
+    sink = get_parquet_sink(kind)
+    if sink is not None:
+        sink.write(record)
+
+
+def read_parquet(kind, root=None, columns=None, filters=None) -> pd.DataFrame:
+    """ 读取一种记录的整个数据集, 分区列(如 city)作为普通列返回
+
+    Parameters
+    ----------
+    kind : str, 记录类型
+    root : str, 数据集根目录, 默认为 configure_parquet 设置的目录
+    columns : list, 读取的列, 为空时读取全部
+    filters : list, pyarrow 的过滤条件, 如 [("city", "in", ["北京", "上海"])], 按分区过滤时只读取对应的目录
+    """
+    path = os.path.join(root or _root, kind)
+    return pq.read_table(path, columns=columns, filters=filters, partitioning="hive").to_pandas(date_as_object=False)
+
+
+def close_parquet():
+    with _sinks_lock:
+        sinks = list(_sinks.values())
+        _sinks.clear()
+    for sink in sinks:
+        sink.close()
+
+
+atexit.register(close_parquet)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 按域名限速的令牌桶, 用 AIMD 根据响应情况自动调整速率
+
+@ModifyRecord:
+"""
+import threading
+import time
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from config import RATE_LIMIT, RATE_SLOW_SECONDS
+
+
+def get_domain(url):
+    """ https://sh.lianjia.com/chengjiao/ -> lianjia.com, 同一个站点的子域名共享限速"""
+    host = urlsplit(url).hostname or url
+    return ".".join(host.split(".")[-2:])
+
+
+class TokenBucket:
+    """ 令牌桶, 令牌不足时返回需要等待的秒数"""
+
+    def __init__(self, rate, capacity=1.0):
+        """
+        Parameters
+        ----------
+        rate : float, 每秒产生的令牌数, 即每秒请求数
+        capacity : float, 桶的容量, 允许的突发请求数
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ 预定一个令牌, 返回需要等待的秒数, 并发调用时依次排队"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class AdaptiveRateLimiter:
+    """ 每个域名一个 TokenBucket, 所有爬虫共享
+
+    响应正常时速率线性增加, 直到 rate; 出错, 非 200 或者响应超过 slow_seconds 时速率减半, 最低 min_rate.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, min_rate=None, slow_seconds=RATE_SLOW_SECONDS, decrease=0.5, burst=1.0):
+        """
+        Parameters
+        ----------
+        rate : float, 目标速率(每秒请求数), 也是速率上限
+        min_rate : float, 速率下限, 默认 rate / 20
+        slow_seconds : float, 响应时间超过这个值视为过载
+        decrease : float, 过载时速率乘以这个系数
+        burst : float, 允许的突发请求数
+        """
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 20
+        self.increase = rate / 20
+        self.decrease = decrease
+        self.slow_seconds = slow_seconds
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, url):
+        domain = get_domain(url)
+        with self.lock:
+            if domain not in self.buckets:
+                self.buckets[domain] = TokenBucket(self.max_rate / 2, self.burst)
+            return self.buckets[domain]
+
+    def reserve(self, url):
+        """ 返回请求 url 前需要等待的秒数, asyncio 中配合 asyncio.sleep 使用"""
+        return self.get_bucket(url).reserve()
+
+    def acquire(self, url):
+        """ 阻塞直到可以请求 url"""
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    def feedback(self, url, ok=True, elapsed=0.0):
+        """ 根据响应调整 url 所在域名的速率
+
+        Parameters
+        ----------
+        url : str
+        ok : bool, 请求是否成功并返回 200
+        elapsed : float, 响应时间(秒)
+        """
+        bucket = self.get_bucket(url)
+        with bucket.lock:
+            old_rate = bucket.rate
+            if ok and elapsed < self.slow_seconds:
+                bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+            else:
+                bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+        if bucket.rate < old_rate:
+            logger.warning(f"{get_domain(url)} slow down: {old_rate:.3f} -> {bucket.rate:.3f} req/s")
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def configure_limiter(rate=RATE_LIMIT, **kwargs):
+    """ 重新创建共享的限速器, rate 为每个域名的目标速率(每秒请求数)"""
+    global _limiter
+    with _limiter_lock:
+        _limiter = AdaptiveRateLimiter(rate, **kwargs)
+    return _limiter
+
+
+def get_limiter():
+    """ 获取共享的限速器"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = AdaptiveRateLimiter()
+    return _limiter
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 从详情页内嵌的 <script> 中取出 houseCode, resblockPosition 等页面变量
+
+@ModifyRecord:
+"""
+import re
+
+import js2xml
+from loguru import logger
+from lxml import etree
+
+PAGE_VARS = ("houseCode", "city_name", "resblockName", "resblockPosition")
+
+# 从左到右扫描 script, 注释和字符串整体作为一个 token 跳过, 注释里和字符串里的 name: 'value' 不会被当作属性
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+    |(?<![\w$.])(?:(?P<key>[A-Za-z_$][\w$]*)|(?P<quote>['"])(?P<quoted_key>[\w$]+)(?P=quote))
+        \s*:\s*(?P<value_quote>['"])(?P<value>(?:\\.|(?!(?P=value_quote))[^\\\n])*)(?P=value_quote)
+    |(?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)
+    """, re.S | re.X)
+
+
+def extract_page_vars(script, names=PAGE_VARS):
+    """ 用正则取 name: 'value', "name": "value" 这样的对象属性
+
+    有变量取不到, 含有转义字符, 或者同一个变量有多个不同的值(嵌套的对象里同名的属性)时返回 None, 交给 js2xml.
+    """
+    values = {}
+    for match in TOKEN_PATTERN.finditer(script):
+        name = match.group("key") or match.group("quoted_key")
+        if name in names:
+            values.setdefault(name, set()).add(match.group("value"))
+    page_vars = {}
+    for name in names:
+        if len(values.get(name, ())) != 1:
+            return None
+        value, = values[name]
+        if "\\" in value:
+            return None
+        page_vars[name] = value
+    return page_vars
+
+
+def extract_page_vars_js2xml(script, names=PAGE_VARS):
+    """ 用 js2xml 解析整个 script, 速度慢, 只作为备用"""
+    script = js2xml.parse(script, encoding='utf-8', debug=False)
+    script_selector = etree.HTML(js2xml.pretty_print(script))
+    page_vars = {}
+    for name in names:
+        values = script_selector.xpath(f"//property[@name = '{name}']/string/text()")
+        if values:
+            page_vars[name] = values[0]
+    return page_vars
+
+
+def get_page_vars(script, names=PAGE_VARS):
+    """ 先用正则, 失败时再用 js2xml
+
+    Returns
+    -------
+    dict, {"houseCode": "101109348392", "resblockPosition": "116.35,39.91", ...}, 取不到的变量不在结果里
+    """
+    page_vars = extract_page_vars(script, names)
+    if page_vars is None:
+        logger.debug("fast page vars extraction failed, fall back to js2xml")
+        page_vars = extract_page_vars_js2xml(script, names)
+    return page_vars
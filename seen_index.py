@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 持久化的已抓取 url 索引, 多个进程可以共享同一个文件去重
+
+@ModifyRecord:
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+from urllib.parse import urlsplit
+
+# 链家房子 /chengjiao/101109348392.html, 小区 /xiaoqu/1111027377964/
+CODE_PATTERN = re.compile(r"/(\d{1,18})(?:\.html)?/?$")
+
+
+def url_key(url):
+    """ url -> 64 位整数
+
+    链家的房子代号/小区编号直接作为正整数保存, 其它 url 取 blake2b 64 位摘要作为负整数, 两者不会冲突.
+    """
+    match = CODE_PATTERN.search(urlsplit(url).path)
+    if match:
+        return int(match.group(1))
+    digest = hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+    return -(int.from_bytes(digest, "big") >> 1) - 1
+
+
+class SeenIndex:
+    """ sqlite 里按整数 key 排序保存的集合, 每个 url 约占 10 字节
+
+    add 是原子操作, 多个进程同时 add 同一个 url 只有一个返回 True.
+    文件不会被删除, 清空时在事务里删除所有记录, 其它进程已经打开的连接仍然有效.
+    """
+
+    def __init__(self, path, reset=False):
+        """
+        Parameters
+        ----------
+        path : str, sqlite 文件路径, ":memory:" 时只在内存中
+        reset : bool, 清空已有的记录, 开始新的一轮抓取时设置, 加入正在进行的抓取的进程不要设置
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen (key INTEGER PRIMARY KEY)")
+        if reset:
+            self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __contains__(self, url):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM seen WHERE key = ?", (url_key(url),)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+
+    def add(self, url):
+        """ 记录 url, 之前没有见过时返回 True"""
+        with self.lock:
+            return self.conn.execute("INSERT OR IGNORE INTO seen VALUES (?)", (url_key(url),)).rowcount == 1
+
+    def add_many(self, urls):
+        """ 一个事务里记录多个 url, 返回每个 url 是否是新的"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = [self.conn.execute("INSERT OR IGNORE INTO seen VALUES (?)", (url_key(url),)).rowcount == 1
+                          for url in urls]
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def clear(self):
+        """ 在一个事务里删除所有记录"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM seen")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 长期打开的输出文件, 记录先缓存在内存里, 成批写入, 所有爬虫共享
+
+@ModifyRecord:
+"""
+import atexit
+import csv
+import io
+import json
+import os
+import threading
+import time
+
+from loguru import logger
+
+from config import SINK_BATCH_SIZE, SINK_FLUSH_INTERVAL, SINK_FSYNC, SINK_MAX_BYTES
+
+FSYNC_NEVER = "never"  # 交给操作系统
+FSYNC_CLOSE = "close"  # 关闭文件时 fsync
+FSYNC_FLUSH = "flush"  # 每批写入后 fsync
+
+
+class JsonLinesSink:
+    """ 每行一个 json 的输出文件
+
+    记录先放在内存里, 满 batch_size 条或者距离上次写入超过 flush_interval 秒时一次写入,
+    文件超过 max_bytes 时改名为 {name}.{n}{ext}, 再写新的文件.
+    """
+
+    def __init__(self, path, batch_size=SINK_BATCH_SIZE, flush_interval=SINK_FLUSH_INTERVAL, fsync=SINK_FSYNC,
+                 max_bytes=SINK_MAX_BYTES):
+        """
+        Parameters
+        ----------
+        path : str, 文件路径, 追加写入
+        batch_size : int, 缓存多少条记录后写入
+        flush_interval : float, 最长多少秒写入一次
+        fsync : str, "never" / "close" / "flush"
+        max_bytes : int, 文件大小上限, 0 时不切分
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.flushed = time.monotonic()
+        self.fd = None
+        self.open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.fd = open(self.path, "a", encoding="utf-8", newline="")
+
+    def format(self, records):
+        """ 记录 -> 写入文件的文本"""
+        return "".join((record if isinstance(record, str) else json.dumps(record)) + "\n" for record in records)
+
+    def write(self, record):
+        """ 写入一条记录, dict 或者已经序列化的 str"""
+        with self.lock:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.batch_size or time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush()
+
+    def write_many(self, records):
+        with self.lock:
+            self.buffer.extend(records)
+            if len(self.buffer) >= self.batch_size or time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """ 把缓存的记录写入文件"""
+        with self.lock:
+            if self.buffer:
+                self.fd.write(self.format(self.buffer))
+                self.buffer = []
+                self.fd.flush()
+                if self.fsync == FSYNC_FLUSH:
+                    os.fsync(self.fd.fileno())
+                if self.max_bytes and self.fd.tell() >= self.max_bytes:
+                    self.rotate()
+            self.flushed = time.monotonic()
+
+    def rotate(self):
+        """ 当前文件改名为下一个编号, 重新打开一个空文件"""
+        with self.lock:
+            self.fd.close()
+            root, ext = os.path.splitext(self.path)
+            index = 1
+            while os.path.exists(f"{root}.{index}{ext}"):
+                index += 1
+            os.replace(self.path, f"{root}.{index}{ext}")
+            logger.info(f"rotate {self.path} -> {root}.{index}{ext}")
+            self.open()
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+            self.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self.fd.fileno())
+            self.fd.close()
+            self.fd = None
+
+
+class CsvSink(JsonLinesSink):
+    """ csv 输出文件, 新文件(包括切分后的文件)先写表头
+
+    columns 为空时使用第一条记录的 key, 记录里多余的 key 忽略, 缺少的 key 为空.
+    """
+
+    def __init__(self, path, columns=None, **kwargs):
+        self.columns = list(columns) if columns is not None else None
+        super(CsvSink, self).__init__(path, **kwargs)
+
+    def format(self, records):
+        if self.columns is None:
+            self.columns = list(records[0].keys())
+        output = io.StringIO()
+        writer = csv.DictWriter(output, self.columns, extrasaction="ignore", lineterminator="\n")
+        if self.fd.tell() == 0:
+            writer.writeheader()
+        writer.writerows(records)
+        return output.getvalue()
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def _get_sink(cls, path, **kwargs):
+    key = os.path.abspath(path)
+    with _sinks_lock:
+        sink = _sinks.get(key)
+        if sink is None or sink.fd is None:
+            sink = _sinks[key] = cls(path, **kwargs)
+    return sink
+
+
+def get_sink(path, **kwargs):
+    """ 获取 path 对应的共享 JsonLinesSink, 第一次获取时创建"""
+    return _get_sink(JsonLinesSink, path, **kwargs)
+
+
+def get_csv_sink(path, columns=None, **kwargs):
+    """ 获取 path 对应的共享 CsvSink, 第一次获取时创建"""
+    return _get_sink(CsvSink, path, columns=columns, **kwargs)
+
+
+def flush_sinks():
+    """ 写入所有共享 sink 缓存的记录, 读取输出文件之前调用"""
+    with _sinks_lock:
+        sinks = list(_sinks.values())
+    for sink in sinks:
+        if sink.fd is not None:
+            sink.flush()
+
+
+def close_sink(path):
+    with _sinks_lock:
+        sink = _sinks.pop(os.path.abspath(path), None)
+    if sink:
+        sink.close()
+
+
+def close_sinks():
+    with _sinks_lock:
+        sinks = list(_sinks.values())
+        _sinks.clear()
+    for sink in sinks:
+        sink.close()
+
+
+atexit.register(close_sinks)
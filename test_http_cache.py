@@ -0,0 +1,25 @@
+from http_cache import DAY, HOUR, ResponseCache
+
+DETAIL_URL = "https://bj.lianjia.com/ershoufang/101109348392.html"
+
+
+def test_listing_roots_use_listing_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    assert cache.get_ttl("https://bj.lianjia.com/ershoufang/chaoyang/") == 6 * HOUR
+    assert cache.get_ttl("https://bj.lianjia.com/ershoufang/chaoyang/pg2") == 6 * HOUR
+    assert cache.get_ttl("https://bj.lianjia.com/xiaoqu/chaoyang/") == 6 * HOUR
+    assert cache.get_ttl(DETAIL_URL) is None
+    assert cache.get_ttl("https://bj.lianjia.com/xiaoqu/1111027377964/") is None
+    assert cache.get_ttl("https://bj.lianjia.com/") == 3 * DAY
+    cache.close()
+
+
+def test_redirected_and_blocked_pages_are_not_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.put(DETAIL_URL, b"<html>login</html>", "utf-8", redirected=True)
+    assert cache.get(DETAIL_URL) is None
+    cache.put(DETAIL_URL, "<html>人机认证</html>".encode("utf-8"), "utf-8")
+    assert cache.get(DETAIL_URL) is None
+    cache.put(DETAIL_URL, b"<html>house</html>", "utf-8")
+    assert cache.get(DETAIL_URL) == (b"<html>house</html>", "utf-8")
+    cache.close()
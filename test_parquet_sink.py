@@ -0,0 +1,34 @@
+import pandas as pd
+
+from normalize import normalize_aqi
+from parquet_sink import ParquetSink, read_parquet
+
+
+def test_records_are_converted_by_normalize(tmp_path):
+    root = str(tmp_path)
+    with ParquetSink(root, "house") as sink:
+        sink.write({"城市": "北京", "区": "朝阳", "房间代号": 101, "单价": "52,345元/平米", "挂牌时间": "2020.06.20",
+                    "建筑年代": "2005年建", "房屋朝向": " 南 ", "网址": ""})
+        sink.write({"城市": "北京", "区": "朝阳", "lng": 116.3})
+    df = read_parquet("house", root)
+    first = df.iloc[0]
+    assert first["房间代号"] == "101"
+    assert first["单价"] == 52345.0
+    assert first["挂牌时间"] == pd.Timestamp("2020-06-20")
+    assert first["建筑年代"] == 2005
+    assert first["房屋朝向"] == "南"
+    assert pd.isna(first["网址"])
+    assert df.iloc[1]["lng"] == 116.3
+
+
+def test_text_records_and_frames_match(tmp_path):
+    rows = [{"city": "c", "日期": "2020-01-02", "AQI": "50", "质量等级": "优"},
+            {"city": "c", "日期": "平均", "AQI": "50"}]
+    with ParquetSink(str(tmp_path / "records"), "aqi") as sink:
+        sink.write_many(rows)
+    with ParquetSink(str(tmp_path / "frames"), "aqi") as sink:
+        sink.write_frame(normalize_aqi(rows))
+    records = read_parquet("aqi", str(tmp_path / "records"))
+    frames = read_parquet("aqi", str(tmp_path / "frames"))
+    assert len(records) == 1
+    pd.testing.assert_frame_equal(records, frames)
@@ -0,0 +1,36 @@
+from script_vars import extract_page_vars, extract_page_vars_js2xml, get_page_vars
+
+SCRIPT = """
+require(['ershoufang/sellDetail/detailV3'], function (main) {
+    // houseCode: '000000000000',
+    /* resblockName: '旧小区',
+       city_name: '上海', */
+    main({
+        ajaxroot: 'https://ajax.api.lianjia.com/',
+        title: "resblockPosition: '0,0'",
+        houseCode: '101109348392',
+        "city_name": "北京",
+        resblockName: '阜成门北大街',
+        resblockPosition: '116.35,39.91'
+    });
+});
+"""
+
+
+def test_fast_path_matches_js2xml():
+    page_vars = extract_page_vars(SCRIPT)
+    assert page_vars == {"houseCode": "101109348392", "city_name": "北京", "resblockName": "阜成门北大街",
+                         "resblockPosition": "116.35,39.91"}
+    assert page_vars == extract_page_vars_js2xml(SCRIPT)
+
+
+def test_ambiguous_values_fall_back_to_js2xml():
+    script = SCRIPT.replace("main({", "main({\n        house: {houseCode: '1'},")
+    assert extract_page_vars(script) is None
+    assert get_page_vars(script) == extract_page_vars_js2xml(script)
+
+
+def test_missing_var_falls_back_to_js2xml():
+    script = SCRIPT.replace("houseCode: '101109348392',", "")
+    assert extract_page_vars(script) is None
+    assert "houseCode" not in get_page_vars(script)
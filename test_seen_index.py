@@ -0,0 +1,20 @@
+from seen_index import SeenIndex
+
+URL = "https://bj.lianjia.com/ershoufang/101109348392.html"
+
+
+def test_workers_share_the_index(tmp_path):
+    path = str(tmp_path / "seen.db")
+    with SeenIndex(path, reset=True) as first, SeenIndex(path) as second:
+        assert first.add(URL)
+        assert not second.add(URL)
+
+
+def test_reset_keeps_other_connections_working(tmp_path):
+    path = str(tmp_path / "seen.db")
+    with SeenIndex(path) as first:
+        first.add(URL)
+        with SeenIndex(path, reset=True) as second:
+            assert len(first) == 0
+            assert second.add(URL)
+            assert not first.add(URL)
@@ -0,0 +1,149 @@
+import time
+
+import fakeredis
+import pytest
+
+from work_queue import RedisProducer, RedisWorkQueue, SqliteWorkQueue, WorkQueue
+
+
+@pytest.fixture(params=["redis", "sqlite"])
+def queue(request, tmp_path):
+    if request.param == "redis":
+        yield RedisWorkQueue(fakeredis.FakeRedis(decode_responses=True), "test", visibility_timeout=0.1,
+                             max_retries=1)
+    else:
+        with SqliteWorkQueue(str(tmp_path / "queue.db"), "test", visibility_timeout=0.1, max_retries=1) as queue:
+            yield queue
+
+
+def expire():
+    time.sleep(0.15)
+
+
+def test_work_queue_is_abstract():
+    with pytest.raises(TypeError):
+        WorkQueue()
+
+
+def test_claim_and_ack(queue):
+    queue.put(["a", "b"])
+    claims = queue.claim(2)
+    assert sorted(claim.item for claim in claims) == ["a", "b"]
+    assert queue.claim(1) == []
+    assert all(queue.ack(claim) for claim in claims)
+    assert queue.stats()["pending"] == 0
+    assert queue.stats()["processing"] == 0
+
+
+def test_expired_claim_is_requeued(queue):
+    queue.put(["a"])
+    claim, = queue.claim(1)
+    expire()
+    assert queue.requeue_expired() == 1
+    again, = queue.claim(1)
+    assert again.item == "a"
+    assert again.token != claim.token
+
+
+def test_late_ack_keeps_reclaimed_task(queue):
+    queue.put(["a"])
+    first, = queue.claim(1)
+    expire()
+    queue.requeue_expired()
+    second, = queue.claim(1)
+    # 第一个消费者的租约已经到期, 它的 ack 不能删掉第二个消费者取出的任务
+    assert not queue.ack(first)
+    assert not queue.nack(first)
+    assert queue.stats()["processing"] == 1
+    expire()
+    assert queue.requeue_expired() == 1
+    assert queue.stats()["dead"] == 1
+    assert not queue.ack(second)
+
+
+def test_nack_retries_then_dead(queue):
+    queue.put(["a"])
+    claim, = queue.claim(1)
+    assert queue.nack(claim)
+    claim, = queue.claim(1)
+    assert queue.nack(claim)
+    assert queue.stats()["dead"] == 1
+    assert queue.requeue_dead() == 1
+    claim, = queue.claim(1)
+    assert queue.ack(claim)
+
+
+def test_sweep_does_not_touch_fresh_claims(queue):
+    queue.put(["a"])
+    claim, = queue.claim(1)
+    # 其它消费者在租约到期前检查, 刚取出的任务不能被重新入队
+    assert queue.requeue_expired() == 0
+    assert queue.ack(claim)
+    expire()
+    assert queue.requeue_expired() == 0
+    assert queue.claim(1) == []
+    assert queue.stats()["pending"] == 0
+    assert queue.stats()["processing"] == 0
+
+
+def test_redis_claim_retries_when_queue_changes():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    queue = RedisWorkQueue(client, "test")
+    queue.put(["a", "b"])
+    claim_tasks = queue._claim
+    calls = []
+
+    def claim_while_producing(pipe, count):
+        # WATCH 之后生产者又推送了任务, 事务失败后重新读取
+        calls.append(count)
+        if len(calls) == 1:
+            client.lpush("test", "c")
+        return claim_tasks(pipe, count)
+
+    queue._claim = claim_while_producing
+    claims = queue.claim(2)
+    assert len(calls) == 2
+    assert [claim.item for claim in claims] == ["a", "b"]
+    assert client.lrange("test", 0, -1) == ["c"]
+    assert client.hlen("test:claims") == 2
+
+
+class FailingPipeline:
+    """ 第一次 execute 含有 command 的 pipeline 时抛出异常"""
+
+    def __init__(self, client, command):
+        self.client = client
+        self.command = command
+        self.failed = False
+        self.pipeline = client.pipeline
+
+    def __call__(self, *args, **kwargs):
+        pipe = self.pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def failing_execute(*execute_args, **execute_kwargs):
+            commands = [args[0] for args, _ in pipe.command_stack]
+            if not self.failed and self.command in commands:
+                self.failed = True
+                pipe.reset()
+                raise ConnectionError("redis down")
+            return execute(*execute_args, **execute_kwargs)
+
+        pipe.execute = failing_execute
+        return pipe
+
+
+@pytest.mark.parametrize("command", ["SADD", "LPUSH"])
+def test_producer_keeps_batch_when_push_fails(command):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    client.pipeline = FailingPipeline(client, command)
+    producer = RedisProducer(client, "test", batch_size=100)
+    for item in ["a", "b", "c"]:
+        producer.add(item)
+    with pytest.raises(ConnectionError):
+        producer.flush()
+    assert producer.buffered == 3
+    producer.add("a")
+    assert producer.flush() == 3
+    assert sorted(client.lrange("test", 0, -1)) == ["a", "b", "c"]
+    assert producer.buffered == 0
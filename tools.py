@@ -8,12 +8,21 @@ Created on 2020/7/7 11:54
 
 @ModifyRecord:
 """
-import json
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
 from retry import retry
 
+from config import DISCOVERY_WORKERS, HTTP_POOL_SIZE, HTTP_TIMEOUT
+from http_cache import get_cache
+from rate_limit import get_limiter
+from sinks import get_sink
+
 ProxyPoolUrl = 'http://62.234.77.96:5555/random'
 
 ua_list = [
@@ -59,9 +68,88 @@ def get_useragent():
     return random.choice(ua_list)
 
 
+class HttpClient:
+    """ 所有爬虫共享的 requests.Session, 每个 host 复用 keep-alive 连接"""
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+        """
+        Parameters
+        ----------
+        pool_size : int, 每个 host 的连接池大小, 也是缓存的 host 连接池个数
+        timeout : int, 请求超时时间(秒)
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def cached_response(url, content, encoding):
+        response = requests.Response()
+        response.status_code = requests.codes.ok
+        response.url = url
+        response.encoding = encoding
+        response._content = content
+        return response
+
+    def get(self, url, headers=None, **kwargs):
+        """ 带随机 User-Agent 的 GET 请求, 请求前按域名限速, 请求后把响应情况反馈给限速器
+
+        命中本地缓存时直接返回, 不占用限速
+        """
+        cache = get_cache()
+        cached = cache.get(url) if cache else None
+        if cached:
+            return self.cached_response(url, *cached)
+        _headers = {'User-Agent': get_useragent(), }
+        _headers.update(headers or {})
+        kwargs.setdefault("timeout", self.timeout)
+        limiter = get_limiter()
+        limiter.acquire(url)
+        start = time.monotonic()
+        try:
+            response = self.session.get(url, headers=_headers, **kwargs)
+        except Exception:
+            limiter.feedback(url, ok=False)
+            raise
+        limiter.feedback(url, response.status_code == requests.codes.ok, time.monotonic() - start)
+        if cache and response.status_code == requests.codes.ok:
+            cache.put(url, response.content, response.encoding, redirected=bool(response.history))
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure_client(pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+    """ 重新创建共享的 HttpClient, 在爬虫启动前调用"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HttpClient(pool_size, timeout)
+    return _client
+
+
+def get_client():
+    """ 获取共享的 HttpClient"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HttpClient()
+    return _client
+
+
 def get_random_proxy():
     """ 获取随机代理"""
-    proxy = requests.get(ProxyPoolUrl).text.strip()
+    proxy = get_client().get(ProxyPoolUrl).text.strip()
     return {'http': 'http://' + proxy}
 
 
@@ -73,24 +161,45 @@ def requests_get(url):
     ----------
     url : str, url 链接
     """
-    headers = {'User-Agent': get_useragent(), }
     # proxy = get_random_proxy()
-    response = requests.get(url=url, headers=headers)
+    response = get_client().get(url)
     if response.status_code != requests.codes.ok:
         raise Exception('request_get error!!!!')
     return response
 
 
+def thread_map(func, items, workers=DISCOVERY_WORKERS):
+    """ 用线程池并发执行 func(item), 按 items 的顺序逐个返回结果, 出错的结果为 None
+
+    请求都经过共享的 HttpClient, 并发线程数只决定同时等待的请求数, 总速率仍然由限速器控制.
+
+    Parameters
+    ----------
+    func : callable
+    items : iterable
+    workers : int, 线程数, 1 时在当前线程里逐个执行
+    """
+
+    def call(item):
+        try:
+            return func(item)
+        except Exception as err:
+            logger.error(f"{item}: {err}")
+            return None
+
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield call(item)
+        return
+    with ThreadPoolExecutor(min(workers, len(items))) as executor:
+        yield from executor.map(call, items)
+
+
 def save_json(mapping, save_path):
-    """ 保存成json"""
-    if not isinstance(mapping, str):
-        mapping = json.dumps(mapping)
-    with open(save_path, "a+") as fd:
-        fd.write(mapping + "\n")
+    """ 保存成json, 写入 save_path 共享的 sink, 成批落盘"""
+    get_sink(save_path).write(mapping)
 
 
 def bulk_save_json(records, save_path):
-    with open(save_path, "a+") as fd:
-        for record in records:
-            record = json.dumps(record)
-            fd.write(record + "\n")
+    get_sink(save_path).write_many(records)
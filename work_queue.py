@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 可靠的任务队列, 取出的任务在确认前一直保留, 超时未确认的任务重新入队, 多次失败的任务进入死信队列
+
+@ModifyRecord:
+"""
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+from loguru import logger
+
+from config import (WORK_QUEUE_BATCH_SIZE, WORK_QUEUE_MAX_RETRIES, WORK_QUEUE_PUSH_BATCH_SIZE, WORK_QUEUE_PUSH_INTERVAL,
+                    WORK_QUEUE_VISIBILITY_TIMEOUT)
+
+# claim 取出的一个任务, token 只属于这一次取出, 租约到期后重新取出的同一个任务有新的 token
+Claim = namedtuple("Claim", ["token", "item"])
+
+
+class WorkQueue(ABC):
+    """ 任务队列的接口, 任务为字符串(一般是 json)
+
+    claim 取出的任务带一个租约, 租约到期前没有 ack 或者 nack 的任务(处理它的进程挂了)由 requeue_expired 重新入队.
+    nack 和租约到期都计为一次重试, 超过 max_retries 次的任务放入死信队列, 不再分发.
+    ack 和 nack 按 claim 返回的 token 确认, 租约已经到期的 token 不再有效, 迟到的确认不会影响任务重新取出后的处理.
+    """
+
+    def __init__(self, visibility_timeout=WORK_QUEUE_VISIBILITY_TIMEOUT, max_retries=WORK_QUEUE_MAX_RETRIES):
+        """
+        Parameters
+        ----------
+        visibility_timeout : float, 租约秒数, 要大于处理一批任务的时间
+        max_retries : int, 最多重试次数
+        """
+        self.visibility_timeout = visibility_timeout
+        self.max_retries = max_retries
+
+    @abstractmethod
+    def put(self, items):
+        """ 添加任务"""
+
+    @abstractmethod
+    def claim(self, count=1, timeout=0):
+        """ 取出最多 count 个任务, 队列为空时最多等待 timeout 秒, 返回 Claim 列表"""
+
+    @abstractmethod
+    def ack(self, claim):
+        """ 任务完成, 从队列中删除, 返回 claim 是否还有效"""
+
+    @abstractmethod
+    def nack(self, claim):
+        """ 任务失败, 重新入队或者放入死信队列, 返回 claim 是否还有效"""
+
+    @abstractmethod
+    def requeue_expired(self):
+        """ 租约到期的任务按 nack 处理, 返回处理的任务数"""
+
+    @abstractmethod
+    def requeue_dead(self):
+        """ 死信队列中的任务清零重试次数后重新入队, 返回任务数"""
+
+    @abstractmethod
+    def stats(self):
+        """ {"pending": 等待的任务数, "processing": 处理中的任务数, "dead": 死信任务数}"""
+
+    def consume(self, handler, batch_size=WORK_QUEUE_BATCH_SIZE, timeout=5, exit_when_empty=False):
+        """ 循环取出任务交给 handler 处理, handler 正常返回时 ack, 抛出异常时 nack
+
+        Parameters
+        ----------
+        handler : callable, handler(item)
+        batch_size : int, 每次预取的任务数, 同一批任务共用一个租约
+        timeout : float, 队列为空时每次等待的秒数
+        exit_when_empty : bool, 没有等待和处理中的任务时返回, 否则一直运行
+        """
+        reaped = 0
+        done = 0
+        while True:
+            # 不需要每批都检查过期的租约
+            if time.monotonic() - reaped >= self.visibility_timeout / 10:
+                expired = self.requeue_expired()
+                if expired:
+                    logger.warning(f"requeue {expired} expired tasks")
+                reaped = time.monotonic()
+            claims = self.claim(batch_size, timeout)
+            if not claims:
+                if exit_when_empty:
+                    stats = self.stats()
+                    if not stats["pending"] and not stats["processing"]:
+                        logger.info(f"queue drained, {done} tasks done, {stats['dead']} dead")
+                        return done
+                continue
+            for claim in claims:
+                try:
+                    handler(claim.item)
+                except Exception as err:
+                    logger.error(f"task failed: {claim.item}, err: {err}")
+                    self.nack(claim)
+                    continue
+                if not self.ack(claim):
+                    logger.warning(f"lease expired before ack, task requeued: {claim.item}")
+                done += 1
+
+
+class RedisWorkQueue(WorkQueue):
+    """ redis 上的任务队列, 多台机器的多个进程共享
+
+    name            等待的任务, 生产者 lpush, 消费者从右边取
+    name:claims     哈希, 每次取出生成的 token -> 任务, 即处理中的任务
+    name:leases     有序集合, token -> 租约到期时间
+    name:retries    哈希, 任务 -> 已重试次数
+    name:dead       死信队列
+    取出任务时在同一个 WATCH/MULTI 事务里从等待队列删除并写入 token 和租约, 重新入队时在同一个事务里
+    删除 token 并放回等待队列, 任务任何时候都只在一个地方, 进程在两步之间挂掉也不会丢失或者多出任务.
+    ack, nack 和租约到期都要先删掉 token, 租约到期后迟到的 ack 不会删掉其它消费者重新取出的同一个任务.
+    不需要 lua 脚本, 可以用 fakeredis 测试.
+    """
+
+    def __init__(self, client, name, poll_interval=0.5, **kwargs):
+        """
+        Parameters
+        ----------
+        client : redis.Redis
+        name : str, 队列名, 和生产者 lpush 的 key 相同
+        poll_interval : float, claim 等待任务时每次检查的间隔秒数
+        """
+        super(RedisWorkQueue, self).__init__(**kwargs)
+        self.client = client
+        self.name = name
+        self.poll_interval = poll_interval
+        self.claims = f"{name}:claims"
+        self.leases = f"{name}:leases"
+        self.retries = f"{name}:retries"
+        self.dead = f"{name}:dead"
+
+    def put(self, items):
+        items = list(items)
+        if items:
+            self.client.lpush(self.name, *items)
+
+    def _claim(self, pipe, count):
+        # WATCH 之后 pipe 立即执行命令, multi 之后的命令在 execute 时原子执行, 等待队列被修改时整个函数重试
+        items = pipe.lrange(self.name, -count, -1)
+        if not items:
+            return []
+        # 最右边的任务最早入队
+        claims = [Claim(uuid.uuid4().hex, item) for item in reversed(items)]
+        deadline = time.time() + self.visibility_timeout
+        pipe.multi()
+        pipe.ltrim(self.name, 0, -len(items) - 1)
+        pipe.hset(self.claims, mapping={claim.token: claim.item for claim in claims})
+        pipe.zadd(self.leases, {claim.token: deadline for claim in claims})
+        return claims
+
+    def claim(self, count=1, timeout=0):
+        stop = time.monotonic() + timeout
+        while True:
+            claims = self.client.transaction(lambda pipe: self._claim(pipe, count), self.name,
+                                             value_from_callable=True)
+            if claims or time.monotonic() >= stop:
+                return claims
+            time.sleep(min(self.poll_interval, max(0.0, stop - time.monotonic())))
+
+    def ack(self, claim):
+        if not self.client.hdel(self.claims, claim.token):
+            return False
+        # token 已经删除, 这里挂掉时只留下没用的租约和重试次数, requeue_expired 会清理租约
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrem(self.leases, claim.token)
+        pipe.hdel(self.retries, claim.item)
+        pipe.execute()
+        return True
+
+    def _requeue(self, pipe, claim):
+        if not pipe.hexists(self.claims, claim.token):
+            return None
+        retries = int(pipe.hget(self.retries, claim.item) or 0) + 1
+        pipe.multi()
+        pipe.hdel(self.claims, claim.token)
+        pipe.zrem(self.leases, claim.token)
+        if retries > self.max_retries:
+            pipe.lpush(self.dead, claim.item)
+            pipe.hdel(self.retries, claim.item)
+        else:
+            # 放到队尾, 不会马上被同一个消费者再次取到
+            pipe.lpush(self.name, claim.item)
+            pipe.hset(self.retries, claim.item, retries)
+        return retries
+
+    def requeue(self, claim):
+        """ claim 还有效时计一次重试, 重新入队或者放入死信队列, 返回是否处理了"""
+        retries = self.client.transaction(lambda pipe: self._requeue(pipe, claim), self.claims, self.retries,
+                                          value_from_callable=True)
+        if retries is None:
+            return False
+        if retries > self.max_retries:
+            logger.error(f"task dead after {retries - 1} retries: {claim.item}")
+        return True
+
+    def nack(self, claim):
+        return self.requeue(claim)
+
+    def requeue_expired(self):
+        count = 0
+        for token in self.client.zrangebyscore(self.leases, "-inf", time.time()):
+            item = self.client.hget(self.claims, token)
+            # 已经 ack 的任务只剩下租约; 多个进程同时检查, 或者同时 ack 时只有删除 token 成功的一方处理
+            if item is None:
+                self.client.zrem(self.leases, token)
+            elif self.requeue(Claim(token, item)):
+                count += 1
+        return count
+
+    def requeue_dead(self):
+        count = 0
+        while True:
+            item = self.client.rpoplpush(self.dead, self.name)
+            if item is None:
+                return count
+            self.client.hdel(self.retries, item)
+            count += 1
+
+    def stats(self):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.llen(self.name)
+        pipe.hlen(self.claims)
+        pipe.llen(self.dead)
+        pending, processing, dead = pipe.execute()
+        return {"pending": pending, "processing": processing, "dead": dead}
+
+
+PENDING = 0
+PROCESSING = 1
+DEAD = 2
+DONE = 3
+
+
+class SqliteWorkQueue(WorkQueue):
+    """ sqlite(WAL) 文件上的任务队列, 一台机器上的多个进程共享, 不需要 redis
+
+    每个任务一行, 状态为 PENDING / PROCESSING / DEAD / DONE, 同一个队列里相同的任务只保存一次,
+    完成的任务保留为 DONE, 重复 put 同一个文件不会重复抓取. claim 在 BEGIN IMMEDIATE 事务里
+    选出并标记任务, 多个进程不会取到同一个任务.
+    任务每次重新入队都换一个新的 id, claim 用 id 作为 token, 租约到期后迟到的 ack 找不到这一行.
+    """
+
+    def __init__(self, path, name="default", **kwargs):
+        """
+        Parameters
+        ----------
+        path : str, sqlite 文件路径
+        name : str, 队列名, 一个文件可以保存多个队列
+        """
+        super(SqliteWorkQueue, self).__init__(**kwargs)
+        self.path = path
+        self.name = name
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            queue TEXT NOT NULL,
+            item TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            retries INTEGER NOT NULL DEFAULT 0,
+            deadline REAL,
+            UNIQUE (queue, item))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_queue_state ON tasks (queue, state, id)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def transaction(self, func, *args):
+        """ 在写事务里执行 func(*args), 开始时就拿到写锁, 避免多个进程同时读后写"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def put(self, items):
+        rows = [(self.name, item, PENDING) for item in items]
+        self.transaction(lambda: self.conn.executemany(
+            "INSERT OR IGNORE INTO tasks (queue, item, state) VALUES (?, ?, ?)", rows))
+
+    def _claim(self, count):
+        rows = self.conn.execute("SELECT id, item FROM tasks WHERE queue = ? AND state = ? ORDER BY id LIMIT ?",
+                                 (self.name, PENDING, count)).fetchall()
+        if rows:
+            deadline = time.time() + self.visibility_timeout
+            self.conn.executemany("UPDATE tasks SET state = ?, deadline = ? WHERE id = ?",
+                                  [(PROCESSING, deadline, row[0]) for row in rows])
+        return [Claim(*row) for row in rows]
+
+    def claim(self, count=1, timeout=0):
+        stop = time.monotonic() + timeout
+        while True:
+            claims = self.transaction(self._claim, count)
+            if claims or time.monotonic() >= stop:
+                return claims
+            time.sleep(min(1.0, max(0.0, stop - time.monotonic())))
+
+    def ack(self, claim):
+        return self.transaction(lambda: self.conn.execute(
+            "UPDATE tasks SET state = ?, deadline = NULL WHERE id = ? AND state = ?",
+            (DONE, claim.token, PROCESSING)).rowcount) > 0
+
+    def _requeue(self, token, state, retries):
+        """ 换一个最大的 id 放到队尾, 之前取出的 token 失效"""
+        self.conn.execute("UPDATE tasks SET id = (SELECT MAX(id) + 1 FROM tasks), state = ?, retries = ?, "
+                          "deadline = NULL WHERE id = ?", (state, retries, token))
+
+    def _nack(self, claim):
+        row = self.conn.execute("SELECT retries FROM tasks WHERE id = ? AND state = ?",
+                                (claim.token, PROCESSING)).fetchone()
+        if row is None:
+            return False
+        retries = row[0] + 1
+        if retries > self.max_retries:
+            logger.error(f"task dead after {retries - 1} retries: {claim.item}")
+            self._requeue(claim.token, DEAD, 0)
+        else:
+            self._requeue(claim.token, PENDING, retries)
+        return True
+
+    def nack(self, claim):
+        return self.transaction(self._nack, claim)
+
+    def _requeue_expired(self):
+        rows = self.conn.execute("SELECT id, item FROM tasks WHERE queue = ? AND state = ? AND deadline < ?",
+                                 (self.name, PROCESSING, time.time())).fetchall()
+        for row in rows:
+            self._nack(Claim(*row))
+        return len(rows)
+
+    def requeue_expired(self):
+        return self.transaction(self._requeue_expired)
+
+    def _requeue_dead(self):
+        rows = self.conn.execute("SELECT id FROM tasks WHERE queue = ? AND state = ? ORDER BY id",
+                                 (self.name, DEAD)).fetchall()
+        for row in rows:
+            self._requeue(row[0], PENDING, 0)
+        return len(rows)
+
+    def requeue_dead(self):
+        return self.transaction(self._requeue_dead)
+
+    def stats(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM tasks WHERE queue = ? GROUP BY state", (self.name,))
+            counts = dict(rows.fetchall())
+        return {"pending": counts.get(PENDING, 0), "processing": counts.get(PROCESSING, 0),
+                "dead": counts.get(DEAD, 0), "done": counts.get(DONE, 0)}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class RedisProducer:
+    """ 批量往 redis 队列推送任务, 用集合 {name}:seen 去重, 多台机器发现的相同任务只推送一次
+
+    任务先缓存在内存里, 满 batch_size 个或者距离上次推送超过 flush_interval 秒时推送,
+    每批两次请求: 一个 pipeline 批量 sadd 去重, 一个 pipeline 批量 lpush 新任务.
+    推送失败的任务保留在内存里, 下次推送时重试.
+    """
+
+    def __init__(self, client, name, batch_size=WORK_QUEUE_PUSH_BATCH_SIZE, flush_interval=WORK_QUEUE_PUSH_INTERVAL):
+        """
+        Parameters
+        ----------
+        client : redis.Redis
+        name : str, 队列名
+        batch_size : int, 缓存多少个任务后推送
+        flush_interval : float, 最长多少秒推送一次
+        """
+        self.client = client
+        self.name = name
+        self.seen = f"{name}:seen"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.buffer = []
+        # key 已经 sadd 成功但是 lpush 失败的任务
+        self.unpushed = []
+        self.flushed = time.monotonic()
+        self.pushed = 0
+        self.duplicated = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def add(self, item, key=None):
+        """ 添加一个任务
+
+        Parameters
+        ----------
+        item : str, 任务
+        key : str, 去重用的 key, 默认为任务本身
+        """
+        with self.lock:
+            self.buffer.append((key or item, item))
+            if len(self.buffer) >= self.batch_size or time.monotonic() - self.flushed >= self.flush_interval:
+                self.flush()
+
+    @property
+    def buffered(self):
+        """ 还没有推送的任务数"""
+        return len(self.buffer) + len(self.unpushed)
+
+    def flush(self):
+        """ 推送缓存的任务, 返回新推送的任务数
+
+        请求失败时这一批任务放回缓存的最前面再抛出异常, 下次 flush 时重新推送, 不会丢失.
+        """
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+            unpushed, self.unpushed = self.unpushed, []
+            self.flushed = time.monotonic()
+            if not buffer and not unpushed:
+                return 0
+            added = []
+            if buffer:
+                # 在事务里 sadd, 失败时整批都没有执行
+                pipe = self.client.pipeline(transaction=True)
+                for key, _ in buffer:
+                    pipe.sadd(self.seen, key)
+                try:
+                    added = pipe.execute()
+                except Exception:
+                    self.buffer[:0] = buffer
+                    self.unpushed[:0] = unpushed
+                    logger.error(f"failed to dedup {len(buffer)} tasks in redis {self.name}, kept for the next flush")
+                    raise
+            new_items = [item for (_, item), new in zip(buffer, added) if new]
+            items = unpushed + new_items
+            if items:
+                pipe = self.client.pipeline(transaction=True)
+                # 一次 lpush 太多参数会阻塞 redis, 分成小块
+                for i in range(0, len(items), 1000):
+                    pipe.lpush(self.name, *items[i:i + 1000])
+                try:
+                    pipe.execute()
+                except Exception:
+                    # 这些任务的 key 已经在 {name}:seen 里, 下次直接推送, 不再去重
+                    self.unpushed[:0] = items
+                    logger.error(f"failed to push {len(items)} tasks to redis {self.name}, kept for the next flush")
+                    raise
+            self.pushed += len(items)
+            self.duplicated += len(buffer) - len(new_items)
+            logger.info(f"push {len(items)} tasks to redis {self.name}, {len(buffer) - len(new_items)} duplicated")
+            return len(items)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026/10/18
+
+@Author: Mamba
+
+@Purpose: 启动时把所有 xpath 编译成 etree.XPath, 一次调用计算一组 xpath
+
+@ModifyRecord:
+"""
+from lxml import etree
+
+_registry = {}
+
+
+class XPathSet:
+    """ 一组预编译的 xpath, {名字: etree.XPath}"""
+
+    def __init__(self, patterns):
+        """
+        Parameters
+        ----------
+        patterns : dict, {名字: xpath 字符串}
+        """
+        self.patterns = dict(patterns)
+        self.compiled = {name: etree.XPath(pattern) for name, pattern in self.patterns.items()}
+
+    def __getitem__(self, name):
+        return self.compiled[name]
+
+    def __contains__(self, name):
+        return name in self.compiled
+
+    def evaluate(self, selector, names=None):
+        """ 在 selector 上计算 names 中的 xpath, 默认计算全部
+
+        Returns
+        -------
+        dict, {名字: xpath 结果列表}, 计算出错的 xpath 结果为 []
+        """
+        result = {}
+        for name in names or self.compiled:
+            try:
+                result[name] = self.compiled[name](selector)
+            except etree.XPathError:
+                result[name] = []
+        return result
+
+
+def register(name, patterns):
+    """ 编译并注册一组 xpath, 返回 XPathSet"""
+    _registry[name] = XPathSet(patterns)
+    return _registry[name]
+
+
+def get_xpaths(name):
+    return _registry[name]